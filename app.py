@@ -1,22 +1,69 @@
 #!/usr/bin/env python3
-import os
-import uuid
-import tempfile
-from datetime import datetime
-from pathlib import Path
-from flask import Flask, request, jsonify, render_template, send_from_directory, session, redirect, url_for, abort
-from flask_cors import CORS
-from werkzeug.utils import secure_filename
-from b2sdk.v2 import InMemoryAccountInfo, B2Api
-from dotenv import load_dotenv
-
-# Firebase imports
-try:
-    import firebase_admin
-    from firebase_admin import credentials, firestore
-    FIREBASE_AVAILABLE = True
-except ImportError:
-    FIREBASE_AVAILABLE = False
+import time
+
+# Informe de arranque: los cold starts de Vercel son nuestra latencia p99,
+# así que se mide cuánto cuesta cada import y cuánto tarda la primera petición
+_PROCESS_START = time.perf_counter()
+STARTUP_TIMINGS = {}
+
+class StartupTimer:
+    """Medir un paso del arranque (en ms) y guardarlo en STARTUP_TIMINGS"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        STARTUP_TIMINGS[self.name] = round((time.perf_counter() - self._started) * 1000, 1)
+
+with StartupTimer('import stdlib'):
+    import os
+    import base64
+    import contextvars
+    import hashlib
+    import heapq
+    import hmac
+    import gzip
+    import mimetypes
+    import importlib.util
+    import io
+    import json
+    import queue
+    import random
+    import re
+    import shutil
+    import uuid
+    import tempfile
+    from collections import Counter, OrderedDict, deque
+    from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+    import threading
+    from datetime import datetime, timedelta
+    from pathlib import Path
+    from urllib.parse import quote
+with StartupTimer('import flask'):
+    from flask import (
+        Flask, request, jsonify, render_template, send_from_directory, session, redirect, url_for, abort,
+        g, has_request_context
+    )
+    from werkzeug.exceptions import HTTPException
+    from werkzeug.security import safe_join
+    from werkzeug.sansio.multipart import (
+        Data as MultipartData, Epilogue, File as MultipartFile, MultipartDecoder, NeedData
+    )
+    from werkzeug.utils import secure_filename
+with StartupTimer('import flask_cors'):
+    from flask_cors import CORS
+with StartupTimer('import dotenv'):
+    from dotenv import load_dotenv
+
+# b2sdk, firebase_admin y Pillow se importan en el primer uso (ver B2SessionManager,
+# init_firebase y transcode_upload) para que /login y los estáticos no paguen su coste.
+FIREBASE_AVAILABLE = importlib.util.find_spec('firebase_admin') is not None
+PILLOW_AVAILABLE = importlib.util.find_spec('PIL') is not None
+# Opcional: variantes .br de los assets (pip install brotli); sin él solo gzip
+BROTLI_AVAILABLE = importlib.util.find_spec('brotli') is not None
 
 # Cargar variables de entorno desde .env
 load_dotenv()
@@ -48,6 +95,106 @@ else:
 
 ALLOWED_EXTENSIONS = {'webp', 'jpg', 'jpeg', 'png', 'gif'}
 
+# Campos opcionales que se guardan en el registro de Firestore si se conocen
+OPTIONAL_RECORD_FIELDS = ('bytes', 'sha1', 'original_bytes')
+# Campos que un reintento puede volver a escribir en un registro que ya existe: el
+# timestamp (orden del listado y día de las estadísticas), los bytes y los
+# metadatos se quedan como los guardó el primer intento
+RECORD_RETRY_FIELDS = ('filename', 'url', 'b2_filename', 'sha1')
+
+# Subida en streaming: cuerpos hasta este tamaño van en una sola petición
+# (upload_bytes); los mayores se trocean en partes de STREAM_PART_SIZE
+STREAM_SMALL_UPLOAD_MAX = int(os.getenv('STREAM_SMALL_UPLOAD_MAX', 5 * 1024 * 1024))
+STREAM_PART_SIZE = int(os.getenv('STREAM_PART_SIZE', 8 * 1024 * 1024))
+STREAM_READ_SIZE = 64 * 1024
+
+# Subida directa multiparte (API de archivos grandes de B2, partes >= 5MB)
+LARGE_UPLOAD_PART_SIZE = max(int(os.getenv('LARGE_UPLOAD_PART_SIZE', 16 * 1024 * 1024)), 5 * 1024 * 1024)
+LARGE_UPLOAD_MAX_PARALLEL = int(os.getenv('LARGE_UPLOAD_MAX_PARALLEL', 4))
+
+# Conversión a WebP en el servidor para /upload (desactivada por defecto)
+SERVER_WEBP_ENABLED = os.getenv('SERVER_WEBP_ENABLED', '0') == '1'
+SERVER_WEBP_QUALITY = int(os.getenv('SERVER_WEBP_QUALITY', 85))
+SERVER_WEBP_MAX_DIMENSION = int(os.getenv('SERVER_WEBP_MAX_DIMENSION', 4096))  # 0 = sin límite
+SERVER_WEBP_MAX_INPUT_BYTES = int(os.getenv('SERVER_WEBP_MAX_INPUT_BYTES', 30 * 1024 * 1024))
+TRANSCODE_WORKERS = int(os.getenv('TRANSCODE_WORKERS', os.cpu_count() or 1))
+TRANSCODE_TIMEOUT = float(os.getenv('TRANSCODE_TIMEOUT', 60))
+
+# Metadatos de imagen tras registrar una subida (dimensiones, color, blurhash):
+# hilos y trabajos en espera de la cola, bytes de la lectura parcial de la
+# cabecera y tamaño máximo que se descarga entero para el placeholder
+METADATA_WORKERS = int(os.getenv('METADATA_WORKERS', 2))
+METADATA_MAX_PENDING = int(os.getenv('METADATA_MAX_PENDING', 256))
+METADATA_HEADER_BYTES = int(os.getenv('METADATA_HEADER_BYTES', 64 * 1024))
+METADATA_MAX_DECODE_BYTES = int(os.getenv('METADATA_MAX_DECODE_BYTES', 20 * 1024 * 1024))
+# Campos de metadatos que el listado devuelve cuando existen
+IMAGE_METADATA_FIELDS = ('width', 'height', 'bytes', 'mime', 'color', 'blurhash')
+
+# Miniaturas (/thumb/<b2_filename>?w=&fmt=): anchos admitidos (otro ancho se
+# redondea al siguiente), calidad, original más grande que se redimensiona y
+# caché en disco con expulsión LRU cuando pasa de THUMB_CACHE_MAX_BYTES.
+# Los fallos (original inexistente, demasiado grande o que no es una imagen)
+# se recuerdan THUMB_FAILURE_TTL segundos, hasta THUMB_FAILURE_MAX_ENTRIES
+THUMB_WIDTHS = tuple(sorted(int(w) for w in os.getenv('THUMB_WIDTHS', '160,320,640,1280').split(',')))
+THUMB_FORMATS = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+THUMB_QUALITY = int(os.getenv('THUMB_QUALITY', 80))
+THUMB_MAX_SOURCE_BYTES = int(os.getenv('THUMB_MAX_SOURCE_BYTES', 30 * 1024 * 1024))
+THUMB_CACHE_DIR = os.getenv('THUMB_CACHE_DIR', os.path.join(UPLOAD_FOLDER, 'thumbs'))
+THUMB_CACHE_MAX_BYTES = int(os.getenv('THUMB_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+THUMB_MAX_AGE = int(os.getenv('THUMB_MAX_AGE', 365 * 24 * 3600))
+THUMB_FAILURE_TTL = float(os.getenv('THUMB_FAILURE_TTL', 5 * 60))
+THUMB_FAILURE_MAX_ENTRIES = int(os.getenv('THUMB_FAILURE_MAX_ENTRIES', 10000))
+
+# Subidas por lotes: máximo de archivos por petición y de escrituras por WriteBatch,
+# y consultas simultáneas a B2 del tamaño de los archivos al registrarlos
+UPLOAD_BATCH_MAX = int(os.getenv('UPLOAD_BATCH_MAX', 200))
+FIRESTORE_BATCH_LIMIT = 500
+UPLOAD_COMPLETE_LOOKUP_CONCURRENCY = int(os.getenv('UPLOAD_COMPLETE_LOOKUP_CONCURRENCY', 8))
+
+# Cola de trabajos de /upload?async=1: hilos, trabajos en espera, reintentos y
+# segundos que se conserva el estado de un trabajo terminado
+UPLOAD_JOB_WORKERS = int(os.getenv('UPLOAD_JOB_WORKERS', 4))
+UPLOAD_JOB_MAX_PENDING = int(os.getenv('UPLOAD_JOB_MAX_PENDING', 32))
+UPLOAD_JOB_MAX_ATTEMPTS = int(os.getenv('UPLOAD_JOB_MAX_ATTEMPTS', 3))
+UPLOAD_JOB_RETRY_BASE = float(os.getenv('UPLOAD_JOB_RETRY_BASE', 1))
+UPLOAD_JOB_TTL = int(os.getenv('UPLOAD_JOB_TTL', 10 * 60))
+
+# Control de admisión de /upload (por proceso): subidas simultáneas, bytes en
+# vuelo (Content-Length de las subidas en curso y de los trabajos en cola),
+# bytes de cuerpos que se pueden retener en memoria y segundos base de Retry-After
+UPLOAD_MAX_CONCURRENT = int(os.getenv('UPLOAD_MAX_CONCURRENT', 8))
+UPLOAD_MAX_INFLIGHT_BYTES = int(os.getenv('UPLOAD_MAX_INFLIGHT_BYTES', 512 * 1024 * 1024))
+UPLOAD_MEMORY_BUDGET = int(os.getenv('UPLOAD_MEMORY_BUDGET', 64 * 1024 * 1024))
+UPLOAD_RETRY_AFTER = int(os.getenv('UPLOAD_RETRY_AFTER', 5))
+
+# Estadísticas de la galería (imágenes, bytes, por extensión y por día) en
+# STATS_SHARDS documentos que se suman al leer; /api/uploads/stats las cachea
+STATS_COLLECTION = os.getenv('STATS_COLLECTION', 'upload_stats')
+STATS_SHARDS = int(os.getenv('STATS_SHARDS', 10))
+STATS_CACHE_TTL = float(os.getenv('STATS_CACHE_TTL', 10))
+
+# Índice de contenido (SHA1 -> subida existente) para no subir duplicados
+HASH_INDEX_COLLECTION = os.getenv('HASH_INDEX_COLLECTION', 'upload_hashes')
+HASH_INDEX_CACHE_SIZE = int(os.getenv('HASH_INDEX_CACHE_SIZE', 10000))
+
+# Paginación del listado de /uploads
+UPLOADS_PAGE_SIZE = int(os.getenv('UPLOADS_PAGE_SIZE', 50))
+UPLOADS_MAX_PAGE_SIZE = int(os.getenv('UPLOADS_MAX_PAGE_SIZE', 200))
+# Caché en proceso del listado (segundos de vida y número máximo de páginas)
+LISTING_CACHE_TTL = float(os.getenv('LISTING_CACHE_TTL', 30))
+LISTING_CACHE_MAX_ENTRIES = int(os.getenv('LISTING_CACHE_MAX_ENTRIES', 64))
+# /api/uploads/changes vuelve a leer los últimos segundos antes del token: el
+# timestamp se genera antes de escribir, así que otro worker puede guardar un
+# registro "más antiguo" después de que el cliente haya avanzado su token
+UPLOADS_CHANGES_OVERLAP = float(os.getenv('UPLOADS_CHANGES_OVERLAP', 5))
+
+# Índice de búsqueda en proceso: segundos hasta refrescarlo con los cambios de
+# Firestore (recoge lo que subieron otros workers), máximo de cambios por
+# refresco (si hay más se reconstruye entero) y tamaño de página de resultados
+SEARCH_INDEX_MAX_AGE = int(os.getenv('SEARCH_INDEX_MAX_AGE', 5 * 60))
+SEARCH_INDEX_REFRESH_LIMIT = int(os.getenv('SEARCH_INDEX_REFRESH_LIMIT', 500))
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 50))
+
 # Crear directorios necesarios (only if not on Vercel or for /tmp)
 try:
     os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -58,12 +205,44 @@ except OSError as e:
 
 # Firebase es el único almacenamiento - no hay JSON local
 
+# Assets con huella (/assets/<nombre>.<hash>.<ext>): se cachean un año como immutable.
+# build_assets.py los deja construidos en static/dist (con manifest.json); los que
+# falten se construyen en memoria al primer uso, con brotli de calidad
+# ASSET_BROTLI_QUALITY (la 11 del build es demasiado lenta para una petición)
+ASSET_MAX_AGE = int(os.getenv('ASSET_MAX_AGE', 365 * 24 * 3600))
+ASSET_DIST_DIR = 'dist'
+ASSET_BROTLI_QUALITY = int(os.getenv('ASSET_BROTLI_QUALITY', 5))
+ASSET_COMPRESSIBLE_TYPES = ('text/css', 'text/javascript', 'application/javascript', 'application/json',
+                            'image/svg+xml')
+
+# Almacenamiento de los archivos: 'b2' (Backblaze, por defecto) o 'local' (disco,
+# servido por /files/<nombre>; LOCAL_STORAGE_URL puede apuntar a un CDN delante)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'b2').lower()
+LOCAL_STORAGE_DIR = os.getenv('LOCAL_STORAGE_DIR', os.path.join(UPLOAD_FOLDER, 'files'))
+LOCAL_STORAGE_URL = os.getenv('LOCAL_STORAGE_URL', '/files').rstrip('/')
+LOCAL_STORAGE_MAX_AGE = int(os.getenv('LOCAL_STORAGE_MAX_AGE', 365 * 24 * 3600))
+# Delegar el envío en Apache/lighttpd (X-Sendfile) en lugar de servirlo desde Python
+app.config['USE_X_SENDFILE'] = os.getenv('LOCAL_STORAGE_X_SENDFILE') == '1'
+
 # Configuración de Backblaze B2
 B2_APPLICATION_KEY_ID = os.getenv('B2_APPLICATION_KEY_ID', '004342de23298e60000000008')
 B2_APPLICATION_KEY = os.getenv('B2_APPLICATION_KEY', 'K004vxv230w3HCnvPNwX1MAu8YABxxY')
 B2_BUCKET_NAME = os.getenv('B2_BUCKET_NAME', 'openlapimages')
 B2_ENDPOINT = os.getenv('B2_ENDPOINT', 'https://f004.backblazeb2.com')
 B2_PREFIX = os.getenv('B2_PREFIX', 'products')
+# Realm de autorización: 'production' o una URL (p. ej. el fake de benchmarks/fake_b2.py)
+B2_REALM = os.getenv('B2_REALM', 'production')
+# Renovar el token de B2 antes de que expire (B2 lo invalida a las 24h)
+B2_AUTH_REFRESH_SECONDS = int(os.getenv('B2_AUTH_REFRESH_SECONDS', 23 * 3600))
+# Pool de URLs de subida directa (una subida simultánea por URL)
+UPLOAD_URL_POOL_SIZE = int(os.getenv('UPLOAD_URL_POOL_SIZE', 4))
+UPLOAD_URL_LEASE_SECONDS = int(os.getenv('UPLOAD_URL_LEASE_SECONDS', 15 * 60))
+UPLOAD_URL_MAX_AGE_SECONDS = int(os.getenv('UPLOAD_URL_MAX_AGE_SECONDS', 23 * 3600))
+UPLOAD_URL_FETCH_CONCURRENCY = int(os.getenv('UPLOAD_URL_FETCH_CONCURRENCY', 8))
+
+# Métricas: token opcional para /metrics (si no, basta con la sesión) y cabecera Server-Timing
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+SERVER_TIMING_ENABLED = os.getenv('SERVER_TIMING_ENABLED', '1') == '1'
 
 # Configuración de Firebase (obligatorio)
 FIREBASE_PROJECT_ID = os.getenv('FIREBASE_PROJECT_ID')
@@ -71,17 +250,138 @@ FIREBASE_PRIVATE_KEY = os.getenv('FIREBASE_PRIVATE_KEY')
 FIREBASE_CLIENT_EMAIL = os.getenv('FIREBASE_CLIENT_EMAIL')
 FIREBASE_STORAGE_BUCKET = os.getenv('FIREBASE_STORAGE_BUCKET')
 
+class Metrics:
+    """Contadores e histogramas en proceso, expuestos en formato Prometheus.
+
+    Cada worker tiene los suyos; Prometheus los agrega por instancia.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # (nombre, etiquetas) -> valor
+        self._histograms = {}  # (nombre, etiquetas) -> [cuentas por bucket, suma, total]
+        self._help = {}
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    entry[0][i] += 1
+            entry[1] += seconds
+            entry[2] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+    def render(self, gauges=None):
+        """Texto de exposición de Prometheus; gauges = {nombre: valor} calculados al vuelo"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(e[0]), e[1], e[2]) for key, e in self._histograms.items()}
+        lines = []
+        seen = set()
+
+        def header(name, default_kind):
+            if name in seen:
+                return
+            seen.add(name)
+            kind, text = self._help.get(name, (default_kind, name))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, 'counter')
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            header(name, 'histogram')
+            for bound, bucket_count in zip(self.BUCKETS, counts):
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {bucket_count}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        for name, value in sorted((gauges or {}).items()):
+            header(name, 'gauge')
+            lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('app_span_duration_seconds', 'histogram', 'Duración de las operaciones contra backends (B2, Firestore, disco)')
+metrics.describe('app_http_request_duration_seconds', 'histogram', 'Duración de las peticiones HTTP por endpoint')
+metrics.describe('app_uploaded_bytes_total', 'counter', 'Bytes subidos a B2 por vía de subida')
+metrics.describe('app_firestore_documents_read_total', 'counter', 'Documentos leídos de Firestore')
+metrics.describe('app_firestore_documents_written_total', 'counter', 'Documentos escritos en Firestore')
+metrics.describe('app_errors_total', 'counter', 'Errores por causa')
+
+class Span:
+    """Medir una operación contra un backend.
+
+    La duración va al histograma app_span_duration_seconds y, dentro de una
+    petición, a la cabecera Server-Timing. Si la operación lanza una excepción
+    se cuenta en app_errors_total con el nombre del span como causa.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self._started
+        metrics.observe('app_span_duration_seconds', elapsed, span=self.name)
+        if exc_type is not None and not issubclass(exc_type, HTTPException):
+            metrics.inc('app_errors_total', cause=self.name)
+        if has_request_context():
+            spans = g.setdefault('spans', {})
+        else:
+            # Peticiones del modo ASGI (asgi.py): cada tarea tiene su propio dict
+            spans = request_spans.get()
+        if spans is not None:
+            total, count = spans.get(self.name, (0.0, 0))
+            spans[self.name] = (total + elapsed, count + 1)
+
+request_spans = contextvars.ContextVar('request_spans', default=None)
+
 # Inicialización de Firebase Firestore
 firestore_db = None
 firestore_collection = None
+hash_index_collection = None
+stats_collection = None
+
+_firebase_lock = threading.Lock()
 
 def init_firebase():
     """Inicializar Firebase Firestore (obligatorio)"""
-    global firestore_db, firestore_collection
+    global firestore_db, firestore_collection, hash_index_collection, stats_collection
     
     if not FIREBASE_AVAILABLE:
         raise RuntimeError("Firebase Admin SDK no está instalado. Ejecuta: pip install firebase-admin")
     
+    with StartupTimer('import firebase_admin'):
+        import firebase_admin
+        from firebase_admin import credentials, firestore
+    
     # Verificar que todas las variables requeridas estén configuradas
     required_vars = {
         'FIREBASE_PROJECT_ID': FIREBASE_PROJECT_ID,
@@ -114,29 +414,37 @@ def init_firebase():
             "client_x509_cert_url": None
         }
         
-        # Inicializar Firebase solo si no está ya inicializado
-        if not firebase_admin._apps:
-            cred = credentials.Certificate(cred_dict)
-            firebase_admin.initialize_app(cred, {
-                'storageBucket': FIREBASE_STORAGE_BUCKET
-            })
-        
-        firestore_db = firestore.client()
-        firestore_collection = firestore_db.collection('uploads')
+        with StartupTimer('init firestore'):
+            # Inicializar Firebase solo si no está ya inicializado
+            if not firebase_admin._apps:
+                cred = credentials.Certificate(cred_dict)
+                firebase_admin.initialize_app(cred, {
+                    'storageBucket': FIREBASE_STORAGE_BUCKET
+                })
+            
+            db = firestore.client()
+            firestore_collection = db.collection('uploads')
+            hash_index_collection = db.collection(HASH_INDEX_COLLECTION)
+            stats_collection = db.collection(STATS_COLLECTION)
+            firestore_db = db
         print("Firebase Firestore inicializado correctamente")
         return True
     except Exception as e:
         raise RuntimeError(f"Error inicializando Firebase: {e}")
 
-# Inicializar Firebase al iniciar la aplicación
-try:
-    init_firebase()
-    print("Firebase Firestore configurado como único almacenamiento")
-except Exception as e:
-    print(f"ERROR CRÍTICO: {e}")
-    print("La aplicación no puede funcionar sin Firebase.")
-    print("Configura las variables de entorno de Firebase o instala firebase-admin")
-    # La aplicación continuará, pero las funciones fallarán cuando intenten usar Firestore
+def get_firestore_db():
+    """Cliente de Firestore, inicializado en el primer uso (no al importar la app)"""
+    if firestore_db is None:
+        with _firebase_lock:
+            if firestore_db is None:
+                try:
+                    init_firebase()
+                except Exception as e:
+                    print(f"ERROR CRÍTICO: {e}")
+                    print("La aplicación no puede funcionar sin Firebase.")
+                    print("Configura las variables de entorno de Firebase o instala firebase-admin")
+                    raise RuntimeError(f"Firestore no está inicializado: {e}")
+    return firestore_db
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -147,154 +455,1889 @@ def generate_b2_filename(filename):
     unique_id = uuid.uuid4().hex[:12]
     return f"{B2_PREFIX}{Path(filename).stem}-{unique_id}{ext}"
 
-def get_upload_credentials(b2_filename):
-    """Get upload credentials for direct client upload"""
-    bucket = init_b2()
-    
-    # Get upload authorization from B2 using low-level API
-    try:
-        upload_data = bucket.api.session.get_upload_url(bucket.id_)
-        
+class B2SessionManager:
+    """Sesión de Backblaze B2 compartida por todo el proceso.
+
+    Autoriza una sola vez, reutiliza el B2Api (y sus conexiones HTTP) y el
+    bucket, y renueva el token antes de que expire (B2 lo invalida a las 24h).
+    """
+
+    def __init__(self, key_id, key, bucket_name, realm="production", refresh_after=B2_AUTH_REFRESH_SECONDS):
+        self.key_id = key_id
+        self.key = key
+        self.bucket_name = bucket_name
+        self.realm = realm
+        self.refresh_after = refresh_after
+        self._lock = threading.Lock()
+        self._api = None
+        self._bucket = None
+        self._authorized_at = 0.0
+        self.hits = 0
+        self.authorizations = 0
+        self.refreshes = 0
+        self.auth_retries = 0
+
+    def _is_fresh(self):
+        return self._bucket is not None and (time.monotonic() - self._authorized_at) < self.refresh_after
+
+    def _authorize(self):
+        """Autorizar la cuenta y resolver el bucket (llamar con el lock tomado)"""
+        if self._api is None:
+            with StartupTimer('import b2sdk'):
+                from b2sdk.v2 import B2Api, InMemoryAccountInfo
+            self._api = B2Api(InMemoryAccountInfo())
+        else:
+            self.refreshes += 1
+        with Span('b2_auth'):
+            self._api.authorize_account(self.realm, self.key_id, self.key)
+            self._bucket = self._api.get_bucket_by_name(self.bucket_name)
+        self._authorized_at = time.monotonic()
+        self.authorizations += 1
+        print(f"B2 autorizado (autorizaciones={self.authorizations}, renovaciones={self.refreshes})")
+
+    def get_bucket(self, force_refresh=False):
+        """Devolver el bucket autorizado, renovando el token solo si hace falta"""
+        seen = self._authorized_at
+        if not force_refresh and self._is_fresh():
+            self.hits += 1
+            return self._bucket
+        with self._lock:
+            # Otro hilo pudo haber renovado mientras esperábamos el lock
+            if self._is_fresh() and (not force_refresh or self._authorized_at != seen):
+                self.hits += 1
+                return self._bucket
+            self._authorize()
+            return self._bucket
+
+    def call(self, fn):
+        """Ejecutar fn(bucket) y reintentar una vez si B2 responde 401 (token expirado)"""
+        bucket = self.get_bucket()
+        from b2sdk.v2.exception import InvalidAuthToken
+        try:
+            return fn(bucket)
+        except InvalidAuthToken as e:
+            print(f"Token de B2 inválido o expirado, reautorizando: {e}")
+            self.auth_retries += 1
+            metrics.inc('app_errors_total', cause='b2_auth_expired')
+            return fn(self.get_bucket(force_refresh=True))
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "authorizations": self.authorizations,
+            "refreshes": self.refreshes,
+            "auth_retries": self.auth_retries,
+            "token_age_seconds": round(time.monotonic() - self._authorized_at, 1) if self._authorized_at else None,
+        }
+
+
+b2_session = B2SessionManager(B2_APPLICATION_KEY_ID, B2_APPLICATION_KEY, B2_BUCKET_NAME, realm=B2_REALM)
+
+def init_b2():
+    """Obtener el bucket de Backblaze B2 desde la sesión compartida del proceso"""
+    return b2_session.get_bucket()
+
+class UploadUrlPool:
+    """Pool de URLs de subida de B2 pre-obtenidas en segundo plano.
+
+    B2 solo admite una subida simultánea por URL, así que cada URL se presta
+    (lease) a un único cliente y vuelve al pool en /api/upload/complete.
+    Los préstamos no devueltos caducan y su URL se descarta.
+    """
+
+    def __init__(self, session, target_size=UPLOAD_URL_POOL_SIZE, lease_timeout=UPLOAD_URL_LEASE_SECONDS,
+                 max_age=UPLOAD_URL_MAX_AGE_SECONDS):
+        self.session = session
+        self.target_size = target_size
+        self.lease_timeout = lease_timeout
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._available = deque()
+        self._leases = {}
+        self._refill = threading.Event()
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+        self.expired_leases = 0
+
+    def _fetch(self):
+        """Pedir una URL de subida nueva a B2"""
+        with Span('b2_upload_url'):
+            upload_data = self.session.call(lambda b: b.api.session.get_upload_url(b.id_))
         return {
             'upload_url': upload_data['uploadUrl'],
             'authorization_token': upload_data['authorizationToken'],
-            'b2_filename': b2_filename,
-            'bucket_id': bucket.id_
+            'bucket_id': upload_data['bucketId'],
+            'fetched_at': time.monotonic(),
         }
+
+    def _is_usable(self, entry, now):
+        return now - entry['fetched_at'] < self.max_age
+
+    def _expire_leases(self, now):
+        """Eliminar préstamos vencidos (llamar con el lock tomado)"""
+        expired = [lease_id for lease_id, (_, expires_at) in self._leases.items() if expires_at <= now]
+        for lease_id in expired:
+            del self._leases[lease_id]
+        self.expired_leases += len(expired)
+
+    def _ensure_worker(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='b2-upload-url-pool', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._refill.wait(timeout=30)
+            self._refill.clear()
+            with self._lock:
+                now = time.monotonic()
+                self._expire_leases(now)
+                self._available = deque(e for e in self._available if self._is_usable(e, now))
+                missing = self.target_size - len(self._available)
+            for _ in range(max(missing, 0)):
+                try:
+                    entry = self._fetch()
+                except Exception as e:
+                    print(f"Error rellenando pool de URLs de subida: {e}")
+                    time.sleep(5)
+                    break
+                with self._lock:
+                    self._available.append(entry)
+
+    def lease(self):
+        """Prestar una URL de subida; devuelve (lease_id, entry)"""
+        return self.lease_many(1)[0]
+
+    def lease_many(self, count):
+        """Prestar varias URLs; las que falten en el pool se piden a B2 en paralelo"""
+        self._ensure_worker()
+        entries = []
+        with self._lock:
+            now = time.monotonic()
+            self._expire_leases(now)
+            while self._available and len(entries) < count:
+                candidate = self._available.popleft()
+                if self._is_usable(candidate, now):
+                    entries.append(candidate)
+            self.hits += len(entries)
+        missing = count - len(entries)
+        if missing > 0:
+            # Pool vacío: obtenerlas en línea y rellenar en segundo plano
+            self.misses += missing
+            with ThreadPoolExecutor(max_workers=min(missing, UPLOAD_URL_FETCH_CONCURRENCY)) as executor:
+                entries.extend(executor.map(lambda _: self._fetch(), range(missing)))
+        leases = []
+        with self._lock:
+            expires_at = time.monotonic() + self.lease_timeout
+            for entry in entries:
+                lease_id = uuid.uuid4().hex
+                self._leases[lease_id] = (entry, expires_at)
+                leases.append((lease_id, entry))
+        self._refill.set()
+        return leases
+
+    def release(self, lease_id):
+        """Devolver una URL prestada al pool (ignora préstamos desconocidos o
+        vencidos, y la descarta si el pool ya tiene target_size URLs)"""
+        if not lease_id:
+            return False
+        with self._lock:
+            item = self._leases.pop(lease_id, None)
+            if item is None:
+                return False
+            entry, expires_at = item
+            now = time.monotonic()
+            if expires_at <= now or not self._is_usable(entry, now):
+                return False
+            # Con el pool lleno (préstamos de fallos que se devuelven) se descarta
+            if len(self._available) >= self.target_size:
+                return False
+            self._available.append(entry)
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "available": len(self._available),
+                "leased": len(self._leases),
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired_leases": self.expired_leases,
+            }
+
+
+upload_url_pool = UploadUrlPool(b2_session)
+
+def get_upload_credentials(b2_filename):
+    """Get upload credentials for direct client upload (leased from the upload URL pool)"""
+    return get_upload_credentials_batch([b2_filename])[0]
+
+def get_upload_credentials_batch(b2_filenames):
+    """Get one set of upload credentials per B2 filename"""
+    try:
+        with Span('upload_url_lease'):
+            leases = upload_url_pool.lease_many(len(b2_filenames))
     except Exception as e:
         print(f"Error getting upload URL: {e}")
-        # Try alternative approach if above fails
+        raise RuntimeError(f"Failed to get upload credentials: {e}")
+    return [
+        {
+            'upload_url': entry['upload_url'],
+            'authorization_token': entry['authorization_token'],
+            'b2_filename': b2_filename,
+            'bucket_id': entry['bucket_id'],
+            'lease_id': lease_id
+        }
+        for b2_filename, (lease_id, entry) in zip(b2_filenames, leases)
+    ]
+
+class HashingReader:
+    """Envuelve un stream de lectura calculando SHA1 y bytes leídos sobre la marcha"""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._sha1 = hashlib.sha1()
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self._stream.read(-1 if size is None else size)
+        if data:
+            self._sha1.update(data)
+            self.bytes_read += len(data)
+        return data
+
+    def hexdigest(self):
+        return self._sha1.hexdigest()
+
+
+class MalformedUpload(ValueError):
+    """Cuerpo multipart truncado o mal formado (el cliente recibe un 400)"""
+
+
+class MultipartFileReader:
+    """Lee un campo de archivo multipart directamente del cuerpo de la petición.
+
+    Decodifica el multipart de forma incremental, sin pasar por request.files
+    (que vuelca el archivo a disco) y sin cargarlo entero en memoria.
+    """
+
+    def __init__(self, stream, boundary, field_name='file', chunk_size=STREAM_READ_SIZE):
+        self._stream = stream
+        self._decoder = MultipartDecoder(boundary.encode('latin-1'))
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._done = False
+        self.filename = None
+        self.content_type = None
+        self._find_file(field_name)
+
+    @classmethod
+    def from_request(cls, req, field_name='file'):
+        boundary = req.mimetype_params.get('boundary')
+        if req.mimetype != 'multipart/form-data' or not boundary:
+            raise ValueError("No file part")
+        return cls(req.stream, boundary, field_name)
+
+    def _next_event(self):
+        while True:
+            try:
+                event = self._decoder.next_event()
+            except ValueError as e:
+                # El decoder no sabe seguir (cuerpo cortado o mal formado)
+                raise MalformedUpload(f"Malformed multipart body: {e}") from e
+            if not isinstance(event, NeedData):
+                return event
+            chunk = self._stream.read(self._chunk_size)
+            self._decoder.receive_data(chunk or None)
+
+    def _find_file(self, field_name):
+        while True:
+            event = self._next_event()
+            if isinstance(event, MultipartFile) and event.name == field_name:
+                self.filename = event.filename
+                self.content_type = event.headers.get('Content-Type')
+                return
+            if isinstance(event, Epilogue):
+                raise ValueError("No file part")
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        while not self._done and (size < 0 or len(self._buffer) < size):
+            event = self._next_event()
+            if isinstance(event, MultipartData):
+                self._buffer += event.data
+                if not event.more_data:
+                    self._done = True
+            else:
+                self._done = True
+        if size < 0 or size > len(self._buffer):
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+def upload_stream_to_b2(stream, b2_filename, size_hint=None):
+    """Subir un stream a B2 sin archivos temporales.
+
+    Los cuerpos pequeños se suben con upload_bytes; los grandes (o de tamaño
+    desconocido) con upload_unbound_stream, que usa la API de archivos grandes
+    con buffers de STREAM_PART_SIZE, así la memoria queda acotada.
+    Devuelve el tamaño y el SHA1 calculados mientras se leía.
+    """
+    reader = HashingReader(stream)
+    if size_hint is not None and size_hint <= STREAM_SMALL_UPLOAD_MAX:
+        data = reader.read()
+        with Span('b2_transfer'):
+            b2_session.call(lambda b: b.upload_bytes(data, b2_filename))
+    else:
+        # El stream no se puede releer: b2sdk reautoriza por su cuenta si el token expira
+        bucket = init_b2()
+        with Span('b2_transfer'):
+            bucket.upload_unbound_stream(
+                reader,
+                b2_filename,
+                recommended_upload_part_size=STREAM_PART_SIZE,
+                min_part_size=STREAM_PART_SIZE,
+                buffer_size=STREAM_PART_SIZE,
+                buffers_count=2,
+                read_size=STREAM_READ_SIZE,
+            )
+    metrics.inc('app_uploaded_bytes_total', reader.bytes_read, path='server')
+    return {"bytes": reader.bytes_read, "sha1": reader.hexdigest()}
+
+class B2Storage:
+    """Archivos en el bucket de Backblaze B2 (admite subidas directas desde el navegador)"""
+
+    name = 'b2'
+    supports_direct_uploads = True
+
+    def public_url(self, key):
+        return f"{B2_ENDPOINT}/file/{B2_BUCKET_NAME}/{key}"
+
+    def upload_stream(self, stream, key, size_hint=None):
+        return upload_stream_to_b2(stream, key, size_hint)
+
+    def read_range(self, key, start, end):
+        """Bytes [start, end] del archivo y su tamaño total (FileNotFoundError si no existe)"""
+        from b2sdk.v2.exception import FileNotPresent, InvalidRange
+        out = io.BytesIO()
+        with Span('b2_download'):
+            try:
+                downloaded = b2_session.call(lambda b: b.download_file_by_name(key, range_=(start, end)))
+            except FileNotPresent:
+                raise FileNotFoundError(key)
+            except InvalidRange as e:
+                # El rango pasa del final del archivo: B2 lo recorta pero b2sdk
+                # lo rechaza; repetir con el rango que sí existe
+                end = start + e.content_length - 1
+                downloaded = b2_session.call(lambda b: b.download_file_by_name(key, range_=(start, end)))
+            downloaded.save(out)
+        return out.getvalue(), downloaded.download_version.size
+
+    def file_info(self, key):
+        """Lo que B2 guardó del archivo (FileNotFoundError si no existe)"""
+        from b2sdk.v2.exception import FileNotPresent
+        with Span('b2_api'):
+            try:
+                version = b2_session.call(lambda b: b.get_file_info_by_name(key))
+            except FileNotPresent:
+                raise FileNotFoundError(key)
+        # Los archivos grandes traen 'none' o 'unverified:<sha1 del cliente>'
+        sha1 = version.content_sha1 if is_sha1(version.content_sha1) else None
+        return {"bytes": version.size, "sha1": sha1.lower() if sha1 else None}
+
+    def upload_path(self, path, key):
+        with Span('b2_transfer'):
+            b2_session.call(lambda b: b.upload_local_file(local_file=path, file_name=key))
+        size = os.path.getsize(path)
+        metrics.inc('app_uploaded_bytes_total', size, path='server')
+        return {"bytes": size}
+
+
+class LocalStorage:
+    """Archivos en un directorio local, servidos por la ruta /files/<key>"""
+
+    name = 'local'
+    supports_direct_uploads = False
+
+    def __init__(self, root):
+        self.root = root
+
+    def path_for(self, key):
+        path = safe_join(self.root, key)
+        if path is None:
+            raise ValueError(f"Nombre de archivo no válido: {key}")
+        return path
+
+    def public_url(self, key):
+        return f"{LOCAL_STORAGE_URL}/{quote(key)}"
+
+    def upload_stream(self, stream, key, size_hint=None):
+        """Escribir en un temporal del mismo directorio y renombrar (nunca se sirve a medias)"""
+        path = self.path_for(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        reader = HashingReader(stream)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.upload-')
         try:
-            # Get account authorization
-            account_auth = bucket.api.account_info.get_account_authorization()
-            api_url = account_auth['apiUrl']
-            auth_token = account_auth['authorizationToken']
-            
-            # Construct upload URL (v2) without filename (filename goes in header)
-            upload_url = f"{api_url}/b2api/v2/b2_upload_file/{bucket.id_}"
-            return {
-                'upload_url': upload_url,
-                'authorization_token': auth_token,
-                'b2_filename': b2_filename,
-                'bucket_id': bucket.id_
-            }
-        except Exception as e2:
-            raise RuntimeError(f"Failed to get upload credentials: {e2}")
+            with Span('disk_write'), os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(reader, f, STREAM_READ_SIZE)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        metrics.inc('app_uploaded_bytes_total', reader.bytes_read, path='server')
+        return {"bytes": reader.bytes_read, "sha1": reader.hexdigest()}
 
-def init_b2():
-    """Inicializar conexión a Backblaze B2"""
-    info = InMemoryAccountInfo()
-    b2_api = B2Api(info)
-    b2_api.authorize_account("production", B2_APPLICATION_KEY_ID, B2_APPLICATION_KEY)
-    bucket = b2_api.get_bucket_by_name(B2_BUCKET_NAME)
-    return bucket
+    def upload_path(self, path, key):
+        with open(path, 'rb') as f:
+            return self.upload_stream(f, key)
+
+    def read_range(self, key, start, end):
+        path = self.path_for(key)
+        with open(path, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start + 1), os.fstat(f.fileno()).st_size
+
+    def file_info(self, key):
+        digest = hashlib.sha1()
+        with open(self.path_for(key), 'rb') as f:
+            for chunk in iter(lambda: f.read(STREAM_READ_SIZE), b''):
+                digest.update(chunk)
+        return {"bytes": os.path.getsize(self.path_for(key)), "sha1": digest.hexdigest()}
 
 
+def create_storage(backend):
+    if backend == 'b2':
+        return B2Storage()
+    if backend == 'local':
+        return LocalStorage(LOCAL_STORAGE_DIR)
+    raise ValueError(f"STORAGE_BACKEND desconocido: {backend} (usa 'b2' o 'local')")
 
-def upload_to_b2(file_data, filename):
-    """Subir archivo a Backblaze B2 y retornar URL pública.
-    file_data puede ser: ruta de archivo (str/Path) o objeto de archivo (BytesIO, FileStorage).
+storage = create_storage(STORAGE_BACKEND)
+
+def read_stored_file(key, max_bytes):
+    """Leer un archivo del almacenamiento empezando por una lectura parcial.
+
+    Devuelve (datos, tamaño total). Si el archivo pasa de max_bytes solo se
+    lee la cabecera (METADATA_HEADER_BYTES), así que len(datos) < tamaño.
     """
-    bucket = init_b2()
-    ext = Path(filename).suffix.lower()
-    unique_id = uuid.uuid4().hex[:12]
-    b2_filename = f"{B2_PREFIX}{Path(filename).stem}-{unique_id}{ext}"
+    data, size = storage.read_range(key, 0, METADATA_HEADER_BYTES - 1)
+    if size <= max_bytes and size > len(data):
+        rest, _ = storage.read_range(key, len(data), size - 1)
+        data += rest
+    return data, size
+
+def upload_to_storage(file_data, filename, size_hint=None):
+    """Subir archivo al almacenamiento configurado y retornar URL pública.
+    file_data puede ser: ruta de archivo (str/Path) o objeto de archivo
+    (BytesIO, FileStorage, MultipartFileReader), que se sube en streaming.
+    """
+    b2_filename = generate_b2_filename(filename)
+    result = {
+        "filename": filename,
+        "url": get_public_url(b2_filename),
+        "b2_filename": b2_filename
+    }
     
     # Determine if file_data is a path (str/Path) or a file object
     if isinstance(file_data, (str, Path)):
         # It's a file path
-        local_path = str(file_data)
-        bucket.upload_local_file(
-            local_file=local_path,
-            file_name=b2_filename
-        )
+        result.update(storage.upload_path(str(file_data), b2_filename))
     else:
-        # It's a file object - save to temporary file
-        # Ensure upload directory exists
-        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-        
-        import tempfile
-        with tempfile.NamedTemporaryFile(delete=False, suffix=ext, dir=UPLOAD_FOLDER) as tmp_file:
-            # Save file object to temporary file
-            if hasattr(file_data, 'save'):
-                # Werkzeug FileStorage object
-                file_data.save(tmp_file.name)
-            else:
-                # Other file-like object (BytesIO, etc.)
-                tmp_file.write(file_data.read())
-            tmp_path = tmp_file.name
-        
+        # Werkzeug FileStorage expone el contenido en .stream
+        stream = getattr(file_data, 'stream', file_data)
+        result.update(storage.upload_stream(stream, b2_filename, size_hint))
+    
+    return result
+
+class ProgressReader:
+    """Envuelve un stream de lectura contando los bytes leídos en un callback"""
+
+    def __init__(self, stream, on_read):
+        self._stream = stream
+        self._on_read = on_read
+
+    def read(self, size=-1):
+        data = self._stream.read(-1 if size is None else size)
+        if data:
+            self._on_read(len(data))
+        return data
+
+
+class UploadAdmission:
+    """Control de admisión de /upload por proceso.
+
+    Cada subida reserva un hueco (max_concurrent) y los bytes de su
+    Content-Length (max_bytes) antes de leer el cuerpo; si no hay sitio se
+    responde al momento con 429 o 503 y Retry-After. Una subida mayor que
+    max_bytes solo entra con el proceso libre. Aparte, los cuerpos solo se
+    retienen en memoria (spool de async, transcodificación) mientras quepan en
+    memory_budget; si no, van a disco y se suben sin transcodificar.
+    """
+
+    def __init__(self, max_concurrent, max_bytes, memory_budget):
+        self.max_concurrent = max_concurrent
+        self.max_bytes = max_bytes
+        self.memory_budget = memory_budget
+        self._lock = threading.Lock()
+        self._active = 0
+        self._bytes = 0
+        self._memory = 0
+        self.admitted = 0
+        self.rejected_concurrency = 0
+        self.rejected_bytes = 0
+        self.spilled = 0
+
+    def admit(self, size):
+        """Reservar hueco y bytes: devuelve (UploadTicket, None) o (None, código HTTP)"""
+        with self._lock:
+            if self._active >= self.max_concurrent:
+                self.rejected_concurrency += 1
+                return None, 429
+            if self._bytes and self._bytes + size > self.max_bytes:
+                self.rejected_bytes += 1
+                return None, 503
+            self._active += 1
+            self._bytes += size
+            self.admitted += 1
+        return UploadTicket(self, size), None
+
+    def _reserve_memory(self, size):
+        with self._lock:
+            if self._memory + size > self.memory_budget:
+                self.spilled += 1
+                return False
+            self._memory += size
+            return True
+
+    def _release(self, ticket, slot_only=False):
+        with self._lock:
+            self._active -= ticket._slot
+            ticket._slot = 0
+            if not slot_only:
+                self._bytes -= ticket.size
+                self._memory -= ticket.memory
+                ticket.size = ticket.memory = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "active": self._active,
+                "inflight_bytes": self._bytes,
+                "memory_bytes": self._memory,
+                "admitted": self.admitted,
+                "rejected_concurrency": self.rejected_concurrency,
+                "rejected_bytes": self.rejected_bytes,
+                "spilled": self.spilled,
+            }
+
+
+class UploadTicket:
+    """Reserva de una subida admitida. La petición libera el hueco al responder;
+    los bytes se liberan con release() (al terminar el trabajo si es async).
+    """
+
+    def __init__(self, admission, size):
+        self._admission = admission
+        self._slot = 1
+        self.size = size
+        self.memory = 0
+
+    def hold_in_memory(self, size):
+        """Reservar memoria para retener `size` bytes del cuerpo; False si no hay presupuesto"""
+        if size <= self.memory:
+            return True
+        if not self._admission._reserve_memory(size - self.memory):
+            return False
+        self.memory = size
+        return True
+
+    def release_slot(self):
+        self._admission._release(self, slot_only=True)
+
+    def release(self):
+        self._admission._release(self)
+
+
+upload_admission = UploadAdmission(UPLOAD_MAX_CONCURRENT, UPLOAD_MAX_INFLIGHT_BYTES, UPLOAD_MEMORY_BUDGET)
+
+def upload_busy_response(status, error):
+    """Respuesta 429/503 con Retry-After (con algo de azar para no reintentar todos a la vez)"""
+    response = jsonify({"error": error})
+    response.headers['Retry-After'] = str(UPLOAD_RETRY_AFTER + random.randint(0, UPLOAD_RETRY_AFTER))
+    return response, status
+
+
+class UploadJobQueue:
+    """Cola acotada de subidas en segundo plano para /upload?async=1.
+
+    Cada trabajo lee un cuerpo ya volcado a un SpooledTemporaryFile (memoria
+    hasta STREAM_SMALL_UPLOAD_MAX, disco en UPLOAD_FOLDER a partir de ahí), así
+    que se puede releer para reintentar con backoff exponencial. El archivo se
+    cierra (y borra) al terminar, y el estado del trabajo se conserva
+    UPLOAD_JOB_TTL segundos para que el cliente lo consulte.
+    """
+
+    def __init__(self, workers, max_pending):
+        self._workers = workers
+        self._max_pending = max_pending
+        self._executor = None
+        self._jobs = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+
+    def is_full(self):
+        with self._lock:
+            return self._pending >= self._max_pending
+
+    def submit(self, spool, filename, size, ticket=None):
+        """Encolar una subida; devuelve el id del trabajo o None si la cola está llena.
+
+        Si se encola, el trabajo libera el ticket de admisión al terminar.
+        """
+        with self._lock:
+            self._prune()
+            if self._pending >= self._max_pending:
+                return None
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._workers,
+                                                    thread_name_prefix='upload-job')
+            job_id = uuid.uuid4().hex
+            job = {
+                "id": job_id,
+                "status": "queued",
+                "filename": filename,
+                "bytes_total": size,
+                "bytes_done": 0,
+                "attempts": 0,
+                "url": None,
+                "duplicate": False,
+                "error": None,
+                "created_at": time.time(),
+                "finished_at": None,
+            }
+            self._jobs[job_id] = job
+            self._pending += 1
+        self._executor.submit(self._run, job, spool, ticket)
+        return job_id
+
+    def get(self, job_id):
+        """Copia del estado público de un trabajo (None si no existe o ya caducó)"""
+        with self._lock:
+            self._prune()
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            view = {k: v for k, v in job.items() if k not in ('created_at', 'finished_at')}
+        total = view['bytes_total']
+        view['progress'] = round(view['bytes_done'] / total, 3) if total else 0
+        if view['status'] == 'done':
+            view['progress'] = 1
+        return view
+
+    def _prune(self):
+        """Olvidar los trabajos terminados hace más de UPLOAD_JOB_TTL (llamar con el lock)"""
+        cutoff = time.time() - UPLOAD_JOB_TTL
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job['finished_at'] is not None and job['finished_at'] < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _run(self, job, spool, ticket=None):
+        def advance(count):
+            job['bytes_done'] += count
         try:
-            bucket.upload_local_file(
-                local_file=tmp_path,
-                file_name=b2_filename
-            )
+            for attempt in range(1, UPLOAD_JOB_MAX_ATTEMPTS + 1):
+                job['attempts'] = attempt
+                job['status'] = 'uploading'
+                job['bytes_done'] = 0
+                spool.seek(0)
+                try:
+                    payload = store_upload(ProgressReader(spool, advance), job['filename'],
+                                           job['bytes_total'], ticket)
+                except Exception as e:
+                    job['error'] = str(e)
+                    if attempt == UPLOAD_JOB_MAX_ATTEMPTS:
+                        print(f"Trabajo de subida {job['id']} fallido tras {attempt} intentos: {e}")
+                        job['status'] = 'error'
+                        with self._lock:
+                            self.failed += 1
+                        return
+                    delay = UPLOAD_JOB_RETRY_BASE * 2 ** (attempt - 1)
+                    print(f"Reintentando trabajo de subida {job['id']} en {delay}s: {e}")
+                    job['status'] = 'retrying'
+                    with self._lock:
+                        self.retries += 1
+                    time.sleep(delay)
+                    continue
+                job.update(status='done', error=None, url=payload['url'],
+                           filename=payload['filename'], duplicate=payload.get('duplicate', False))
+                with self._lock:
+                    self.completed += 1
+                return
         finally:
-            # Clean up temporary file
-            try:
-                os.unlink(tmp_path)
-            except:
-                pass
-    
-    public_url = f"{B2_ENDPOINT}/file/{B2_BUCKET_NAME}/{b2_filename}"
-    return {
-        "filename": filename,
-        "url": public_url,
-        "b2_filename": b2_filename
-    }
+            spool.close()
+            if ticket is not None:
+                ticket.release()
+            with self._lock:
+                self._pending -= 1
+                job['finished_at'] = time.time()
 
-def save_upload_record(record):
-    """Guardar registro de subida en Firestore (único almacenamiento)"""
-    if not firestore_collection:
-        raise RuntimeError("Firestore no está inicializado. Verifica la configuración de Firebase.")
-    
-    timestamp = datetime.now().isoformat()
+    def stats(self):
+        with self._lock:
+            return {
+                "jobs": len(self._jobs),
+                "pending": self._pending,
+                "completed": self.completed,
+                "failed": self.failed,
+                "retries": self.retries,
+            }
+
+
+upload_jobs = UploadJobQueue(UPLOAD_JOB_WORKERS, UPLOAD_JOB_MAX_PENDING)
+
+class ImageMetadataQueue:
+    """Cola acotada que completa los registros con los metadatos de la imagen.
+
+    Tras registrar una subida se lee la cabecera del archivo con una lectura
+    parcial (METADATA_HEADER_BYTES) para las dimensiones y el tipo; si el
+    archivo no pasa de METADATA_MAX_DECODE_BYTES se lee el resto y el pool de
+    procesos calcula el color dominante y el blurhash. Con la cola llena el
+    registro se queda sin metadatos: la galería funciona igual, sin placeholder.
+    """
+
+    def __init__(self, workers, max_pending):
+        self._workers = workers
+        self._max_pending = max_pending
+        # Hilos daemon propios: los de un ThreadPoolExecutor se esperan al salir
+        # del intérprete, y un trabajo reintentando la descarga lo dejaría colgado
+        self._queue = queue.Queue()
+        self._threads = []
+        self._pending = 0
+        self._lock = threading.Lock()
+        # En Vercel no hay proceso que siga vivo después de la respuesta
+        self.enabled = PILLOW_AVAILABLE and not IS_VERCEL
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def submit(self, doc_id, image_data):
+        """Encolar un registro recién guardado; devuelve False si no se encola"""
+        if not self.enabled:
+            return False
+        with self._lock:
+            if self._pending >= self._max_pending:
+                self.dropped += 1
+                return False
+            if not self._threads:
+                for i in range(self._workers):
+                    thread = threading.Thread(target=self._worker, name=f'image-metadata-{i}',
+                                              daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+            self._pending += 1
+        self._queue.put((doc_id, dict(image_data)))
+        return True
+
+    def _worker(self):
+        while True:
+            self._run(*self._queue.get())
+
+    def _run(self, doc_id, image_data):
+        import imaging
+        try:
+            # Cabecera y, si el archivo es lo bastante pequeño, el resto (para el placeholder)
+            data, size = read_stored_file(doc_id, METADATA_MAX_DECODE_BYTES)
+            placeholder = len(data) == size
+            future = get_transcode_pool().submit(imaging.image_metadata, data, placeholder)
+            with Span('image_metadata'):
+                fields = future.result(timeout=TRANSCODE_TIMEOUT)
+            fields = {key: value for key, value in fields.items() if value is not None}
+            get_firestore_db()
+            with Span('firestore_write'):
+                firestore_collection.document(doc_id).update(fields)
+            metrics.inc('app_firestore_documents_written_total', collection='uploads')
+            image_data.update(fields)
+            listing_cache.record_updated(doc_id, image_data)
+            search_index.add(doc_id, image_data)
+            with self._lock:
+                self.completed += 1
+        except Exception as e:
+            print(f"Error obteniendo metadatos de {doc_id}: {e}")
+            with self._lock:
+                self.failed += 1
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": self._pending,
+                "completed": self.completed,
+                "failed": self.failed,
+                "dropped": self.dropped,
+            }
+
+
+image_metadata = ImageMetadataQueue(METADATA_WORKERS, METADATA_MAX_PENDING)
+
+def spool_upload(file, ticket=None):
+    """Volcar el archivo de la petición a un temporal (en memoria si es pequeño
+    y el ticket de admisión tiene presupuesto para ello).
+
+    Devuelve (spool, tamaño); el llamador es responsable de cerrarlo.
+    """
+    if ticket is None or ticket.hold_in_memory(min(ticket.size, STREAM_SMALL_UPLOAD_MAX)):
+        spool = tempfile.SpooledTemporaryFile(max_size=STREAM_SMALL_UPLOAD_MAX, dir=UPLOAD_FOLDER)
+    else:
+        spool = tempfile.TemporaryFile(dir=UPLOAD_FOLDER)
+    size = 0
+    try:
+        with Span('spool_write'):
+            while True:
+                chunk = file.read(STREAM_READ_SIZE)
+                if not chunk:
+                    break
+                spool.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    return spool, size
+
+_transcode_pool = None
+_transcode_pool_lock = threading.Lock()
+
+def get_transcode_pool():
+    """Pool de procesos para el trabajo de CPU con imágenes (se crea al primer uso)"""
+    global _transcode_pool
+    if _transcode_pool is None:
+        with _transcode_pool_lock:
+            if _transcode_pool is None:
+                _transcode_pool = ProcessPoolExecutor(max_workers=TRANSCODE_WORKERS)
+    return _transcode_pool
+
+def should_transcode(content_length):
+    """Transcodificar solo si está activado y el cuerpo cabe en memoria"""
+    return (SERVER_WEBP_ENABLED and PILLOW_AVAILABLE and content_length is not None
+            and content_length <= SERVER_WEBP_MAX_INPUT_BYTES)
+
+def transcode_upload(data, filename):
+    """Convertir a WebP en el pool de procesos.
+
+    Devuelve (datos, nombre); si la conversión no conviene o falla, los originales.
+    """
+    import imaging
+    future = get_transcode_pool().submit(
+        imaging.transcode_to_webp, data, SERVER_WEBP_QUALITY, SERVER_WEBP_MAX_DIMENSION
+    )
+    try:
+        with Span('transcode'):
+            result = future.result(timeout=TRANSCODE_TIMEOUT)
+    except Exception as e:
+        print(f"Error convirtiendo {filename} a WebP, se sube el original: {e}")
+        return data, filename
+    if result is None:
+        return data, filename
+    encoded, width, height = result
+    print(f"Convertido {filename} a WebP: {len(data)} -> {len(encoded)} bytes ({width}x{height})")
+    return encoded, f"{Path(filename).stem}.webp"
+
+def build_image_data(record, timestamp=None):
+    """Construir el documento de Firestore para un registro de subida"""
     image_data = {
         "filename": record['filename'],
         "url": record['url'],
-        "timestamp": timestamp,
+        "timestamp": timestamp or datetime.now().isoformat(),
         "b2_filename": record['b2_filename']
     }
+    # Campos opcionales conocidos en el momento de la subida
+    for field in OPTIONAL_RECORD_FIELDS:
+        if record.get(field) is not None:
+            image_data[field] = record[field]
+    return image_data
+
+def remember_saved_record(doc_id, image_data):
+    """Write-through: actualizar el listado en caché y el buscador sin volver a leer Firestore"""
+    listing_cache.record_saved(doc_id, image_data)
+    search_index.add(doc_id, image_data)
+    # Un reintento puede traer el registro ya completado por el primer intento
+    if image_data.get('mime') is None:
+        image_metadata.submit(doc_id, image_data)
+
+def retry_fields(data):
+    """Lo que un reintento fusiona en un registro existente (ver RECORD_RETRY_FIELDS)"""
+    return {field: data[field] for field in RECORD_RETRY_FIELDS if data.get(field) is not None}
+
+def stats_totals(records, totals=None):
+    """Sumar registros de subida a unos totales (imágenes, bytes, por extensión y por día)"""
+    if totals is None:
+        totals = {"images": 0, "bytes": 0, "by_extension": Counter(), "by_day": Counter()}
+    for data in records:
+        name = data.get('b2_filename') or data.get('filename') or ''
+        extension = name.rsplit('.', 1)[1].lower() if '.' in name else 'other'
+        totals["images"] += 1
+        totals["bytes"] += data.get('bytes') or 0
+        totals["by_extension"][extension] += 1
+        totals["by_day"][(data.get('timestamp') or '')[:10] or 'unknown'] += 1
+    return totals
+
+def stats_increments(totals, sign=1):
+    """Campos para set(..., merge=True) que suman (o restan, sign=-1) unos totales a un shard"""
+    from google.cloud.firestore import Increment
+    fields = {key: Increment(sign * totals[key]) for key in ('images', 'bytes') if totals.get(key)}
+    for key in ('by_extension', 'by_day'):
+        counts = {name: Increment(sign * count) for name, count in totals.get(key, {}).items() if count}
+        if counts:
+            fields[key] = counts
+    return fields
+
+def reset_upload_stats(totals):
+    """Sustituir las estadísticas por unos totales ya calculados (reconcile.py --rebuild-stats).
+
+    Los totales van al shard 0 y el resto de shards se borran, en un solo lote.
+    """
+    db = get_firestore_db()
+    batch = db.batch()
+    batch.set(stats_collection.document('shard-0'), {
+        "images": totals["images"],
+        "bytes": totals["bytes"],
+        "by_extension": dict(totals["by_extension"]),
+        "by_day": dict(totals["by_day"]),
+    })
+    for shard in stats_collection.stream():
+        if shard.id != 'shard-0':
+            batch.delete(shard.reference)
+    with Span('firestore_write'):
+        batch.commit()
+    gallery_stats.invalidate()
+
+def stats_shard(collection=None):
+    """Shard al azar: repartir los incrementos evita el límite de escrituras por documento"""
+    if collection is None:
+        collection = stats_collection
+    return collection.document(f"shard-{random.randrange(STATS_SHARDS)}")
+
+def upload_record_batch(db, uploads, hashes, stats, image_data, exists=False):
+    """Lote con todas las escrituras de un registro de subida.
+
+    Crea el registro (con el b2_filename como ID), guarda su SHA1 en el índice
+    de contenido y suma el registro a un shard de estadísticas. Con exists=True
+    (el create falló con AlreadyExists: un reintento) fusiona solo los campos
+    de RECORD_RETRY_FIELDS, sin volver a contarlo. Recibe el cliente y las colecciones para servir igual al
+    cliente síncrono de app.py que al asíncrono de asgi.py: el llamador solo
+    hace commit (o await commit).
+    """
+    batch = db.batch()
+    doc_ref = uploads.document(image_data['b2_filename'])
+    if exists:
+        batch.set(doc_ref, retry_fields(image_data), merge=True)
+    else:
+        batch.create(doc_ref, image_data)
+        batch.set(stats_shard(stats), stats_increments(stats_totals([image_data])), merge=True)
+    if image_data.get('sha1'):
+        entry = hash_index_entry(image_data)
+        if exists:
+            batch.set(hashes.document(image_data['sha1']), retry_fields(entry), merge=True)
+        else:
+            batch.set(hashes.document(image_data['sha1']), entry)
+    return batch
+
+def upload_record_saved(image_data):
+    """Contar las escrituras de upload_record_batch y actualizar las cachés del proceso.
+
+    Tras un reintento image_data debe ser el registro releído de Firestore.
+    """
+    metrics.inc('app_firestore_documents_written_total', collection='uploads')
+    remember_saved_record(image_data['b2_filename'], image_data)
+    if image_data.get('sha1'):
+        metrics.inc('app_firestore_documents_written_total', collection='hashes')
+        hash_index.remember(image_data['sha1'], hash_index_entry(image_data))
+
+def save_upload_record(record):
+    """Guardar registro de subida en Firestore (único almacenamiento).
+
+    El registro se crea en el mismo lote que su entrada del índice de contenido
+    y el incremento de las estadísticas. Si ya existía (un reintento), solo se
+    fusionan los campos de RECORD_RETRY_FIELDS, sin volver a contarlo, y las
+    cachés reciben el registro tal como quedó guardado.
+    """
+    from google.api_core.exceptions import AlreadyExists
+    get_firestore_db()
+    
+    image_data = build_image_data(record)
+    collections = (firestore_collection, hash_index_collection, stats_collection)
     
     try:
-        # Usar el b2_filename como ID del documento
-        doc_ref = firestore_collection.document(record['b2_filename'])
-        doc_ref.set(image_data)
+        with Span('firestore_write'):
+            try:
+                upload_record_batch(firestore_db, *collections, image_data).commit()
+            except AlreadyExists:
+                upload_record_batch(firestore_db, *collections, image_data, exists=True).commit()
+                image_data = firestore_collection.document(record['b2_filename']).get().to_dict() or image_data
         print(f"Registro guardado en Firestore: {record['b2_filename']}")
-        return record
     except Exception as e:
         print(f"Error guardando en Firestore: {e}")
         raise RuntimeError(f"No se pudo guardar el registro en Firestore: {e}")
+    
+    upload_record_saved(image_data)
+    return record
+
+def save_upload_records(records, remember=True):
+    """Guardar varios registros con escrituras por lotes de Firestore.
+
+    Los lotes (WriteBatch) tienen como máximo FIRESTORE_BATCH_LIMIT escrituras;
+    si un lote falla, se marcan como fallidos solo sus registros. Cada lote
+    incrementa las estadísticas con los registros que crea; en los que ya
+    existían solo se fusionan los campos de RECORD_RETRY_FIELDS, sin contarlos.
+    Con remember=False no se tocan las cachés
+    del proceso (listado, buscador, índice de contenido): para importaciones
+    masivas que no sirven la galería.
+    Devuelve un resultado por registro, en el mismo orden.
+    """
+    from google.api_core.exceptions import AlreadyExists
+    get_firestore_db()
+    
+    # Repartir los registros en lotes; cada uno ocupa 1 escritura (2 si indexa su
+    # SHA1), más la del shard de estadísticas de cada lote
+    chunks = [[]]
+    writes = 1
+    for record in records:
+        cost = 2 if record.get('sha1') else 1
+        if writes + cost > FIRESTORE_BATCH_LIMIT:
+            chunks.append([])
+            writes = 1
+        chunks[-1].append(record)
+        writes += cost
+    
+    def build_batch(chunk_data, existing):
+        batch = firestore_db.batch()
+        for image_data in chunk_data:
+            doc_ref = firestore_collection.document(image_data['b2_filename'])
+            exists = image_data['b2_filename'] in existing
+            if exists:
+                batch.set(doc_ref, retry_fields(image_data), merge=True)
+            else:
+                batch.create(doc_ref, image_data)
+            if image_data.get('sha1'):
+                entry = hash_index_entry(image_data)
+                batch.set(hash_index_collection.document(image_data['sha1']),
+                          retry_fields(entry) if exists else entry, merge=exists)
+        new = [d for d in chunk_data if d['b2_filename'] not in existing]
+        if new:
+            batch.set(stats_shard(), stats_increments(stats_totals(new)), merge=True)
+        return batch
+    
+    results = []
+    for chunk in chunks:
+        if not chunk:
+            continue
+        chunk_data = [build_image_data(record, record.get('timestamp')) for record in chunk]
+        existing = {}
+        try:
+            with Span('firestore_write'):
+                try:
+                    build_batch(chunk_data, existing).commit()
+                except AlreadyExists:
+                    # Algún registro ya existía: repetir el lote sabiendo cuáles (y
+                    # quedarse con lo guardado para las cachés)
+                    refs = [firestore_collection.document(d['b2_filename']) for d in chunk_data]
+                    existing = {snap.id: snap.to_dict() for snap in firestore_db.get_all(refs) if snap.exists}
+                    build_batch(chunk_data, existing).commit()
+        except Exception as e:
+            print(f"Error guardando lote en Firestore: {e}")
+            results.extend({"b2_filename": r['b2_filename'], "success": False, "error": str(e)} for r in chunk)
+            continue
+        print(f"Lote de {len(chunk)} registros guardado en Firestore")
+        metrics.inc('app_firestore_documents_written_total', len(chunk), collection='uploads')
+        metrics.inc('app_firestore_documents_written_total', sum(1 for d in chunk_data if d.get('sha1')),
+                    collection='hashes')
+        for record, image_data in zip(chunk, chunk_data):
+            if remember:
+                stored = existing.get(record['b2_filename'])
+                if stored is not None:
+                    image_data = {**stored, **retry_fields(image_data)}
+                remember_saved_record(record['b2_filename'], image_data)
+                if image_data.get('sha1'):
+                    hash_index.remember(image_data['sha1'], hash_index_entry(image_data))
+            results.append({"b2_filename": record['b2_filename'], "success": True})
+    return results
+
+def delete_upload_records(records):
+    """Borrar registros (dicts con b2_filename y, si lo hay, sha1) por lotes.
+
+    También borra la entrada del índice de contenido de cada SHA1: si apuntaba
+    a otra copia viva, lo peor que pasa es una subida duplicada más adelante.
+    Los registros se leen antes para restarlos de las estadísticas en el mismo
+    lote; el borrado exige que sigan existiendo, así que si otro proceso los
+    borra a la vez el lote se repite y nada se resta dos veces.
+    Devuelve cuántos registros se borraron.
+    """
+    from google.api_core.exceptions import FailedPrecondition, NotFound
+    db = get_firestore_db()
+    deleted = 0
+    chunk_size = (FIRESTORE_BATCH_LIMIT - 1) // 2
+    for start in range(0, len(records), chunk_size):
+        chunk = records[start:start + chunk_size]
+        refs = [firestore_collection.document(record['b2_filename']) for record in chunk]
+        for attempt in (1, 2):
+            with Span('firestore_read'):
+                snapshots = db.get_all(refs, field_paths=['filename', 'bytes', 'timestamp'])
+                found = [snap for snap in snapshots if snap.exists]
+            batch = db.batch()
+            for snap in found:
+                batch.delete(snap.reference, option=db.write_option(exists=True))
+            for record in chunk:
+                if record.get('sha1'):
+                    batch.delete(hash_index_collection.document(record['sha1'].lower()))
+            if found:
+                removed = [{'b2_filename': snap.id, **(snap.to_dict() or {})} for snap in found]
+                batch.set(stats_shard(), stats_increments(stats_totals(removed), sign=-1), merge=True)
+            try:
+                with Span('firestore_write'):
+                    batch.commit()
+                break
+            except (NotFound, FailedPrecondition) as e:
+                if attempt == 2:
+                    raise RuntimeError(f"No se pudieron borrar los registros en Firestore: {e}")
+            except Exception as e:
+                print(f"Error borrando lote en Firestore: {e}")
+                raise RuntimeError(f"No se pudieron borrar los registros en Firestore: {e}")
+        metrics.inc('app_firestore_documents_written_total', len(found), collection='uploads')
+        for record in chunk:
+            search_index.remove(record['b2_filename'])
+            if record.get('sha1'):
+                hash_index.forget(record['sha1'])
+        deleted += len(found)
+    if deleted:
+        listing_cache.clear()
+    return deleted
+
+def is_sha1(value):
+    """Validar un SHA1 en hexadecimal"""
+    return isinstance(value, str) and len(value) == 40 and all(c in '0123456789abcdef' for c in value.lower())
+
+def uploaded_sha1(claimed, info):
+    """SHA1 de una subida directa para el índice de contenido: el que calculó el
+    almacenamiento (file_info), nunca el del cliente. None si no lo hay.
+
+    Lanza ValueError si el cliente declaró uno distinto.
+    """
+    if claimed and info.get('sha1') and claimed.lower() != info['sha1']:
+        raise ValueError("sha1 does not match the uploaded file")
+    return info.get('sha1')
+
+def hash_index_entry(image_data):
+    """Datos que guarda el índice de contenido para una subida"""
+    return {
+        "b2_filename": image_data['b2_filename'],
+        "url": image_data['url'],
+        "filename": image_data['filename'],
+        "timestamp": image_data['timestamp']
+    }
+
+
+class HashIndex:
+    """Índice SHA1 -> subida existente, en Firestore con una LRU en proceso delante.
+
+    Solo se guardan aciertos en la LRU: un fallo obsoleto solo provocaría
+    una subida duplicada, nunca una URL incorrecta.
+    """
+
+    def __init__(self, max_entries=HASH_INDEX_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.duplicates = 0
+
+    def remember(self, sha1, entry):
+        with self._lock:
+            self._entries[sha1] = entry
+            self._entries.move_to_end(sha1)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def forget(self, sha1):
+        with self._lock:
+            self._entries.pop(sha1.lower(), None)
+
+    def peek(self, sha1):
+        """Consultar solo la LRU; devuelve None si hay que leer Firestore"""
+        sha1 = sha1.lower()
+        with self._lock:
+            entry = self._entries.get(sha1)
+            if entry is not None:
+                self._entries.move_to_end(sha1)
+                self.hits += 1
+                self.duplicates += 1
+            return entry
+
+    def lookup(self, sha1):
+        """Devolver la subida existente con ese contenido, o None"""
+        return self.lookup_many([sha1]).get(sha1.lower())
+
+    def lookup_many(self, sha1s):
+        """Buscar varios SHA1; los que no están en la LRU se leen de Firestore en una sola llamada"""
+        found = {}
+        pending = []
+        with self._lock:
+            for sha1 in {sha1.lower() for sha1 in sha1s}:
+                entry = self._entries.get(sha1)
+                if entry is not None:
+                    self._entries.move_to_end(sha1)
+                    self.hits += 1
+                    found[sha1] = entry
+                else:
+                    self.misses += 1
+                    pending.append(sha1)
+        if pending:
+            try:
+                db = get_firestore_db()
+                refs = [hash_index_collection.document(sha1) for sha1 in pending]
+                with Span('firestore_read'):
+                    snapshots = list(db.get_all(refs))
+                metrics.inc('app_firestore_documents_read_total', len(refs), collection='hashes')
+                for snapshot in snapshots:
+                    if snapshot.exists:
+                        entry = snapshot.to_dict()
+                        self.remember(snapshot.id, entry)
+                        found[snapshot.id] = entry
+            except Exception as e:
+                print(f"Error consultando el índice de contenido: {e}")
+        self.duplicates += len(found)
+        return found
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "duplicates": self.duplicates,
+            }
+
+
+hash_index = HashIndex()
+
+def encode_cursor(timestamp, doc_id):
+    """Codificar la posición (timestamp, id de documento) como cursor opaco"""
+    raw = json.dumps([timestamp, doc_id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """Decodificar un cursor opaco; lanza ValueError si no es válido"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, doc_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except Exception:
+        raise ValueError("Cursor inválido")
+    if not isinstance(timestamp, str) or not isinstance(doc_id, str):
+        raise ValueError("Cursor inválido")
+    return timestamp, doc_id
+
+def doc_to_image(doc):
+    """Convertir un documento de Firestore al formato que devuelve /uploads"""
+    return image_view(doc.to_dict())
+
+def image_view(data):
+    """Campos públicos de un registro de subida"""
+    # Asegurar compatibilidad con formato anterior (sin b2_filename)
+    view = {
+        "filename": data.get("filename", ""),
+        "url": data.get("url", ""),
+        "timestamp": data.get("timestamp", "")
+    }
+    # Metadatos para maquetar la galería antes de descargar la imagen
+    for field in IMAGE_METADATA_FIELDS:
+        if data.get(field) is not None:
+            view[field] = data[field]
+    # Base de las miniaturas (la galería añade ?w= para el srcset)
+    b2_filename = data.get("b2_filename")
+    if PILLOW_AVAILABLE and b2_filename and allowed_file(b2_filename):
+        view["thumb"] = f"/thumb/{quote(b2_filename)}"
+    return view
+
+def get_uploaded_images(limit=UPLOADS_PAGE_SIZE, cursor=None):
+    """Obtener una página de imágenes subidas desde Firestore, más recientes primero.
+
+    Devuelve (imágenes, next_cursor); next_cursor es None en la última página.
+    """
+    rows, next_cursor = query_uploads_page(limit, cursor)
+    return [image for _, image in rows], next_cursor
+
+def uploads_page_query(collection, limit, cursor=None):
+    """Consulta de una página del listado (vale para el cliente síncrono y el asíncrono)"""
+    # Ordenar por timestamp y luego por id ('__name__') para que el cursor sea estable
+    query = (collection
+             .order_by('timestamp', direction='DESCENDING')
+             .order_by('__name__', direction='DESCENDING'))
+    if cursor:
+        query = query.start_after(list(decode_cursor(cursor)))
+    # Pedir un documento extra para saber si hay más páginas
+    return query.limit(limit + 1)
+
+def query_uploads_page(limit, cursor=None):
+    """Leer una página de Firestore como lista de (id de documento, imagen)"""
+    get_firestore_db()
+    query = uploads_page_query(firestore_collection, limit, cursor)
+    
+    try:
+        with Span('firestore_read'):
+            docs = list(query.stream())
+    except Exception as e:
+        print(f"Error obteniendo imágenes de Firestore: {e}")
+        raise RuntimeError(f"No se pudieron obtener las imágenes desde Firestore: {e}")
+    return uploads_page_rows(docs, limit)
+
+def uploads_page_rows(docs, limit):
+    """Filas (id de documento, imagen) y cursor siguiente de una página leída con uploads_page_query"""
+    metrics.inc('app_firestore_documents_read_total', max(len(docs), 1), collection='uploads')
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        last = docs[-1]
+        next_cursor = encode_cursor(last.to_dict().get('timestamp', ''), last.id)
+    rows = [(doc.id, doc_to_image(doc)) for doc in docs]
+    print(f"Obtenidas {len(rows)} imágenes desde Firestore")
+    return rows, next_cursor
+
+def parse_changes_token(since):
+    """Aceptar un token de /api/uploads/changes o un timestamp ISO del listado.
+
+    Devuelve (timestamp, id de documento); lanza ValueError si no es válido.
+    """
+    try:
+        return decode_cursor(since)
+    except ValueError:
+        pass
+    try:
+        datetime.fromisoformat(since)
+    except ValueError:
+        raise ValueError("since debe ser un token o un timestamp ISO")
+    return since, ''
+
+def query_upload_changes(since, limit):
+    """Registros escritos después de la posición since=(timestamp, id).
+
+    Devuelve (filas ascendentes (id, datos del documento), nuevo token, reset). Se releen los últimos
+    UPLOADS_CHANGES_OVERLAP segundos (el cliente descarta los que ya tiene);
+    reset=True indica que hay más de limit cambios y conviene recargar.
+    """
+    get_firestore_db()
+    since_timestamp, since_id = since
+    lower = (datetime.fromisoformat(since_timestamp) - timedelta(seconds=UPLOADS_CHANGES_OVERLAP)).isoformat()
+    query = (firestore_collection
+             .where('timestamp', '>', lower)
+             .order_by('timestamp')
+             .order_by('__name__'))
+    
+    try:
+        with Span('firestore_read'):
+            docs = list(query.limit(limit + 1).stream())
+    except Exception as e:
+        print(f"Error obteniendo cambios de Firestore: {e}")
+        raise RuntimeError(f"No se pudieron obtener los cambios desde Firestore: {e}")
+    
+    metrics.inc('app_firestore_documents_read_total', max(len(docs), 1), collection='uploads')
+    if len(docs) > limit:
+        return [], encode_cursor(since_timestamp, since_id), True
+    rows = [(doc.id, doc.to_dict()) for doc in docs]
+    # El token nunca retrocede aunque solo se hayan releído registros del solape
+    position = max([(since_timestamp, since_id)] + [(data['timestamp'], doc_id) for doc_id, data in rows])
+    return rows, encode_cursor(*position), False
+
+
+class ListingCache:
+    """Caché en proceso de las páginas de /uploads.
+
+    Cada escritura incrementa la versión y actualiza la primera página en
+    memoria (las páginas siguientes se descartan porque sus cursores se
+    desplazan). El TTL acota cuánto tarda en verse lo que escriben otros
+    workers y max_entries acota la memoria.
+    """
+
+    def __init__(self, ttl=LISTING_CACHE_TTL, max_entries=LISTING_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _etag(rows, next_cursor):
+        """ETag fuerte derivado del contenido de la página"""
+        payload = json.dumps([rows, next_cursor], separators=(',', ':'), sort_keys=True)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def _store(self, key, rows, next_cursor, expires_at=None):
+        entry = {
+            'rows': rows,
+            'images': [image for _, image in rows],
+            'next_cursor': next_cursor,
+            'etag': self._etag(rows, next_cursor),
+            'version': self.version,
+            'expires_at': expires_at or time.monotonic() + self.ttl,
+        }
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    def get(self, limit, cursor=None):
+        """Devolver la página en caché o None si no existe o caducó"""
+        key = (limit, cursor)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['expires_at'] <= time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, limit, cursor, rows, next_cursor):
+        with self._lock:
+            return self._store((limit, cursor), rows, next_cursor)
+
+    def record_saved(self, doc_id, image_data):
+        """Write-through de un registro nuevo (el más reciente por definición)"""
+        image = image_view(image_data)
+        with self._lock:
+            self.version += 1
+            for key in list(self._entries):
+                limit, cursor = key
+                entry = self._entries[key]
+                if cursor is not None or entry['expires_at'] <= time.monotonic():
+                    del self._entries[key]
+                    continue
+                rows = [(doc_id, image)] + [row for row in entry['rows'] if row[0] != doc_id]
+                next_cursor = entry['next_cursor']
+                if len(rows) > limit:
+                    rows = rows[:limit]
+                    last_id, last_image = rows[-1]
+                    next_cursor = encode_cursor(last_image['timestamp'], last_id)
+                self._store(key, rows, next_cursor, expires_at=entry['expires_at'])
+
+    def record_updated(self, doc_id, image_data):
+        """Actualizar en las páginas en caché un registro que ya estaba listado"""
+        image = image_view(image_data)
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if any(row[0] == doc_id for row in entry['rows']):
+                    rows = [(row_id, image if row_id == doc_id else row_image)
+                            for row_id, row_image in entry['rows']]
+                    self._store(key, rows, entry['next_cursor'], expires_at=entry['expires_at'])
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "version": self.version,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+listing_cache = ListingCache()
+
+
+class GalleryStats:
+    """Estadísticas de la galería: suma de los shards de STATS_COLLECTION.
+
+    Las escrituras las mantienen con incrementos (ver save_upload_record y
+    delete_upload_records), así que leerlas cuesta STATS_SHARDS lecturas y no
+    un recorrido de la colección. El resultado se cachea ttl segundos y las
+    peticiones que llegan mientras se refresca esperan a esa misma lectura.
+    """
+
+    def __init__(self, ttl=STATS_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._value = None
+        self._expires_at = 0
+        self.hits = 0
+        self.refreshes = 0
+
+    def _cached(self):
+        with self._lock:
+            if self._value is not None and time.monotonic() < self._expires_at:
+                self.hits += 1
+                return self._value
+        return None
+
+    def get(self):
+        value = self._cached()
+        if value is not None:
+            return value
+        with self._refresh_lock:
+            value = self._cached()
+            if value is not None:
+                return value
+            get_firestore_db()
+            with Span('firestore_read'):
+                shards = list(stats_collection.stream())
+            totals = {"images": 0, "bytes": 0, "by_extension": Counter(), "by_day": Counter()}
+            for shard in shards:
+                data = shard.to_dict() or {}
+                totals["images"] += data.get("images", 0)
+                totals["bytes"] += data.get("bytes", 0)
+                for key in ("by_extension", "by_day"):
+                    totals[key].update(data.get(key) or {})
+            value = {
+                "images": totals["images"],
+                "bytes": totals["bytes"],
+                "by_extension": {k: v for k, v in sorted(totals["by_extension"].items()) if v},
+                "by_day": {k: v for k, v in sorted(totals["by_day"].items()) if v},
+                "shards": len(shards),
+                "generated_at": datetime.now().isoformat(),
+            }
+            with self._lock:
+                self._value = value
+                self._expires_at = time.monotonic() + self.ttl
+                self.refreshes += 1
+            return value
+
+    def invalidate(self):
+        with self._lock:
+            self._value = None
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "refreshes": self.refreshes}
+
+
+gallery_stats = GalleryStats()
+
+_SEARCH_WORD_SPLIT = re.compile(r'[^0-9a-z]+')
+
+class SearchIndex:
+    """Índice en proceso para buscar por filename y b2_filename.
+
+    Trigramas para subcadenas de 3 o más caracteres y prefijos de palabra para
+    términos de 1 o 2. Se construye una vez desde Firestore (en la primera
+    búsqueda) y se actualiza con cada registro guardado; cada
+    SEARCH_INDEX_MAX_AGE segundos lee en segundo plano solo lo escrito desde la
+    última lectura (query_upload_changes) para recoger lo que hayan subido
+    otros workers. Lo que borren otros workers no aparece en esa consulta: sale
+    del índice cuando se reconstruye entero (al arrancar el proceso o si hay más
+    de SEARCH_INDEX_REFRESH_LIMIT cambios).
+    """
+
+    SHORT_PREFIX = 2
+
+    def __init__(self, max_age=SEARCH_INDEX_MAX_AGE):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._docs = {}
+        self._grams = {}
+        self._prefixes = {}
+        self._built_at = None
+        # Posición (timestamp, id) del registro más reciente leído de Firestore
+        self._position = None
+        self._rebuilding = False
+        # Registros guardados mientras se lee Firestore (no están en la lectura)
+        self._pending = None
+        self.builds = 0
+        self.refreshes = 0
+        self.queries = 0
+
+    @staticmethod
+    def _text(image_data, doc_id):
+        return f"{image_data.get('filename', '')} {image_data.get('b2_filename') or doc_id}".lower()
+
+    @staticmethod
+    def _trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    @classmethod
+    def _word_prefixes(cls, text):
+        words = [word for word in _SEARCH_WORD_SPLIT.split(text) if word]
+        return {word[:n] for n in range(1, cls.SHORT_PREFIX + 1) for word in words}
+
+    def _keys(self, text):
+        return self._trigrams(text), self._word_prefixes(text)
+
+    @classmethod
+    def _entry(cls, doc_id, image_data):
+        return (cls._text(image_data, doc_id), image_data.get('filename', '').lower(),
+                image_data.get('timestamp', ''), image_view(image_data))
+
+    def _add(self, doc_id, image_data):
+        """Indexar un documento (llamar con el lock tomado)"""
+        entry = self._entry(doc_id, image_data)
+        self._insert(doc_id, entry)
+        if self._pending is not None:
+            self._pending[doc_id] = entry
+
+    def _apply_pending(self, target):
+        """Aplicar a target lo guardado (o borrado) mientras se leía Firestore
+        y dejar de anotarlo (llamar con el lock tomado)"""
+        for doc_id, entry in self._pending.items():
+            if entry is None:
+                target._discard(doc_id)
+            else:
+                target._insert(doc_id, entry)
+        self._pending = None
+
+    def _insert(self, doc_id, entry):
+        self._discard(doc_id)
+        grams, prefixes = self._keys(entry[0])
+        self._docs[doc_id] = entry
+        for index, keys in ((self._grams, grams), (self._prefixes, prefixes)):
+            for key in keys:
+                ids = index.get(key)
+                if ids is None:
+                    index[key] = {doc_id}
+                else:
+                    ids.add(doc_id)
+
+    def _discard(self, doc_id):
+        entry = self._docs.pop(doc_id, None)
+        if entry is None:
+            return
+        grams, prefixes = self._keys(entry[0])
+        for index, keys in ((self._grams, grams), (self._prefixes, prefixes)):
+            for key in keys:
+                ids = index.get(key)
+                if ids is not None:
+                    ids.discard(doc_id)
+                    if not ids:
+                        del index[key]
+
+    def add(self, doc_id, image_data):
+        """Indexar un registro recién guardado"""
+        with self._lock:
+            self._add(doc_id, image_data)
+
+    def remove(self, doc_id):
+        """Quitar del índice un registro borrado"""
+        with self._lock:
+            self._discard(doc_id)
+            if self._pending is not None:
+                self._pending[doc_id] = None
+
+    def _load(self):
+        """Leer todos los registros de Firestore y reemplazar el índice"""
+        get_firestore_db()
+        started = time.perf_counter()
+        with self._lock:
+            self._pending = {}
+        try:
+            with Span('firestore_read'):
+                docs = [(doc.id, doc.to_dict()) for doc in firestore_collection.stream()]
+        except Exception as e:
+            with self._lock:
+                self._pending = None
+            print(f"Error construyendo el índice de búsqueda: {e}")
+            raise RuntimeError(f"No se pudo construir el índice de búsqueda: {e}")
+        metrics.inc('app_firestore_documents_read_total', max(len(docs), 1), collection='uploads')
+        fresh = SearchIndex(self.max_age)
+        for doc_id, data in docs:
+            fresh._add(doc_id, data)
+        positions = [(data['timestamp'], doc_id) for doc_id, data in docs if data.get('timestamp')]
+        with self._lock:
+            self._apply_pending(fresh)
+            self._docs, self._grams, self._prefixes = fresh._docs, fresh._grams, fresh._prefixes
+            self._position = max(positions) if positions else None
+            self._built_at = time.monotonic()
+            self.builds += 1
+        print(f"Índice de búsqueda construido: {len(docs)} registros en "
+              f"{(time.perf_counter() - started) * 1000:.0f}ms")
+
+    def _refresh(self):
+        """Indexar lo escrito en Firestore desde la última lectura"""
+        if self._position is None:
+            # Colección vacía (o solo registros sin timestamp): releerla no cuesta
+            self._load()
+            return
+        with self._lock:
+            self._pending = {}
+        try:
+            rows, token, reset = query_upload_changes(self._position, SEARCH_INDEX_REFRESH_LIMIT)
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        if reset:
+            with self._lock:
+                self._pending = None
+            self._load()
+            return
+        with self._lock:
+            for doc_id, data in rows:
+                self._insert(doc_id, self._entry(doc_id, data))
+            self._apply_pending(self)
+            self._position = decode_cursor(token)
+            self._built_at = time.monotonic()
+            self.refreshes += 1
+
+    def _rebuild_in_background(self):
+        try:
+            with self._build_lock:
+                if self._built_at is None:
+                    self._load()
+                else:
+                    self._refresh()
+        except Exception:
+            pass
+        finally:
+            self._rebuilding = False
+
+    def warm(self):
+        """Empezar a construir el índice en segundo plano si aún no existe"""
+        if self._built_at is None and not self._rebuilding:
+            self._rebuilding = True
+            threading.Thread(target=self._rebuild_in_background, daemon=True).start()
+
+    def ensure_built(self):
+        """Construir el índice la primera vez; si está viejo, refrescarlo en segundo plano"""
+        if self._built_at is None:
+            with self._build_lock:
+                if self._built_at is None:
+                    self._load()
+            return
+        if time.monotonic() - self._built_at > self.max_age and not self._rebuilding:
+            self._rebuilding = True
+            threading.Thread(target=self._rebuild_in_background, daemon=True).start()
+
+    def _candidates(self, term):
+        """Ids que pueden contener el término (None = sin coincidencias)"""
+        if len(term) < 3:
+            return self._prefixes.get(term)
+        sets = []
+        for gram in self._trigrams(term):
+            ids = self._grams.get(gram)
+            if not ids:
+                return None
+            sets.append(ids)
+        sets.sort(key=len)
+        return set.intersection(*sets)
 
-def get_uploaded_images():
-    """Obtener lista de imágenes subidas desde Firestore (único almacenamiento)"""
-    if not firestore_collection:
-        raise RuntimeError("Firestore no está inicializado. Verifica la configuración de Firebase.")
-    
-    try:
-        docs = firestore_collection.stream()
-        images = []
-        for doc in docs:
-            data = doc.to_dict()
-            # Asegurar compatibilidad con formato anterior
-            image_data = {
-                "filename": data.get("filename", ""),
-                "url": data.get("url", ""),
-                "timestamp": data.get("timestamp", ""),
-                "b2_filename": data.get("b2_filename", doc.id)
+    @staticmethod
+    def _score(terms, text, filename):
+        """Puntuación de relevancia: coincidencia exacta > prefijo > nombre > b2_filename"""
+        stem = filename.rsplit('.', 1)[0]
+        score = 0
+        for term in terms:
+            if term == filename or term == stem:
+                score += 8
+            elif filename.startswith(term):
+                score += 4
+            elif term in filename:
+                score += 2
+            elif term in text:
+                score += 1
+        return score
+
+    def search(self, query, limit=SEARCH_PAGE_SIZE, offset=0):
+        """Buscar; devuelve (imágenes de la página, total de coincidencias)"""
+        self.ensure_built()
+        terms = [term for term in query.lower().split() if term]
+        if not terms:
+            return [], 0
+        with self._lock:
+            self.queries += 1
+            candidates = None
+            for term in sorted(terms, key=len, reverse=True):
+                ids = self._candidates(term)
+                if not ids:
+                    return [], 0
+                candidates = set(ids) if candidates is None else candidates & ids
+                if not candidates:
+                    return [], 0
+            matches = []
+            for doc_id in candidates:
+                text, filename, timestamp, image = self._docs[doc_id]
+                # Los trigramas y prefijos solo preseleccionan: confirmar cada término
+                if len(terms) > 1 or len(terms[0]) >= 3:
+                    if not all(term in text for term in terms):
+                        continue
+                matches.append((self._score(terms, text, filename), timestamp, doc_id, image))
+        # Más relevantes primero y, a igual puntuación, más recientes
+        top = heapq.nlargest(offset + limit, matches, key=lambda m: (m[0], m[1], m[2]))
+        return [image for _, _, _, image in top[offset:offset + limit]], len(matches)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "documents": len(self._docs),
+                "trigrams": len(self._grams),
+                "prefixes": len(self._prefixes),
+                "builds": self.builds,
+                "refreshes": self.refreshes,
+                "queries": self.queries,
             }
-            # Remover b2_filename si existe para mantener compatibilidad
-            if "b2_filename" in image_data:
-                del image_data["b2_filename"]
-            images.append(image_data)
-        
-        # Ordenar por timestamp descendente (más recientes primero)
-        images.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-        print(f"Obtenidas {len(images)} imágenes desde Firestore")
-        return images
-    except Exception as e:
-        print(f"Error obteniendo imágenes de Firestore: {e}")
-        raise RuntimeError(f"No se pudieron obtener las imágenes desde Firestore: {e}")
+
+
+search_index = SearchIndex()
+
+_first_request_seen = False
+
+def startup_report():
+    """Tiempos de arranque en ms: imports, inicializaciones perezosas y primera petición"""
+    return {
+        "timings_ms": dict(STARTUP_TIMINGS),
+        "lazy": {
+            "b2sdk_loaded": b2_session._api is not None,
+            "firestore_loaded": firestore_db is not None,
+        },
+    }
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_timing(response):
+    """Histograma por endpoint y cabecera Server-Timing con los spans de la petición"""
+    started = g.get('request_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    if endpoint != '/metrics':
+        metrics.observe('app_http_request_duration_seconds', elapsed, method=request.method,
+                        endpoint=endpoint, status=str(response.status_code))
+    if response.status_code >= 500:
+        metrics.inc('app_errors_total', cause='http_5xx')
+    if SERVER_TIMING_ENABLED:
+        entries = [f"{name};dur={total * 1000:.1f}" + (f';desc="x{count}"' if count > 1 else '')
+                   for name, (total, count) in g.get('spans', {}).items()]
+        entries.append(f"app;dur={elapsed * 1000:.1f}")
+        response.headers['Server-Timing'] = ', '.join(entries)
+    return response
+
+@app.before_request
+def record_first_request():
+    """Medir el tiempo hasta la primera petición e imprimirlo una sola vez"""
+    global _first_request_seen
+    if _first_request_seen:
+        return
+    _first_request_seen = True
+    STARTUP_TIMINGS['first request'] = round((time.perf_counter() - _PROCESS_START) * 1000, 1)
+    print("Arranque: " + ", ".join(f"{name}={ms}ms" for name, ms in STARTUP_TIMINGS.items()))
 
 def login_required(f):
     """Decorator to protect routes requiring authentication"""
@@ -305,6 +2348,17 @@ def login_required(f):
     decorated_function.__name__ = f.__name__
     return decorated_function
 
+def direct_uploads_required(f):
+    """Decorator for routes that hand out B2 credentials to the browser"""
+    def decorated_function(*args, **kwargs):
+        if not storage.supports_direct_uploads:
+            return jsonify({
+                "error": f"Direct uploads are not available with the '{storage.name}' storage backend"
+            }), 400
+        return f(*args, **kwargs)
+    decorated_function.__name__ = f.__name__
+    return decorated_function
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     """Login page"""
@@ -332,7 +2386,12 @@ def logout():
 @login_required
 def index():
     """Página principal"""
-    return render_template('index.html', is_vercel=IS_VERCEL)
+    if not IS_VERCEL:
+        # Tener el índice listo antes de que se use el buscador
+        search_index.warm()
+    return render_template('index.html', is_vercel=IS_VERCEL,
+                           direct_uploads=storage.supports_direct_uploads,
+                           thumb_widths=THUMB_WIDTHS)
 
 @app.route('/upload', methods=['POST'])
 @login_required
@@ -350,46 +2409,210 @@ def upload_file():
                 "message": "Please use the direct upload to Backblaze B2 feature for larger files"
             }), 400
     
-    if 'file' not in request.files:
-        return jsonify({"error": "No file part"}), 400
+    # Admisión antes de leer el cuerpo: con el proceso saturado se responde al
+    # momento (sin Content-Length se cuenta el máximo permitido)
+    ticket, status = upload_admission.admit(request.content_length or app.config['MAX_CONTENT_LENGTH'])
+    if ticket is None:
+        if status == 429:
+            return upload_busy_response(429, "Too many concurrent uploads, try again later")
+        return upload_busy_response(503, "Server is busy with other uploads, try again later")
+    
+    job_owns_ticket = False
+    try:
+        # Leer el multipart en streaming (request.files volcaría el archivo a disco)
+        try:
+            file = MultipartFileReader.from_request(request, 'file')
+        except MalformedUpload:
+            return jsonify({"error": "Malformed upload body"}), 400
+        except ValueError:
+            return jsonify({"error": "No file part"}), 400
+        
+        if not file.filename:
+            return jsonify({"error": "No selected file"}), 400
+        
+        if not allowed_file(file.filename):
+            return jsonify({"error": "File type not allowed"}), 400
+        
+        filename = secure_filename(str(file.filename))
+        
+        # Modo asíncrono: volcar el cuerpo, encolar y responder 202 sin esperar a B2.
+        # En Vercel el proceso se congela tras la respuesta, así que allí se ignora.
+        if request.args.get('async') == '1' and not IS_VERCEL:
+            # Comprobar antes de leer el cuerpo; submit vuelve a comprobarlo con el lock
+            job_id = None
+            if not upload_jobs.is_full():
+                try:
+                    spool, size = spool_upload(file, ticket)
+                except MalformedUpload:
+                    # spool_upload ya cerró el temporal; el finally libera el ticket
+                    return jsonify({"error": "Malformed upload body"}), 400
+                job_id = upload_jobs.submit(spool, filename, size, ticket)
+                if job_id is None:
+                    spool.close()
+            if job_id is None:
+                return upload_busy_response(503, "Upload queue is full, try again later")
+            # El trabajo conserva la reserva de bytes hasta terminar
+            job_owns_ticket = True
+            return jsonify({
+                "success": True,
+                "job_id": job_id,
+                "status_url": url_for('get_upload_job', job_id=job_id)
+            }), 202
+        
+        try:
+            return jsonify(store_upload(file, filename, request.content_length, ticket))
+        except HTTPException:
+            raise
+        except MalformedUpload:
+            return jsonify({"error": "Malformed upload body"}), 400
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+    finally:
+        if job_owns_ticket:
+            ticket.release_slot()
+        else:
+            ticket.release()
+
+def store_upload(file, filename, content_length, ticket=None):
+    """Subir un archivo a B2 (con conversión a WebP y deduplicación) y guardar su registro.
+
+    Con ticket de admisión, la conversión y la lectura en memoria de los
+    archivos pequeños solo se hacen si hay presupuesto de memoria; si no, se
+    sube el original en streaming.
+    Devuelve el cuerpo JSON de la respuesta de /upload.
+    """
+    data = None
+    original_bytes = None
+    if should_transcode(content_length) and (ticket is None or ticket.hold_in_memory(content_length)):
+        # Conversión a WebP en el pool de procesos (fuera de los hilos de Flask)
+        data = file.read()
+        original_bytes = len(data)
+        data, filename = transcode_upload(data, filename)
+    elif (content_length is not None and content_length <= STREAM_SMALL_UPLOAD_MAX
+          and (ticket is None or ticket.hold_in_memory(content_length))):
+        data = file.read()
+    
+    if data is not None:
+        # Cuerpo en memoria: si el contenido ya existe, devolver la URL existente
+        existing = hash_index.lookup(hashlib.sha1(data).hexdigest())
+        if existing:
+            return {
+                "success": True,
+                "duplicate": True,
+                "message": "File already uploaded",
+                "url": existing['url'],
+                "filename": filename
+            }
+        result = upload_to_storage(io.BytesIO(data), filename, size_hint=len(data))
+        result['original_bytes'] = original_bytes
+    else:
+        # Subir en streaming directamente desde la petición
+        result = upload_to_storage(file, filename, size_hint=content_length)
+    # Guardar registro (y su SHA1 en el índice de contenido)
+    save_upload_record(result)
     
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({"error": "No selected file"}), 400
+    return {
+        "success": True,
+        "message": "File uploaded successfully",
+        "url": result['url'],
+        "filename": result['filename']
+    }
+
+@app.route('/api/upload/jobs/<job_id>', methods=['GET'])
+@login_required
+def get_upload_job(job_id):
+    """Estado de un trabajo de /upload?async=1: progreso, URL final o error"""
+    job = upload_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify({"success": True, "job": job})
+
+@app.route('/uploads', methods=['GET'])
+@login_required
+def list_uploads():
+    """Endpoint para listar imágenes subidas (paginado con ?limit=&cursor=)"""
+    try:
+        limit = int(request.args.get('limit', UPLOADS_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    limit = max(1, min(limit, UPLOADS_MAX_PAGE_SIZE))
+    cursor = request.args.get('cursor') or None
     
-    if not allowed_file(file.filename):
-        return jsonify({"error": "File type not allowed"}), 400
+    entry = listing_cache.get(limit, cursor)
+    if entry is None:
+        try:
+            rows, next_cursor = query_uploads_page(limit, cursor)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        entry = listing_cache.put(limit, cursor, rows, next_cursor)
     
-    filename = secure_filename(str(file.filename))
+    if request.if_none_match.contains(entry['etag']):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify({"images": entry['images'], "next_cursor": entry['next_cursor']})
+    response.set_etag(entry['etag'])
+    # El navegador debe revalidar siempre; el 304 evita reenviar el listado
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/api/uploads/changes', methods=['GET'])
+@login_required
+def list_upload_changes():
+    """Registros nuevos desde ?since=<token o timestamp> (sincronización incremental)"""
+    since = request.args.get('since', '').strip()
+    if not since:
+        return jsonify({"error": "since is required"}), 400
+    try:
+        limit = int(request.args.get('limit', UPLOADS_MAX_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    limit = max(1, min(limit, UPLOADS_MAX_PAGE_SIZE))
+    try:
+        rows, token, reset = query_upload_changes(parse_changes_token(since), limit)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
+    response = jsonify({"images": [image_view(data) for _, data in rows], "since": token, "reset": reset})
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/api/uploads/stats', methods=['GET'])
+def get_upload_stats():
+    """Totales de la galería (sesión o METRICS_TOKEN, como /metrics)"""
+    if not metrics_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
     try:
-        # Subir a Backblaze B2 (pass file object directly)
-        result = upload_to_b2(file, filename)
-        # Guardar registro
-        save_upload_record(result)
-        
-        return jsonify({
-            "success": True,
-            "message": "File uploaded successfully",
-            "url": result['url'],
-            "filename": result['filename']
-        })
+        stats = gallery_stats.get()
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return jsonify({"error": f"Failed to read stats: {str(e)}"}), 500
+    response = jsonify(stats)
+    response.headers['Cache-Control'] = f'private, max-age={int(STATS_CACHE_TTL)}'
+    return response
 
-@app.route('/uploads', methods=['GET'])
+@app.route('/api/uploads/search', methods=['GET'])
 @login_required
-def list_uploads():
-    """Endpoint para listar imágenes subidas"""
-    images = get_uploaded_images()
-    return jsonify({"images": images})
+def search_uploads():
+    """Buscar imágenes por nombre (?q=&limit=&offset=), ordenadas por relevancia"""
+    query = request.args.get('q', '').strip()
+    try:
+        limit = int(request.args.get('limit', SEARCH_PAGE_SIZE))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({"error": "limit and offset must be integers"}), 400
+    limit = max(1, min(limit, UPLOADS_MAX_PAGE_SIZE))
+    offset = max(0, offset)
+    
+    images, total = search_index.search(query, limit, offset)
+    next_offset = offset + limit if offset + limit < total else None
+    return jsonify({"images": images, "total": total, "next_offset": next_offset})
 
 def get_public_url(b2_filename):
-    """Get public URL for a B2 filename"""
-    return f"{B2_ENDPOINT}/file/{B2_BUCKET_NAME}/{b2_filename}"
+    """Get public URL for a stored file (B2 or local storage)"""
+    return storage.public_url(b2_filename)
 
 @app.route('/api/upload/auth', methods=['POST'])
 @login_required
+@direct_uploads_required
 def get_upload_auth():
     """Get upload credentials for direct client upload to B2"""
     data = request.get_json()
@@ -404,6 +2627,15 @@ def get_upload_auth():
     if not allowed_file(filename):
         return jsonify({"error": "File type not allowed"}), 400
     
+    # Optional content hash: skip the upload if the same content already exists
+    sha1 = data.get('sha1')
+    if sha1 is not None and not is_sha1(sha1):
+        return jsonify({"error": "sha1 must be a 40-character hex digest"}), 400
+    if sha1:
+        existing = hash_index.lookup(sha1)
+        if existing:
+            return jsonify({"success": True, **duplicate_payload(existing)})
+    
     # Generate unique B2 filename
     b2_filename = generate_b2_filename(filename)
     
@@ -411,28 +2643,178 @@ def get_upload_auth():
         # Get upload credentials from B2
         credentials = get_upload_credentials(b2_filename)
         
-        return jsonify({
-            "success": True,
-            "upload_url": credentials['upload_url'],
-            "authorization_token": credentials['authorization_token'],
-            "b2_filename": b2_filename,
-            "bucket_id": credentials['bucket_id'],
-            # Include headers that client needs to send
-            "headers": {
-                "Authorization": credentials['authorization_token'],
-                "X-Bz-File-Name": b2_filename,
-                "X-Bz-Content-Sha1": "do_not_verify",  # Skip SHA1 verification for simplicity
-                # Content-Type will be set by frontend based on file type
-            }
-        })
+        return jsonify({"success": True, **upload_auth_payload(credentials, sha1)})
     except Exception as e:
         print(f"[ERROR] get_upload_auth failed: {e}")
         import traceback
         traceback.print_exc()
         return jsonify({"error": f"Failed to get upload credentials: {str(e)}"}), 500
 
+def duplicate_payload(existing):
+    """Fields returned when the content is already in B2 (no credentials issued)"""
+    return {
+        "duplicate": True,
+        "url": existing['url'],
+        "b2_filename": existing['b2_filename'],
+        "existing_filename": existing.get('filename', '')
+    }
+
+def upload_auth_payload(credentials, sha1=None):
+    """Fields returned to the client for one direct upload"""
+    b2_filename = credentials['b2_filename']
+    return {
+        "upload_url": credentials['upload_url'],
+        "authorization_token": credentials['authorization_token'],
+        "b2_filename": b2_filename,
+        "bucket_id": credentials['bucket_id'],
+        "lease_id": credentials['lease_id'],
+        # Include headers that client needs to send
+        "headers": {
+            "Authorization": credentials['authorization_token'],
+            "X-Bz-File-Name": b2_filename,
+            # B2 verifies the content when the client sent its SHA1
+            "X-Bz-Content-Sha1": sha1.lower() if sha1 else "do_not_verify",
+            # Content-Type will be set by frontend based on file type
+        }
+    }
+
+@app.route('/api/upload/auth/batch', methods=['POST'])
+@login_required
+@direct_uploads_required
+def get_upload_auth_batch():
+    """Get upload credentials for several direct uploads in one request"""
+    data = request.get_json()
+    if not data or not isinstance(data.get('files'), list) or not data['files']:
+        return jsonify({"error": "files list required"}), 400
+    
+    files = data['files']
+    if len(files) > UPLOAD_BATCH_MAX:
+        return jsonify({"error": f"Too many files (max {UPLOAD_BATCH_MAX})"}), 400
+    
+    items = []
+    accepted = []
+    for index, entry in enumerate(files):
+        filename = entry.get('filename') if isinstance(entry, dict) else entry
+        sha1 = entry.get('sha1') if isinstance(entry, dict) else None
+        if not filename or not isinstance(filename, str):
+            items.append({"index": index, "success": False, "error": "Filename required"})
+        elif not allowed_file(filename):
+            items.append({"index": index, "filename": filename, "success": False, "error": "File type not allowed"})
+        elif sha1 is not None and not is_sha1(sha1):
+            items.append({"index": index, "filename": filename, "success": False,
+                          "error": "sha1 must be a 40-character hex digest"})
+        else:
+            item = {"index": index, "filename": filename, "success": True, "sha1": sha1}
+            items.append(item)
+            accepted.append(item)
+    
+    # Content already in B2: return the existing URL instead of credentials
+    existing = hash_index.lookup_many([item['sha1'] for item in accepted if item['sha1']])
+    if existing:
+        uploads = []
+        for item in accepted:
+            if item['sha1'] and item['sha1'].lower() in existing:
+                item.update(duplicate_payload(existing[item['sha1'].lower()]))
+            else:
+                uploads.append(item)
+        accepted = uploads
+    
+    try:
+        credentials = get_upload_credentials_batch(
+            [generate_b2_filename(item['filename']) for item in accepted]
+        ) if accepted else []
+    except Exception as e:
+        print(f"[ERROR] get_upload_auth_batch failed: {e}")
+        return jsonify({"error": f"Failed to get upload credentials: {str(e)}"}), 500
+    
+    for item, creds in zip(accepted, credentials):
+        item.update(upload_auth_payload(creds, item['sha1']))
+    for item in items:
+        item.pop('sha1', None)
+    
+    return jsonify({"success": all(item['success'] for item in items), "items": items})
+
+@app.route('/api/upload/complete/batch', methods=['POST'])
+@login_required
+@direct_uploads_required
+def complete_upload_batch():
+    """Register several completed direct uploads with batched Firestore writes"""
+    data = request.get_json()
+    if not data or not isinstance(data.get('uploads'), list) or not data['uploads']:
+        return jsonify({"error": "uploads list required"}), 400
+    
+    uploads = data['uploads']
+    if len(uploads) > UPLOAD_BATCH_MAX:
+        return jsonify({"error": f"Too many uploads (max {UPLOAD_BATCH_MAX})"}), 400
+    
+    results = [None] * len(uploads)
+    records = []
+    positions = []
+    for index, upload in enumerate(uploads):
+        b2_filename = upload.get('b2_filename') if isinstance(upload, dict) else None
+        original_filename = upload.get('original_filename') if isinstance(upload, dict) else None
+        if not b2_filename or not original_filename:
+            results[index] = {"index": index, "success": False,
+                              "error": "b2_filename and original_filename required"}
+            continue
+        sha1 = upload.get('sha1')
+        if sha1 is not None and not is_sha1(sha1):
+            results[index] = {"index": index, "success": False,
+                              "error": "sha1 must be a 40-character hex digest"}
+            continue
+        records.append({
+            'filename': original_filename,
+            'url': get_public_url(b2_filename),
+            'b2_filename': b2_filename,
+            'sha1': sha1
+        })
+        positions.append(index)
+    
+    # El tamaño y el SHA1 los da B2 (el tamaño cuenta en las estadísticas al crear el registro)
+    def lookup(record):
+        try:
+            return storage.file_info(record['b2_filename']), None
+        except FileNotFoundError:
+            return None, "Uploaded file not found"
+        except Exception as e:
+            return None, f"Failed to read uploaded file info: {e}"
+    
+    if records:
+        with ThreadPoolExecutor(max_workers=min(len(records), UPLOAD_COMPLETE_LOOKUP_CONCURRENCY)) as executor:
+            infos = list(executor.map(lookup, records))
+        found = []
+        for index, record, (info, error) in zip(positions, records, infos):
+            if info is None:
+                results[index] = {"index": index, "success": False, "error": error}
+                continue
+            try:
+                record['sha1'] = uploaded_sha1(record['sha1'], info)
+            except ValueError as e:
+                results[index] = {"index": index, "success": False, "error": str(e)}
+                continue
+            record['bytes'] = info['bytes']
+            # Return the leased upload URL to the pool for the next client
+            upload_url_pool.release(uploads[index].get('lease_id'))
+            found.append((index, record))
+        positions = [index for index, _ in found]
+        records = [record for _, record in found]
+    
+    try:
+        saved = save_upload_records(records) if records else []
+    except Exception as e:
+        return jsonify({"error": f"Failed to save upload records: {str(e)}"}), 500
+    
+    for index, record, result in zip(positions, records, saved):
+        result = {"index": index, **result}
+        if result['success']:
+            result.update({"url": record['url'], "filename": record['filename']})
+        results[index] = result
+    
+    return jsonify({"success": all(r['success'] for r in results), "results": results})
+
 @app.route('/api/upload/complete', methods=['POST'])
 @login_required
+@direct_uploads_required
 def complete_upload():
     """Register completed upload in Firestore"""
     data = request.get_json()
@@ -445,6 +2827,25 @@ def complete_upload():
     if not b2_filename or not original_filename:
         return jsonify({"error": "b2_filename and original_filename required"}), 400
     
+    sha1 = data.get('sha1')
+    if sha1 is not None and not is_sha1(sha1):
+        return jsonify({"error": "sha1 must be a 40-character hex digest"}), 400
+    
+    # El tamaño y el SHA1 los da B2 (el tamaño cuenta en las estadísticas al crear el registro)
+    try:
+        info = storage.file_info(b2_filename)
+    except FileNotFoundError:
+        return jsonify({"error": "Uploaded file not found"}), 404
+    except Exception as e:
+        return jsonify({"error": f"Failed to read uploaded file info: {str(e)}"}), 500
+    try:
+        sha1 = uploaded_sha1(sha1, info)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 409
+    
+    # Return the leased upload URL to the pool for the next client
+    upload_url_pool.release(data.get('lease_id'))
+    
     # Get public URL
     public_url = get_public_url(b2_filename)
     
@@ -452,7 +2853,9 @@ def complete_upload():
     record = {
         'filename': original_filename,
         'url': public_url,
-        'b2_filename': b2_filename
+        'b2_filename': b2_filename,
+        'sha1': sha1,
+        'bytes': info['bytes']
     }
     
     try:
@@ -466,6 +2869,211 @@ def complete_upload():
     except Exception as e:
         return jsonify({"error": f"Failed to save upload record: {str(e)}"}), 500
 
+# Large-file (multipart) direct upload: the browser uploads parts in parallel
+# straight to B2 and can resume a transfer by asking which parts already exist.
+
+def list_uploaded_parts(file_id):
+    """List the parts B2 already has for an unfinished large file"""
+    parts = []
+    start_part = 1
+    while start_part:
+        with Span('b2_api'):
+            response = b2_session.call(lambda b: b.api.session.list_parts(file_id, start_part, 1000))
+        for part in response.get('parts', []):
+            parts.append({
+                'part_number': part['partNumber'],
+                'sha1': part['contentSha1'],
+                'size': part['contentLength']
+            })
+        start_part = response.get('nextPartNumber')
+    return parts
+
+@app.route('/api/upload/large/start', methods=['POST'])
+@login_required
+@direct_uploads_required
+def start_large_upload():
+    """Start a B2 large file for a multipart direct upload"""
+    data = request.get_json()
+    if not data:
+        return jsonify({"error": "JSON data required"}), 400
+    
+    filename = data.get('filename')
+    if not filename:
+        return jsonify({"error": "Filename required"}), 400
+    
+    if not allowed_file(filename):
+        return jsonify({"error": "File type not allowed"}), 400
+    
+    b2_filename = generate_b2_filename(filename)
+    content_type = data.get('content_type') or 'b2/x-auto'
+    
+    try:
+        with Span('b2_api'):
+            response = b2_session.call(
+                lambda b: b.api.session.start_large_file(b.id_, b2_filename, content_type, {})
+            )
+    except Exception as e:
+        print(f"[ERROR] start_large_file failed: {e}")
+        return jsonify({"error": f"Failed to start large file: {str(e)}"}), 500
+    
+    return jsonify({
+        "success": True,
+        "file_id": response['fileId'],
+        "b2_filename": b2_filename,
+        "part_size": LARGE_UPLOAD_PART_SIZE,
+        "max_parallel": LARGE_UPLOAD_MAX_PARALLEL
+    })
+
+@app.route('/api/upload/large/part-urls', methods=['POST'])
+@login_required
+@direct_uploads_required
+def get_large_upload_part_urls():
+    """Get part upload URLs (one per parallel upload stream)"""
+    data = request.get_json()
+    if not data or not data.get('file_id'):
+        return jsonify({"error": "file_id required"}), 400
+    
+    file_id = data['file_id']
+    try:
+        count = int(data.get('count', 1))
+    except (TypeError, ValueError):
+        return jsonify({"error": "count must be an integer"}), 400
+    count = max(1, min(count, LARGE_UPLOAD_MAX_PARALLEL))
+    
+    try:
+        urls = []
+        for _ in range(count):
+            with Span('b2_api'):
+                part_url = b2_session.call(lambda b: b.api.session.get_upload_part_url(file_id))
+            urls.append({
+                "upload_url": part_url['uploadUrl'],
+                "authorization_token": part_url['authorizationToken']
+            })
+    except Exception as e:
+        print(f"[ERROR] get_upload_part_url failed: {e}")
+        return jsonify({"error": f"Failed to get part upload URLs: {str(e)}"}), 500
+    
+    return jsonify({"success": True, "urls": urls})
+
+@app.route('/api/upload/large/<file_id>/parts', methods=['GET'])
+@login_required
+@direct_uploads_required
+def get_large_upload_parts(file_id):
+    """List uploaded parts so the client can resume only the missing ones"""
+    try:
+        parts = list_uploaded_parts(file_id)
+    except Exception as e:
+        return jsonify({"error": f"Failed to list parts: {str(e)}"}), 404
+    return jsonify({"success": True, "file_id": file_id, "parts": parts})
+
+@app.route('/api/upload/large/finish', methods=['POST'])
+@login_required
+@direct_uploads_required
+def finish_large_upload():
+    """Assemble the uploaded parts and register the upload in Firestore"""
+    data = request.get_json()
+    if not data:
+        return jsonify({"error": "JSON data required"}), 400
+    
+    file_id = data.get('file_id')
+    original_filename = data.get('original_filename')
+    part_sha1_array = data.get('part_sha1_array')
+    
+    if not file_id or not original_filename or not isinstance(part_sha1_array, list) or not part_sha1_array:
+        return jsonify({"error": "file_id, original_filename and part_sha1_array required"}), 400
+    
+    try:
+        with Span('b2_api'):
+            response = b2_session.call(lambda b: b.api.session.finish_large_file(file_id, part_sha1_array))
+    except Exception as e:
+        print(f"[ERROR] finish_large_file failed: {e}")
+        return jsonify({"error": f"Failed to finish large file: {str(e)}"}), 500
+    
+    metrics.inc('app_uploaded_bytes_total', response.get('contentLength') or 0, path='direct_large')
+    
+    # Use the name B2 assigned at start_large_file, not a client-provided one
+    b2_filename = response['fileName']
+    public_url = get_public_url(b2_filename)
+    record = {
+        'filename': original_filename,
+        'url': public_url,
+        'b2_filename': b2_filename,
+        'bytes': response.get('contentLength')
+    }
+    
+    try:
+        save_upload_record(record)
+    except Exception as e:
+        return jsonify({"error": f"Failed to save upload record: {str(e)}"}), 500
+    
+    return jsonify({
+        "success": True,
+        "message": "Upload registered successfully",
+        "url": public_url,
+        "filename": original_filename
+    })
+
+@app.route('/api/upload/large/cancel', methods=['POST'])
+@login_required
+@direct_uploads_required
+def cancel_large_upload():
+    """Cancel an unfinished large file and discard its parts"""
+    data = request.get_json()
+    if not data or not data.get('file_id'):
+        return jsonify({"error": "file_id required"}), 400
+    
+    file_id = data['file_id']
+    try:
+        with Span('b2_api'):
+            b2_session.call(lambda b: b.api.session.cancel_large_file(file_id))
+    except Exception as e:
+        return jsonify({"error": f"Failed to cancel large file: {str(e)}"}), 500
+    return jsonify({"success": True})
+
+@app.route('/api/debug/startup', methods=['GET'])
+@login_required
+def debug_startup():
+    """Informe de tiempos de arranque (cold start) de este proceso"""
+    return jsonify({"success": True, **startup_report()})
+
+def metrics_authorized():
+    """/metrics: sesión iniciada o, si está configurado, METRICS_TOKEN como Bearer"""
+    if session.get('authenticated'):
+        return True
+    if METRICS_TOKEN:
+        return hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}")
+    return False
+
+def component_gauges():
+    """Estadísticas de los singletons como gauges app_<componente>_<campo>"""
+    components = {
+        'b2_session': b2_session.stats(),
+        'upload_url_pool': upload_url_pool.stats(),
+        'upload_jobs': upload_jobs.stats(),
+        'upload_admission': upload_admission.stats(),
+        'hash_index': hash_index.stats(),
+        'listing_cache': listing_cache.stats(),
+        'search_index': search_index.stats(),
+        'assets': assets.stats(),
+        'image_metadata': image_metadata.stats(),
+        'thumbnails': thumbnails.stats(),
+        'gallery_stats': gallery_stats.stats(),
+    }
+    gauges = {}
+    for component, stats in components.items():
+        for key, value in stats.items():
+            if isinstance(value, (int, float)):
+                gauges[f"app_{component}_{key}"] = int(value) if isinstance(value, bool) else value
+    return gauges
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Métricas de este proceso en formato de exposición de Prometheus"""
+    if not metrics_authorized():
+        return app.response_class("Unauthorized\n", status=401, mimetype='text/plain')
+    return app.response_class(metrics.render(component_gauges()),
+                              content_type='text/plain; version=0.0.4; charset=utf-8')
+
 # Test endpoint to debug B2 upload (disabled in production)
 # @app.route('/api/upload/test', methods=['POST'])
 # @login_required
@@ -539,6 +3147,439 @@ def complete_upload():
 #             'error': str(e)
 #         }), 500
 
+@app.route('/files/<path:key>')
+def serve_file(key):
+    """Servir un archivo del almacenamiento local.
+
+    send_file entrega el archivo con wsgi.file_wrapper (sendfile en gunicorn),
+    responde a Range con 206 y a If-None-Match/If-Modified-Since con 304. Los
+    nombres son únicos, así que el contenido de una URL nunca cambia.
+    """
+    if not isinstance(storage, LocalStorage):
+        abort(404)
+    response = send_from_directory(storage.root, key, conditional=True, etag=True,
+                                   max_age=LOCAL_STORAGE_MAX_AGE)
+    response.headers['Cache-Control'] = f'public, max-age={LOCAL_STORAGE_MAX_AGE}, immutable'
+    return response
+
+class ThumbnailCache:
+    """Miniaturas generadas bajo demanda y guardadas en disco, con expulsión LRU por bytes.
+
+    Cada miniatura se identifica por (archivo, ancho, formato): como los nombres
+    de los archivos son únicos nunca cambia, y el hash de la clave sirve de
+    nombre en disco y de ETag. Las peticiones simultáneas de una miniatura que
+    falta comparten una sola descarga del original y un solo redimensionado en
+    el pool de procesos. El orden LRU es el mtime de los archivos (se actualiza
+    en cada acierto), así sobrevive a un reinicio; con varios workers cada uno
+    lleva su propia cuenta de bytes y el límite es aproximado.
+
+    Los fallos se recuerdan en memoria durante failure_ttl segundos, para que
+    pedir una y otra vez una miniatura imposible no descargue el original cada vez.
+    """
+
+    def __init__(self, root, max_bytes, failure_ttl=THUMB_FAILURE_TTL,
+                 max_failures=THUMB_FAILURE_MAX_ENTRIES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.failure_ttl = failure_ttl
+        self.max_failures = max_failures
+        self._lock = threading.Lock()
+        self._entries = None  # nombre -> bytes, del menos al más reciente (se carga al primer uso)
+        self._bytes = 0
+        self._inflight = {}
+        self._failures = OrderedDict()  # nombre -> (caduca, falta el original), por orden de llegada
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.failure_hits = 0
+
+    @staticmethod
+    def digest(key, width, fmt):
+        return hashlib.sha1(f"{key}\0{width}\0{fmt}\0{THUMB_QUALITY}".encode()).hexdigest()
+
+    def _load(self):
+        """Índice de los archivos ya en disco, ordenados por mtime (con el lock tomado)"""
+        if self._entries is not None:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.root):
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                found.append((stat.st_mtime, entry.name, stat.st_size))
+        found.sort()
+        self._entries = OrderedDict((name, size) for _, name, size in found)
+        self._bytes = sum(self._entries.values())
+
+    def _read(self, name):
+        path = os.path.join(self.root, name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            # Lo expulsó otro worker
+            with self._lock:
+                self._bytes -= self._entries.pop(name, 0)
+            return None
+
+    def get(self, key, width, fmt):
+        """Bytes de la miniatura, o None si el original es demasiado grande.
+
+        FileNotFoundError si el original no existe.
+        """
+        name = f"{self.digest(key, width, fmt)}.{fmt}"
+        with self._lock:
+            self._load()
+            failure = self._failures.get(name)
+            if failure is not None and failure[0] <= time.monotonic():
+                del self._failures[name]
+                failure = None
+            if failure is not None:
+                self.failure_hits += 1
+            cached = name in self._entries
+            if cached:
+                self._entries.move_to_end(name)
+        if failure is not None:
+            if failure[1]:
+                raise FileNotFoundError(key)
+            return None
+        if cached:
+            data = self._read(name)
+            if data is not None:
+                with self._lock:
+                    self.hits += 1
+                return data
+
+        with self._lock:
+            future = self._inflight.get(name)
+            leader = future is None
+            if leader:
+                future = self._inflight[name] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result(timeout=TRANSCODE_TIMEOUT * 2)
+        try:
+            data = self._generate(key, width, fmt)
+            if data is not None:
+                self._store(name, data)
+            else:
+                self._remember_failure(name, missing=False)
+            future.set_result(data)
+            return data
+        except BaseException as e:
+            if isinstance(e, Exception):
+                self._remember_failure(name, missing=isinstance(e, (FileNotFoundError, ValueError)))
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(name, None)
+
+    def _remember_failure(self, name, missing):
+        with self._lock:
+            self._failures.pop(name, None)
+            self._failures[name] = (time.monotonic() + self.failure_ttl, missing)
+            while len(self._failures) > self.max_failures:
+                self._failures.popitem(last=False)
+
+    def _generate(self, key, width, fmt):
+        import imaging
+        data, size = read_stored_file(key, THUMB_MAX_SOURCE_BYTES)
+        if len(data) < size:
+            return None
+        future = get_transcode_pool().submit(imaging.make_thumbnail, data, width, fmt, THUMB_QUALITY)
+        with Span('thumbnail'):
+            thumbnail, _, _ = future.result(timeout=TRANSCODE_TIMEOUT)
+        return thumbnail
+
+    def _store(self, name, data):
+        """Escribir en un temporal y renombrar; expulsar las menos recientes si se pasa del límite"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.thumb-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, os.path.join(self.root, name))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        evicted = []
+        with self._lock:
+            self._bytes += len(data) - self._entries.pop(name, 0)
+            self._entries[name] = len(data)
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                old_name, old_size = self._entries.popitem(last=False)
+                self._bytes -= old_size
+                evicted.append(old_name)
+            self.evictions += len(evicted)
+        for old_name in evicted:
+            try:
+                os.remove(os.path.join(self.root, old_name))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "files": len(self._entries or ()),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "inflight": len(self._inflight),
+                "failures": len(self._failures),
+                "failure_hits": self.failure_hits,
+            }
+
+
+thumbnails = ThumbnailCache(THUMB_CACHE_DIR, THUMB_CACHE_MAX_BYTES)
+
+def thumb_width(requested):
+    """Ancho admitido para el pedido: el menor que no sea más pequeño (o el mayor)"""
+    for width in THUMB_WIDTHS:
+        if width >= requested:
+            return width
+    return THUMB_WIDTHS[-1]
+
+@app.route('/thumb/<path:b2_filename>')
+@login_required
+def serve_thumbnail(b2_filename):
+    """Miniatura de una imagen subida: ?w= (se redondea a THUMB_WIDTHS) y ?fmt=webp|jpeg.
+
+    Si no se puede generar (original demasiado grande, Pillow no instalado o
+    archivo que no es una imagen) redirige al original. Requiere sesión, como
+    la galería: cada miniatura nueva cuesta una descarga y un redimensionado.
+    """
+    if not allowed_file(b2_filename) or not b2_filename.startswith(B2_PREFIX):
+        abort(404)
+    width = thumb_width(request.args.get('w', THUMB_WIDTHS[0], type=int) or THUMB_WIDTHS[0])
+    fmt = request.args.get('fmt', 'webp').lower()
+    if fmt == 'jpg':
+        fmt = 'jpeg'
+    if fmt not in THUMB_FORMATS:
+        return jsonify({'error': f"fmt must be one of: {', '.join(THUMB_FORMATS)}"}), 400
+
+    # La miniatura de una clave nunca cambia: el ETag se conoce sin generarla
+    etag = ThumbnailCache.digest(b2_filename, width, fmt)
+    # private: solo las sirve una sesión iniciada, no una caché compartida
+    cache_control = f'private, max-age={THUMB_MAX_AGE}, immutable'
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = cache_control
+        return response
+
+    data = None
+    if PILLOW_AVAILABLE:
+        try:
+            data = thumbnails.get(b2_filename, width, fmt)
+        except (FileNotFoundError, ValueError):
+            abort(404)
+        except Exception as e:
+            print(f"Error generando la miniatura de {b2_filename} ({width}px {fmt}): {e}")
+    if data is None:
+        return redirect(get_public_url(b2_filename))
+
+    response = app.response_class(data, mimetype=THUMB_FORMATS[fmt])
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+class AssetPipeline:
+    """Assets de static/ con huella de contenido y precomprimidos, servidos desde memoria.
+
+    asset_url('js/app.js') devuelve /assets/js/app.<hash>.js: como la URL cambia
+    con el contenido, la respuesta se puede cachear un año como immutable.
+    build_assets.py construye los assets de las plantillas en static/dist al
+    desplegar; al importar solo se carga su manifiesto (load_manifest), y en
+    Vercel la URL apunta a /static/dist/, que sirve el CDN sin pasar por la
+    función. Un archivo que no esté en el manifiesto (o que haya cambiado) se
+    lee, se le calcula la huella y se comprime la primera vez que se pide; en
+    modo debug se vuelve a construir cuando cambia en disco.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self._by_path = {}
+        self._by_name = {}
+        self._dist = set()  # rutas cargadas desde static/dist
+        self.builds = 0
+        self.served = {'br': 0, 'gzip': 0, 'identity': 0}
+
+    @staticmethod
+    def _compress(data, brotli_quality):
+        variants = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+        if BROTLI_AVAILABLE:
+            import brotli
+            variants['br'] = brotli.compress(data, quality=brotli_quality)
+        # Solo vale la pena la variante si es más pequeña que el original
+        return {encoding: body for encoding, body in variants.items() if len(body) < len(data)}
+
+    @staticmethod
+    def digest(data):
+        return hashlib.sha1(data).hexdigest()[:12]
+
+    def build(self, path, brotli_quality=ASSET_BROTLI_QUALITY):
+        """Entrada nueva (sin registrarla) de un archivo de static/: huella y variantes"""
+        full_path = safe_join(self.root, path)
+        if full_path is None or not os.path.isfile(full_path):
+            raise FileNotFoundError(path)
+        mtime = os.path.getmtime(full_path)
+        with open(full_path, 'rb') as f:
+            data = f.read()
+        digest = self.digest(data)
+        stem, ext = os.path.splitext(path)
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        variants = {'identity': data}
+        if mimetype.startswith('text/') or mimetype in ASSET_COMPRESSIBLE_TYPES:
+            with Span('asset_compress'):
+                variants.update(self._compress(data, brotli_quality))
+        return {
+            'path': path,
+            'name': f"{stem}.{digest}{ext}",
+            'digest': digest,
+            'mimetype': mimetype,
+            'mtime': mtime,
+            'variants': variants,
+        }
+
+    def get(self, path):
+        """Entrada (construida si hace falta) de un archivo de static/"""
+        entry = self._by_path.get(path)
+        if entry is not None and not (app.debug and os.path.getmtime(safe_join(self.root, path)) != entry['mtime']):
+            return entry
+        with self._lock:
+            entry = self.build(path)
+            self._register(entry)
+            self._dist.discard(path)
+            self.builds += 1
+        return entry
+
+    def _register(self, entry):
+        old = self._by_path.get(entry['path'])
+        if old is not None:
+            self._by_name.pop(old['name'], None)
+        self._by_path[entry['path']] = entry
+        self._by_name[entry['name']] = entry
+
+    def load_manifest(self):
+        """Cargar lo que dejó build_assets.py en static/dist.
+
+        Solo se lee: los archivos (ya comprimidos) y el de origen, para comprobar
+        que la huella sigue siendo la suya. Una entrada desactualizada se ignora
+        y ese asset se construye en memoria como si no hubiera manifiesto.
+        """
+        dist = os.path.join(self.root, ASSET_DIST_DIR)
+        try:
+            with open(os.path.join(dist, 'manifest.json'), encoding='utf-8') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return
+        for path, item in manifest.items():
+            full_path = safe_join(self.root, path)
+            try:
+                with open(full_path, 'rb') as f:
+                    data = f.read()
+                if self.digest(data) != item['digest']:
+                    print(f"Asset desactualizado en static/{ASSET_DIST_DIR}: {path} (ejecuta build_assets.py)")
+                    continue
+                variants = {'identity': data}
+                for encoding, suffix in item['encodings'].items():
+                    with open(os.path.join(dist, item['name'] + suffix), 'rb') as f:
+                        variants[encoding] = f.read()
+            except (FileNotFoundError, TypeError):
+                continue
+            with self._lock:
+                self._register({
+                    'path': path,
+                    'name': item['name'],
+                    'digest': item['digest'],
+                    'mimetype': item['mimetype'],
+                    'mtime': os.path.getmtime(full_path),
+                    'variants': variants,
+                })
+                self._dist.add(path)
+
+    def url(self, path):
+        entry = self.get(path)
+        if IS_VERCEL and path in self._dist:
+            # El CDN de Vercel sirve static/ (vercel.json) sin pasar por la función
+            return url_for('static', filename=f"{ASSET_DIST_DIR}/{entry['name']}")
+        return url_for('serve_asset', name=entry['name'])
+
+    def count_served(self, encoding):
+        with self._lock:
+            self.served[encoding] += 1
+
+    def lookup(self, name):
+        """Entrada por nombre con huella, o None (nombre desconocido o de otra versión)"""
+        entry = self._by_name.get(name)
+        if entry is None:
+            # Otro worker pudo dar la URL antes de que este construyera el archivo
+            path, digest = self._split_name(name)
+            if path is not None:
+                try:
+                    entry = self.get(path)
+                except FileNotFoundError:
+                    return None
+                if entry['digest'] != digest:
+                    return None
+        return entry
+
+    @staticmethod
+    def _split_name(name):
+        stem, ext = os.path.splitext(name)
+        stem, dot, digest = stem.rpartition('.')
+        if not dot or len(digest) != 12:
+            return None, None
+        return stem + ext, digest
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "files": len(self._by_path),
+                "prebuilt": len(self._dist),
+                "builds": self.builds,
+                "bytes": sum(len(body) for entry in self._by_path.values() for body in entry['variants'].values()),
+            }
+            stats.update({f"served_{encoding}": count for encoding, count in self.served.items()})
+            return stats
+
+
+assets = AssetPipeline(os.path.join(BASE_DIR, 'static'))
+app.jinja_env.globals['asset_url'] = assets.url
+with StartupTimer('load assets'):
+    assets.load_manifest()
+
+@app.route('/assets/<path:name>')
+def serve_asset(name):
+    """Assets con huella: variante según Accept-Encoding, cacheable como immutable"""
+    entry = assets.lookup(name)
+    if entry is None:
+        abort(404)
+    # Preferir brotli, luego gzip, entre las variantes que acepta el cliente
+    encoding = 'identity'
+    for candidate in ('br', 'gzip'):
+        if candidate in entry['variants'] and request.accept_encodings[candidate]:
+            encoding = candidate
+            break
+    assets.count_served(encoding)
+    
+    response = app.response_class(entry['variants'][encoding], mimetype=entry['mimetype'])
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = f'public, max-age={ASSET_MAX_AGE}, immutable'
+    response.set_etag(f"{entry['digest']}-{encoding}")
+    return response.make_conditional(request)
+
 # Static files are served directly by Vercel in production
 # Also available via Flask for compatibility
 @app.route('/static/<path:filename>')
@@ -547,6 +3588,8 @@ def serve_static(filename):
     static_dir = os.path.join(BASE_DIR, 'static')
     return send_from_directory(static_dir, filename)
 
+STARTUP_TIMINGS['import app'] = round((time.perf_counter() - _PROCESS_START) * 1000, 1)
+
 if __name__ == '__main__':
     debug = os.getenv('FLASK_ENV') == 'development'
     host = os.getenv('HOST', '0.0.0.0')
@@ -0,0 +1,603 @@
+#!/usr/bin/env python3
+"""
+Modo de servicio ASGI (opcional) con E/S asíncrona para los endpoints de metadatos.
+
+/api/upload/auth, /api/upload/complete y /uploads son casi solo espera de red
+a B2 y Firestore. Aquí se atienden en el event loop con el cliente asíncrono
+de Firestore y httpx, así que un proceso puede tener cientos de llamadas en
+vuelo sin ocupar un hilo por petición. El resto de rutas pasa a la app Flask
+de app.py a través de WsgiToAsgi. El modo WSGI (python app.py, gunicorn,
+Vercel) sigue siendo el de siempre.
+
+Uso:
+    pip install -r requirements-asgi.txt
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs, quote
+
+import httpx
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+from itsdangerous import BadSignature
+from werkzeug.http import parse_etags
+
+import app as core
+
+# Conexiones simultáneas a la API de B2 por proceso
+ASGI_B2_MAX_CONNECTIONS = int(os.getenv('ASGI_B2_MAX_CONNECTIONS', 100))
+# Hilos para las rutas que siguen en Flask (WSGI)
+ASGI_WSGI_THREADS = int(os.getenv('ASGI_WSGI_THREADS', 32))
+# Cuerpo máximo de las peticiones JSON que se atienden aquí
+ASGI_MAX_JSON_BODY = int(os.getenv('ASGI_MAX_JSON_BODY', 1024 * 1024))
+
+B2_AUTH_ERRORS = ('expired_auth_token', 'bad_auth_token')
+# Los mismos realms que acepta b2sdk (B2_REALM también puede ser una URL)
+B2_REALM_URLS = {
+    'production': 'https://api.backblazeb2.com',
+    'dev': 'http://api.backblazeb2.xyz:8180',
+    'staging': 'https://api.backblaze.net',
+}
+
+
+class B2ApiError(Exception):
+    def __init__(self, status, code, message):
+        super().__init__(f"{status} {code}: {message}")
+        self.status = status
+        self.code = code
+
+
+class AsyncB2Session:
+    """Cliente asíncrono mínimo de la API nativa de B2 (v3, la misma que usa b2sdk).
+
+    Autoriza una vez, comparte el token entre peticiones y lo renueva antes de
+    que expire o cuando B2 lo rechaza.
+    """
+
+    def __init__(self, key_id, key, bucket_name, realm='production',
+                 refresh_after=core.B2_AUTH_REFRESH_SECONDS):
+        self.key_id = key_id
+        self.key = key
+        self.bucket_name = bucket_name
+        self.realm_url = realm if realm.startswith('http') else B2_REALM_URLS[realm]
+        self.refresh_after = refresh_after
+        self._client = None
+        self._lock = asyncio.Lock()
+        self._auth = None
+        self._authorized_at = 0.0
+        self.authorizations = 0
+
+    @property
+    def client(self):
+        if self._client is None:
+            limits = httpx.Limits(max_connections=ASGI_B2_MAX_CONNECTIONS,
+                                  max_keepalive_connections=ASGI_B2_MAX_CONNECTIONS)
+            self._client = httpx.AsyncClient(limits=limits, timeout=30)
+        return self._client
+
+    async def _authorize(self):
+        with core.Span('b2_auth'):
+            response = await self.client.get(f"{self.realm_url}/b2api/v3/b2_authorize_account",
+                                             auth=(self.key_id, self.key))
+            data = self._json(response)
+            storage_api = data['apiInfo']['storageApi']
+            auth = {
+                'api_url': storage_api['apiUrl'],
+                'download_url': storage_api['downloadUrl'],
+                'token': data['authorizationToken'],
+                'bucket_id': storage_api.get('bucketId'),
+            }
+            if not auth['bucket_id']:
+                # Clave sin restricción de bucket: buscarlo por nombre
+                response = await self.client.post(
+                    f"{auth['api_url']}/b2api/v3/b2_list_buckets",
+                    json={'accountId': data['accountId'], 'bucketName': self.bucket_name},
+                    headers={'Authorization': auth['token']})
+                buckets = self._json(response)['buckets']
+                if not buckets:
+                    raise RuntimeError(f"Bucket {self.bucket_name} not found")
+                auth['bucket_id'] = buckets[0]['bucketId']
+        self._auth = auth
+        self._authorized_at = time.monotonic()
+        self.authorizations += 1
+
+    async def _session(self, stale=None):
+        """Sesión vigente; `stale` fuerza renovar si sigue siendo la que B2 rechazó"""
+        expired = time.monotonic() - self._authorized_at > self.refresh_after
+        if self._auth is None or expired or (stale is not None and self._auth is stale):
+            async with self._lock:
+                if self._auth is None or self._auth is stale or \
+                        time.monotonic() - self._authorized_at > self.refresh_after:
+                    await self._authorize()
+        return self._auth
+
+    @staticmethod
+    def _json(response):
+        if response.status_code != 200:
+            try:
+                error = response.json()
+            except ValueError:
+                error = {}
+            raise B2ApiError(response.status_code, error.get('code', 'unknown'),
+                             error.get('message', response.text[:200]))
+        return response.json()
+
+    async def call(self, operation, payload):
+        """Llamar a una operación de la API; reintenta una vez si el token caducó"""
+        auth = await self._session()
+        for attempt in range(2):
+            response = await self.client.post(f"{auth['api_url']}/b2api/v3/{operation}", json=payload,
+                                              headers={'Authorization': auth['token']})
+            try:
+                return self._json(response)
+            except B2ApiError as e:
+                if attempt or e.status != 401 or e.code not in B2_AUTH_ERRORS:
+                    raise
+                core.metrics.inc('app_errors_total', cause='b2_auth_expired')
+                auth = await self._session(stale=auth)
+
+    async def bucket_id(self):
+        return (await self._session())['bucket_id']
+
+    async def file_info(self, name):
+        """Como B2Storage.file_info: HEAD de la descarga por nombre (FileNotFoundError si no existe)"""
+        auth = await self._session()
+        url = f"{auth['download_url']}/file/{self.bucket_name}/{quote(name)}"
+        for attempt in range(2):
+            response = await self.client.head(url, headers={'Authorization': auth['token']})
+            if response.status_code == 404:
+                raise FileNotFoundError(name)
+            if response.status_code == 401 and not attempt:
+                # HEAD no trae cuerpo con el código de error: renovar y repetir una vez
+                core.metrics.inc('app_errors_total', cause='b2_auth_expired')
+                auth = await self._session(stale=auth)
+                continue
+            if response.status_code != 200:
+                raise B2ApiError(response.status_code, 'unknown', f"HEAD {name} failed")
+            sha1 = response.headers.get('x-bz-content-sha1')
+            return {"bytes": int(response.headers['content-length']),
+                    "sha1": sha1.lower() if core.is_sha1(sha1) else None}
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class AsyncUploadUrlPool(core.UploadUrlPool):
+    """El pool de URLs de subida de app.py, rellenado con tareas asyncio en lugar de un hilo.
+
+    Los préstamos solo vuelven a este pool: /api/upload/complete de este modo
+    recibe los lease_id que dio /api/upload/auth de este mismo modo.
+    """
+
+    def __init__(self, b2):
+        super().__init__(session=None)
+        self.b2 = b2
+        self._refill_task = None
+
+    async def _fetch_async(self):
+        with core.Span('b2_upload_url'):
+            upload_data = await self.b2.call('b2_get_upload_url', {'bucketId': await self.b2.bucket_id()})
+        return {
+            'upload_url': upload_data['uploadUrl'],
+            'authorization_token': upload_data['authorizationToken'],
+            'bucket_id': upload_data['bucketId'],
+            'fetched_at': time.monotonic(),
+        }
+
+    async def _refill_async(self):
+        with self._lock:
+            now = time.monotonic()
+            self._expire_leases(now)
+            self._available = type(self._available)(e for e in self._available if self._is_usable(e, now))
+            missing = self.target_size - len(self._available)
+        if missing <= 0:
+            return
+        results = await asyncio.gather(*(self._fetch_async() for _ in range(missing)), return_exceptions=True)
+        entries = [entry for entry in results if not isinstance(entry, Exception)]
+        if len(entries) < missing:
+            print(f"Error rellenando pool de URLs de subida: {results[-1]}")
+        with self._lock:
+            self._available.extend(entries)
+
+    def _schedule_refill(self):
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.get_running_loop().create_task(self._refill_async())
+
+    async def lease_many_async(self, count):
+        """Prestar varias URLs; las que falten se piden a B2 a la vez"""
+        entries = []
+        with self._lock:
+            now = time.monotonic()
+            self._expire_leases(now)
+            while self._available and len(entries) < count:
+                candidate = self._available.popleft()
+                if self._is_usable(candidate, now):
+                    entries.append(candidate)
+            self.hits += len(entries)
+        missing = count - len(entries)
+        if missing > 0:
+            self.misses += missing
+            entries.extend(await asyncio.gather(*(self._fetch_async() for _ in range(missing))))
+        leases = []
+        with self._lock:
+            expires_at = time.monotonic() + self.lease_timeout
+            for entry in entries:
+                lease_id = uuid.uuid4().hex
+                self._leases[lease_id] = (entry, expires_at)
+                leases.append((lease_id, entry))
+        self._schedule_refill()
+        return leases
+
+
+b2 = AsyncB2Session(core.B2_APPLICATION_KEY_ID, core.B2_APPLICATION_KEY, core.B2_BUCKET_NAME,
+                    realm=core.B2_REALM)
+upload_url_pool = AsyncUploadUrlPool(b2)
+
+# Cliente asíncrono de Firestore (se crea en el primer uso, como en app.py)
+firestore_client = None
+firestore_collection = None
+hash_index_collection = None
+stats_collection = None
+
+
+async def get_async_db():
+    global firestore_client, firestore_collection, hash_index_collection, stats_collection
+    if firestore_client is None:
+        # Inicializa firebase_admin (credenciales) en un hilo: es bloqueante
+        await asyncio.to_thread(core.get_firestore_db)
+        from firebase_admin import firestore_async
+        client = firestore_async.client()
+        firestore_collection = client.collection('uploads')
+        hash_index_collection = client.collection(core.HASH_INDEX_COLLECTION)
+        stats_collection = client.collection(core.STATS_COLLECTION)
+        firestore_client = client
+    return firestore_client
+
+
+# -- Peticiones y respuestas ----------------------------------------------
+
+class Request:
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.method = scope['method']
+        self.path = scope['path']
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                        for name, value in scope['headers']}
+        self.args = {key: values[0] for key, values in
+                     parse_qs(scope.get('query_string', b'').decode('latin-1')).items()}
+        self.body = body
+
+    @property
+    def url(self):
+        scheme = self.scope.get('scheme', 'http')
+        host = self.headers.get('host', 'localhost')
+        query = self.scope.get('query_string', b'').decode('latin-1')
+        return f"{scheme}://{host}{self.path}" + (f"?{query}" if query else '')
+
+    def json(self):
+        try:
+            return json.loads(self.body) if self.body else None
+        except ValueError:
+            return None
+
+    def session(self):
+        """Sesión de Flask: misma cookie y misma firma que app.secret_key"""
+        flask_app = core.app
+        cookie = SimpleCookie(self.headers.get('cookie', ''))
+        name = flask_app.config['SESSION_COOKIE_NAME']
+        if name not in cookie:
+            return {}
+        serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+        max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+        try:
+            return serializer.loads(cookie[name].value, max_age=max_age)
+        except BadSignature:
+            return {}
+
+
+class Response:
+    def __init__(self, body=b'', status=200, headers=None, content_type='application/json'):
+        self.body = body
+        self.status = status
+        self.headers = dict(headers or {})
+        if content_type and body:
+            self.headers['Content-Type'] = content_type
+
+
+def jsonify(payload, status=200):
+    return Response(json.dumps(payload, separators=(',', ':')).encode('utf-8'), status)
+
+
+def login_required(handler):
+    async def decorated(request):
+        if not request.session().get('authenticated'):
+            return Response(status=302, headers={'Location': f"/login?next={quote(request.url, safe='')}"})
+        return await handler(request)
+    decorated.__name__ = handler.__name__
+    return decorated
+
+
+def direct_uploads_required(handler):
+    async def decorated(request):
+        if not core.storage.supports_direct_uploads:
+            return jsonify({
+                "error": f"Direct uploads are not available with the '{core.storage.name}' storage backend"
+            }, 400)
+        return await handler(request)
+    decorated.__name__ = handler.__name__
+    return decorated
+
+
+# -- Endpoints --------------------------------------------------------------
+
+async def lookup_hash(sha1):
+    """Como HashIndex.lookup, con la lectura de Firestore asíncrona"""
+    entry = core.hash_index.peek(sha1)
+    if entry is not None:
+        return entry
+    sha1 = sha1.lower()
+    core.hash_index.misses += 1
+    try:
+        await get_async_db()
+        with core.Span('firestore_read'):
+            snapshot = await hash_index_collection.document(sha1).get()
+        core.metrics.inc('app_firestore_documents_read_total', collection='hashes')
+    except Exception as e:
+        print(f"Error consultando el índice de contenido: {e}")
+        return None
+    if not snapshot.exists:
+        return None
+    entry = snapshot.to_dict()
+    core.hash_index.remember(sha1, entry)
+    core.hash_index.duplicates += 1
+    return entry
+
+
+@login_required
+@direct_uploads_required
+async def upload_auth(request):
+    """Get upload credentials for direct client upload to B2"""
+    data = request.json()
+    if not data:
+        return jsonify({"error": "JSON data required"}, 400)
+
+    filename = data.get('filename')
+    if not filename:
+        return jsonify({"error": "Filename required"}, 400)
+    if not core.allowed_file(filename):
+        return jsonify({"error": "File type not allowed"}, 400)
+
+    sha1 = data.get('sha1')
+    if sha1 is not None and not core.is_sha1(sha1):
+        return jsonify({"error": "sha1 must be a 40-character hex digest"}, 400)
+    if sha1:
+        existing = await lookup_hash(sha1)
+        if existing:
+            return jsonify({"success": True, **core.duplicate_payload(existing)})
+
+    b2_filename = core.generate_b2_filename(filename)
+    try:
+        with core.Span('upload_url_lease'):
+            [(lease_id, entry)] = await upload_url_pool.lease_many_async(1)
+    except Exception as e:
+        print(f"[ERROR] get_upload_auth failed: {e}")
+        return jsonify({"error": f"Failed to get upload credentials: {str(e)}"}, 500)
+    credentials = {
+        'upload_url': entry['upload_url'],
+        'authorization_token': entry['authorization_token'],
+        'b2_filename': b2_filename,
+        'bucket_id': entry['bucket_id'],
+        'lease_id': lease_id
+    }
+    return jsonify({"success": True, **core.upload_auth_payload(credentials, sha1)})
+
+
+@login_required
+@direct_uploads_required
+async def upload_complete(request):
+    """Register completed upload in Firestore"""
+    data = request.json()
+    if not data:
+        return jsonify({"error": "JSON data required"}, 400)
+
+    b2_filename = data.get('b2_filename')
+    original_filename = data.get('original_filename')
+    if not b2_filename or not original_filename:
+        return jsonify({"error": "b2_filename and original_filename required"}, 400)
+
+    sha1 = data.get('sha1')
+    if sha1 is not None and not core.is_sha1(sha1):
+        return jsonify({"error": "sha1 must be a 40-character hex digest"}, 400)
+
+    # El tamaño y el SHA1 los da B2 (el tamaño cuenta en las estadísticas al crear el registro)
+    try:
+        with core.Span('b2_api'):
+            info = await b2.file_info(b2_filename)
+    except FileNotFoundError:
+        return jsonify({"error": "Uploaded file not found"}, 404)
+    except Exception as e:
+        return jsonify({"error": f"Failed to read uploaded file info: {str(e)}"}, 500)
+    try:
+        sha1 = core.uploaded_sha1(sha1, info)
+    except ValueError as e:
+        return jsonify({"error": str(e)}, 409)
+
+    upload_url_pool.release(data.get('lease_id'))
+    public_url = core.get_public_url(b2_filename)
+
+    image_data = core.build_image_data({
+        'filename': original_filename,
+        'url': public_url,
+        'b2_filename': b2_filename,
+        'sha1': sha1,
+        'bytes': info['bytes']
+    })
+    try:
+        from google.api_core.exceptions import AlreadyExists
+        client = await get_async_db()
+        # Las mismas escrituras que save_upload_record, con el cliente asíncrono
+        collections = (firestore_collection, hash_index_collection, stats_collection)
+        with core.Span('firestore_write'):
+            try:
+                await core.upload_record_batch(client, *collections, image_data).commit()
+            except AlreadyExists:
+                await core.upload_record_batch(client, *collections, image_data, exists=True).commit()
+                snapshot = await firestore_collection.document(b2_filename).get()
+                image_data = snapshot.to_dict() or image_data
+    except Exception as e:
+        print(f"Error guardando en Firestore: {e}")
+        return jsonify({"error": f"Failed to save upload record: {str(e)}"}, 500)
+
+    core.upload_record_saved(image_data)
+
+    return jsonify({
+        "success": True,
+        "message": "Upload registered successfully",
+        "url": public_url,
+        "filename": original_filename
+    })
+
+
+@login_required
+async def list_uploads(request):
+    """Endpoint para listar imágenes subidas (paginado con ?limit=&cursor=)"""
+    try:
+        limit = int(request.args.get('limit', core.UPLOADS_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}, 400)
+    limit = max(1, min(limit, core.UPLOADS_MAX_PAGE_SIZE))
+    cursor = request.args.get('cursor') or None
+
+    entry = core.listing_cache.get(limit, cursor)
+    if entry is None:
+        await get_async_db()
+        try:
+            query = core.uploads_page_query(firestore_collection, limit, cursor)
+        except ValueError as e:
+            return jsonify({"error": str(e)}, 400)
+        try:
+            with core.Span('firestore_read'):
+                docs = [doc async for doc in query.stream()]
+        except Exception as e:
+            print(f"Error obteniendo imágenes de Firestore: {e}")
+            return jsonify({"error": f"No se pudieron obtener las imágenes desde Firestore: {e}"}, 500)
+        rows, next_cursor = core.uploads_page_rows(docs, limit)
+        entry = core.listing_cache.put(limit, cursor, rows, next_cursor)
+
+    headers = {'ETag': f'"{entry["etag"]}"', 'Cache-Control': 'private, no-cache'}
+    if parse_etags(request.headers.get('if-none-match')).contains(entry['etag']):
+        return Response(status=304, headers=headers)
+    response = jsonify({"images": entry['images'], "next_cursor": entry['next_cursor']})
+    response.headers.update(headers)
+    return response
+
+
+ROUTES = {
+    ('POST', '/api/upload/auth'): upload_auth,
+    ('POST', '/api/upload/complete'): upload_complete,
+    ('GET', '/uploads'): list_uploads,
+}
+
+
+# -- Aplicación ASGI ----------------------------------------------------------
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    """WsgiToAsgi ejecuta todas las peticiones en un único hilo (thread_sensitive).
+    Dentro de un ThreadSensitiveContext cada petición tiene su propio hilo, como
+    con un servidor WSGI multihilo; el semáforo limita las simultáneas a
+    ASGI_WSGI_THREADS."""
+
+    def __init__(self, wsgi_application):
+        super().__init__(wsgi_application)
+        self._slots = None
+
+    async def __call__(self, scope, receive, send):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(ASGI_WSGI_THREADS)
+        async with self._slots, ThreadSensitiveContext():
+            await super().__call__(scope, receive, send)
+
+
+async def read_body(receive, limit):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if len(body) > limit:
+            return None
+        if not message.get('more_body'):
+            return bytes(body)
+
+
+async def send_response(send, response):
+    headers = [(name.lower().encode('latin-1'), str(value).encode('latin-1'))
+               for name, value in response.headers.items()]
+    headers.append((b'content-length', str(len(response.body)).encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': response.status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': response.body})
+
+
+class AsyncApplication:
+    def __init__(self, wsgi_app):
+        self.wsgi = ThreadedWsgiToAsgi(wsgi_app)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await b2.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        handler = ROUTES.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+        if handler is None:
+            return await self.wsgi(scope, receive, send)
+
+        started = time.perf_counter()
+        spans = {}
+        core.request_spans.set(spans)
+        body = await read_body(receive, ASGI_MAX_JSON_BODY)
+        if body is None:
+            response = jsonify({"error": "Request body too large"}, 413)
+        else:
+            request = Request(scope, body)
+            try:
+                response = await handler(request)
+            except Exception as e:
+                print(f"[ERROR] {scope['path']} failed: {e}")
+                response = jsonify({"error": str(e)}, 500)
+
+        elapsed = time.perf_counter() - started
+        core.metrics.observe('app_http_request_duration_seconds', elapsed, method=scope['method'],
+                             endpoint=scope['path'], status=str(response.status))
+        if response.status >= 500:
+            core.metrics.inc('app_errors_total', cause='http_5xx')
+        if core.SERVER_TIMING_ENABLED:
+            entries = [f"{name};dur={total * 1000:.1f}" + (f';desc="x{count}"' if count > 1 else '')
+                       for name, (total, count) in spans.items()]
+            entries.append(f"app;dur={elapsed * 1000:.1f}")
+            response.headers['Server-Timing'] = ', '.join(entries)
+        # Misma política CORS que flask_cors en app.py (orígenes reflejados, con credenciales)
+        origin = dict(scope['headers']).get(b'origin')
+        if origin:
+            response.headers['Access-Control-Allow-Origin'] = origin.decode('latin-1')
+            response.headers['Access-Control-Allow-Credentials'] = 'true'
+            response.headers['Vary'] = 'Origin'
+        await send_response(send, response)
+
+
+application = AsyncApplication(core.app)
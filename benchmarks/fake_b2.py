@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+"""
+Servidor HTTP local que imita la API nativa de Backblaze B2.
+
+Implementa lo que usan app.py (vía b2sdk) y el navegador: autorización,
+buckets, URLs de subida, subida de archivos, archivos grandes por partes,
+listado de nombres, borrado y descarga. Por defecto no guarda el contenido
+(solo tamaño y SHA1) para que la memoria del proceso no crezca durante un
+benchmark; con --store-data lo guarda y las descargas devuelven los bytes reales.
+
+Uso:
+    python benchmarks/fake_b2.py --port 8180 [--latency-ms 20] [--store-data]
+
+Luego arrancar la app con B2_REALM=http://127.0.0.1:8180 y
+B2_ENDPOINT=http://127.0.0.1:8180.
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+API_PATH = re.compile(r'^/b2api/v\d+/(b2_\w+)$')
+HEX_DIGITS_AT_END = 'hex_digits_at_end'
+PART_SIZE = 5 * 1024 * 1024
+
+
+class B2Error(Exception):
+    def __init__(self, status, code, message):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+class FakeB2State:
+    """Estado en memoria del servidor (buckets, archivos y archivos grandes)"""
+
+    def __init__(self, base_url, store_data=False):
+        self.base_url = base_url
+        self.store_data = store_data
+        self.lock = threading.Lock()
+        self.account_id = 'fake-account'
+        self.buckets = {}  # nombre -> bucket
+        self.files = {}  # (bucket_id, nombre) -> versión más reciente
+        self.file_ids = {}  # fileId -> versión
+        self.large_files = {}  # fileId -> {'file': ..., 'parts': {n: parte}}
+        self.tokens = set()
+        self._ids = itertools.count(1)
+        self.calls = {}
+
+    def next_id(self, prefix):
+        return f"{prefix}_{next(self._ids):012d}"
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def bucket(self, name):
+        with self.lock:
+            bucket = self.buckets.get(name)
+            if bucket is None:
+                bucket = {
+                    "accountId": self.account_id,
+                    "bucketId": self.next_id('bucket'),
+                    "bucketName": name,
+                    "bucketType": "allPublic",
+                    "bucketInfo": {},
+                    "corsRules": [],
+                    "lifecycleRules": [],
+                    "options": [],
+                    "revision": 1,
+                    "defaultServerSideEncryption": {"isClientAuthorizedToRead": True, "value": {"mode": None}},
+                    "fileLockConfiguration": {"isClientAuthorizedToRead": True,
+                                              "value": {"defaultRetention": {"mode": None, "period": None},
+                                                        "isFileLockEnabled": False}},
+                    "replicationConfiguration": None,
+                }
+                self.buckets[name] = bucket
+            return bucket
+
+    def bucket_by_id(self, bucket_id):
+        for bucket in self.buckets.values():
+            if bucket['bucketId'] == bucket_id:
+                return bucket
+        raise B2Error(400, 'bad_request', f'Invalid bucketId: {bucket_id}')
+
+
+def file_version(state, bucket_id, name, content_type, sha1, length, file_info, action='upload'):
+    return {
+        "accountId": state.account_id,
+        "bucketId": bucket_id,
+        "fileId": state.next_id('4_zfake'),
+        "fileName": name,
+        "contentLength": length,
+        "contentSha1": sha1,
+        "contentMd5": None,
+        "contentType": content_type,
+        "fileInfo": file_info or {},
+        "action": action,
+        "uploadTimestamp": int(time.time() * 1000),
+        "serverSideEncryption": {"mode": "none"},
+        "fileRetention": {"isClientAuthorizedToRead": True, "value": {"mode": None}},
+        "legalHold": {"isClientAuthorizedToRead": True, "value": None},
+        "replicationStatus": None,
+    }
+
+
+def public_version(version):
+    return {k: v for k, v in version.items() if k != '_data'}
+
+
+class FakeB2Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FakeB2/1.0'
+    state = None
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    # -- utilidades -------------------------------------------------------
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _read_upload(self):
+        """Leer el cuerpo de una subida calculando SHA1 sin guardarlo (salvo store_data)"""
+        length = int(self.headers.get('Content-Length') or 0)
+        declared = self.headers.get('X-Bz-Content-Sha1', '')
+        sha1 = hashlib.sha1()
+        data = bytearray() if self.state.store_data or declared == HEX_DIGITS_AT_END else None
+        remaining = length
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            if data is not None:
+                data += chunk
+            else:
+                sha1.update(chunk)
+        if declared == HEX_DIGITS_AT_END:
+            declared = bytes(data[-40:]).decode('ascii')
+            del data[-40:]
+            length -= 40
+            sha1.update(data)
+        elif data is not None:
+            sha1.update(data)
+        actual = sha1.hexdigest()
+        if declared not in ('', 'do_not_verify') and declared != actual:
+            raise B2Error(400, 'bad_request', 'Checksum did not match data received')
+        return length, actual, (bytes(data) if self.state.store_data else None)
+
+    def _check_auth(self):
+        token = self.headers.get('Authorization')
+        if token not in self.state.tokens:
+            raise B2Error(401, 'bad_auth_token', 'Invalid authorization token')
+
+    def _params(self):
+        if self.command == 'GET':
+            query = parse_qs(urlsplit(self.path).query)
+            return {k: v[0] for k, v in query.items()}
+        body = self._read_body()
+        return json.loads(body) if body else {}
+
+    def _dispatch(self):
+        if self.latency:
+            time.sleep(self.latency)
+        path = urlsplit(self.path).path
+        match = API_PATH.match(path)
+        if match:
+            endpoint = match.group(1)
+            handler = getattr(self, endpoint, None)
+            if handler is None:
+                raise B2Error(404, 'not_found', f'Unknown endpoint {endpoint}')
+            self.state.count(endpoint)
+            return self._send_json(200, handler())
+        if path.startswith('/upload/part/'):
+            self.state.count('upload_part')
+            return self._send_json(200, self.upload_part(path.split('/')[3]))
+        if path.startswith('/upload/'):
+            self.state.count('upload_file')
+            return self._send_json(200, self.upload_file(path.split('/')[2]))
+        if path.startswith('/file/'):
+            self.state.count('download_file_by_name')
+            return self.download_file(path)
+        raise B2Error(404, 'not_found', f'Unknown path {path}')
+
+    def _handle(self):
+        try:
+            self._dispatch()
+        except B2Error as e:
+            # El cuerpo puede no haberse leído entero: no reutilizar la conexión
+            self.close_connection = True
+            self._send_json(e.status, {"status": e.status, "code": e.code, "message": e.message})
+        except (KeyError, ValueError) as e:
+            self.close_connection = True
+            self._send_json(400, {"status": 400, "code": "bad_request", "message": str(e)})
+
+    do_GET = _handle
+    do_POST = _handle
+
+    def do_HEAD(self):
+        self._handle()
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', '*')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    # -- API --------------------------------------------------------------
+
+    def b2_authorize_account(self):
+        if self.command == 'POST':
+            self._read_body()
+        state = self.state
+        token = state.next_id('auth')
+        with state.lock:
+            state.tokens.add(token)
+        capabilities = ['listBuckets', 'listFiles', 'readFiles', 'writeFiles', 'deleteFiles',
+                        'readBucketEncryption', 'readFileRetentions', 'readFileLegalHolds']
+        allowed = {"buckets": None, "capabilities": capabilities, "namePrefix": None}
+        return {
+            "accountId": state.account_id,
+            "authorizationToken": token,
+            "apiInfo": {
+                "groupsApi": {},
+                "storageApi": {
+                    "apiUrl": state.base_url,
+                    "downloadUrl": state.base_url,
+                    "recommendedPartSize": PART_SIZE,
+                    "absoluteMinimumPartSize": PART_SIZE,
+                    "s3ApiUrl": state.base_url,
+                    # v4 expone 'allowed'; v3 (b2sdk.v2) lee estos campos sueltos
+                    "allowed": allowed,
+                    "bucketId": None,
+                    "bucketName": None,
+                    "capabilities": capabilities,
+                    "namePrefix": None,
+                },
+            },
+        }
+
+    def b2_list_buckets(self):
+        self._check_auth()
+        params = self._params()
+        name = params.get('bucketName')
+        if name:
+            return {"buckets": [self.state.bucket(name)]}
+        return {"buckets": list(self.state.buckets.values())}
+
+    def b2_get_upload_url(self):
+        self._check_auth()
+        bucket_id = self._params()['bucketId']
+        token = self.state.next_id('upload')
+        with self.state.lock:
+            self.state.tokens.add(token)
+        return {"bucketId": bucket_id, "uploadUrl": f"{self.state.base_url}/upload/{bucket_id}",
+                "authorizationToken": token}
+
+    def upload_file(self, bucket_id):
+        self._check_auth()
+        name = unquote(self.headers['X-Bz-File-Name'])
+        length, sha1, data = self._read_upload()
+        file_info = {k[len('X-Bz-Info-'):].lower(): unquote(v) for k, v in self.headers.items()
+                     if k.lower().startswith('x-bz-info-')}
+        state = self.state
+        with state.lock:
+            version = file_version(state, bucket_id, name, self.headers.get('Content-Type', 'b2/x-auto'),
+                                   sha1, length, file_info)
+            version['_data'] = data
+            state.files[(bucket_id, name)] = version
+            state.file_ids[version['fileId']] = version
+        return public_version(version)
+
+    def b2_start_large_file(self):
+        self._check_auth()
+        params = self._params()
+        state = self.state
+        with state.lock:
+            version = file_version(state, params['bucketId'], params['fileName'],
+                                   params.get('contentType', 'b2/x-auto'), 'none', 0,
+                                   params.get('fileInfo'), action='start')
+            state.large_files[version['fileId']] = {'file': version, 'parts': {}}
+        return public_version(version)
+
+    def b2_get_upload_part_url(self):
+        self._check_auth()
+        file_id = self._params()['fileId']
+        if file_id not in self.state.large_files:
+            raise B2Error(400, 'bad_request', f'No active upload for: {file_id}')
+        token = self.state.next_id('upload')
+        with self.state.lock:
+            self.state.tokens.add(token)
+        return {"fileId": file_id, "uploadUrl": f"{self.state.base_url}/upload/part/{file_id}",
+                "authorizationToken": token}
+
+    def upload_part(self, file_id):
+        self._check_auth()
+        part_number = int(self.headers['X-Bz-Part-Number'])
+        length, sha1, data = self._read_upload()
+        with self.state.lock:
+            large = self.state.large_files.get(file_id)
+            if large is None:
+                raise B2Error(400, 'bad_request', f'No active upload for: {file_id}')
+            large['parts'][part_number] = {"fileId": file_id, "partNumber": part_number,
+                                           "contentLength": length, "contentSha1": sha1,
+                                           "uploadTimestamp": int(time.time() * 1000), "_data": data}
+        return {"fileId": file_id, "partNumber": part_number, "contentLength": length,
+                "contentSha1": sha1, "contentMd5": None,
+                "serverSideEncryption": {"mode": "none"}, "uploadTimestamp": int(time.time() * 1000)}
+
+    def b2_list_parts(self):
+        self._check_auth()
+        params = self._params()
+        start = int(params.get('startPartNumber') or 1)
+        count = int(params.get('maxPartCount') or 100)
+        with self.state.lock:
+            large = self.state.large_files.get(params['fileId'])
+            if large is None:
+                raise B2Error(400, 'bad_request', f"No active upload for: {params['fileId']}")
+            parts = [public_version(large['parts'][n]) for n in sorted(large['parts']) if n >= start]
+        next_part = parts[count]['partNumber'] if len(parts) > count else None
+        return {"parts": parts[:count], "nextPartNumber": next_part}
+
+    def b2_finish_large_file(self):
+        self._check_auth()
+        params = self._params()
+        state = self.state
+        with state.lock:
+            large = state.large_files.pop(params['fileId'], None)
+            if large is None:
+                raise B2Error(400, 'bad_request', f"No active upload for: {params['fileId']}")
+            parts = [large['parts'][n] for n in sorted(large['parts'])]
+            if [p['contentSha1'] for p in parts] != params['partSha1Array']:
+                raise B2Error(400, 'bad_request', 'Part checksums do not match')
+            version = dict(large['file'])
+            version['action'] = 'upload'
+            version['contentLength'] = sum(p['contentLength'] for p in parts)
+            version['_data'] = b''.join(p['_data'] for p in parts) if state.store_data else None
+            state.files[(version['bucketId'], version['fileName'])] = version
+            state.file_ids[version['fileId']] = version
+        return public_version(version)
+
+    def b2_cancel_large_file(self):
+        self._check_auth()
+        file_id = self._params()['fileId']
+        with self.state.lock:
+            large = self.state.large_files.pop(file_id, None)
+        if large is None:
+            raise B2Error(400, 'bad_request', f'No active upload for: {file_id}')
+        version = large['file']
+        return {"accountId": version['accountId'], "bucketId": version['bucketId'],
+                "fileId": file_id, "fileName": version['fileName']}
+
+    def b2_list_file_names(self):
+        self._check_auth()
+        params = self._params()
+        bucket_id = params['bucketId']
+        start = params.get('startFileName') or ''
+        prefix = params.get('prefix') or ''
+        count = int(params.get('maxFileCount') or 100)
+        with self.state.lock:
+            names = sorted(name for (bid, name) in self.state.files
+                           if bid == bucket_id and name >= start and name.startswith(prefix))
+            files = [public_version(self.state.files[(bucket_id, name)]) for name in names[:count + 1]]
+        next_name = files[count]['fileName'] if len(files) > count else None
+        return {"files": files[:count], "nextFileName": next_name}
+
+    def b2_delete_file_version(self):
+        self._check_auth()
+        params = self._params()
+        with self.state.lock:
+            version = self.state.file_ids.pop(params['fileId'], None)
+            if version is None:
+                raise B2Error(400, 'file_not_present', f"File not present: {params['fileName']}")
+            self.state.files.pop((version['bucketId'], version['fileName']), None)
+        return {"fileId": params['fileId'], "fileName": params['fileName']}
+
+    def download_file(self, path):
+        _, _, bucket_name, name = path.split('/', 3)
+        name = unquote(name)
+        bucket = self.state.bucket(bucket_name)
+        version = self.state.files.get((bucket['bucketId'], name))
+        if version is None:
+            raise B2Error(404, 'not_found', f'File not present: {name}')
+        data = version['_data']
+        if data is None:
+            # Sin --store-data: contenido sintético del tamaño correcto
+            data = bytes(version['contentLength'])
+        status = 200
+        start, end = 0, len(data) - 1
+        range_header = self.headers.get('Range')
+        if range_header and range_header.startswith('bytes='):
+            first, _, last = range_header[6:].partition('-')
+            start = int(first) if first else max(0, len(data) - int(last))
+            end = min(int(last), len(data) - 1) if first and last else end
+            status = 206
+        body = data[start:end + 1]
+        self.send_response(status)
+        self.send_header('Content-Type', version['contentType'] or 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('x-bz-file-id', version['fileId'])
+        self.send_header('x-bz-file-name', version['fileName'])
+        self.send_header('x-bz-content-sha1', version['contentSha1'])
+        self.send_header('x-bz-upload-timestamp', str(version['uploadTimestamp']))
+        if status == 206:
+            self.send_header('Content-Range', f"bytes {start}-{end}/{len(data)}")
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+
+def make_server(host='127.0.0.1', port=0, latency_ms=0, store_data=False):
+    """Crear el servidor (sin arrancarlo); la URL base queda en server.base_url"""
+    server = ThreadingHTTPServer((host, port), FakeB2Handler)
+    server.daemon_threads = True
+    base_url = f"http://{host}:{server.server_address[1]}"
+    state = FakeB2State(base_url, store_data=store_data)
+    server.RequestHandlerClass = type('BoundFakeB2Handler', (FakeB2Handler,),
+                                      {'state': state, 'latency': latency_ms / 1000})
+    server.base_url = base_url
+    server.state = state
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Servidor local que imita la API de Backblaze B2')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8180)
+    parser.add_argument('--latency-ms', type=float, default=0, help='latencia añadida a cada llamada')
+    parser.add_argument('--store-data', action='store_true', help='guardar el contenido de los archivos')
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.latency_ms, args.store_data)
+    print(f"Fake B2 escuchando en {server.base_url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+Firestore en memoria para los benchmarks.
+
+Cubre la parte de la API de google-cloud-firestore que usa app.py:
+colecciones, documentos, consultas con order_by/where/start_after/limit,
+WriteBatch (máximo 500 escrituras y atómico, como el real; create y delete
+con precondición), set con merge profundo, Increment y get_all. Las lecturas
+y escrituras se cuentan para poder comparar cuántas operaciones hace cada
+endpoint.
+"""
+import threading
+
+from google.api_core.exceptions import AlreadyExists, NotFound
+
+BATCH_LIMIT = 500
+_OPERATORS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    'in': lambda a, b: a in b,
+}
+
+
+def _resolve(old, new):
+    """Valor de un campo tras escribir `new` (Increment suma al valor anterior)"""
+    if type(new).__name__ == 'Increment':
+        return (old if isinstance(old, (int, float)) else 0) + new.value
+    if isinstance(new, dict):
+        return {key: _resolve(None, value) for key, value in new.items()}
+    return new
+
+
+def _merge(old, new):
+    """set(merge=True): los mapas se combinan campo a campo"""
+    merged = dict(old)
+    for key, value in new.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = _resolve(merged.get(key), value)
+    return merged
+
+
+class ExistsOption:
+    def __init__(self, exists):
+        self.exists = exists
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class DocumentReference:
+    def __init__(self, collection, doc_id):
+        self._collection = collection
+        self.id = doc_id
+
+    @property
+    def path(self):
+        return f"{self._collection.id}/{self.id}"
+
+    def get(self):
+        db = self._collection._db
+        with db.lock:
+            db.reads += 1
+            data = self._collection._docs.get(self.id)
+            return DocumentSnapshot(self, dict(data) if data is not None else None)
+
+    def create(self, data):
+        db = self._collection._db
+        with db.lock:
+            db.writes += 1
+            self._apply_create(data)
+
+    def set(self, data, merge=False):
+        db = self._collection._db
+        with db.lock:
+            db.writes += 1
+            self._apply_set(data, merge)
+
+    def update(self, data):
+        db = self._collection._db
+        with db.lock:
+            db.writes += 1
+            self._apply_update(data)
+
+    def delete(self):
+        db = self._collection._db
+        with db.lock:
+            db.writes += 1
+            self._collection._docs.pop(self.id, None)
+
+    def _check_create(self):
+        if self.id in self._collection._docs:
+            raise AlreadyExists(f"Document already exists: {self.path}")
+
+    def _apply_create(self, data):
+        self._check_create()
+        self._apply_set(data)
+
+    def _apply_set(self, data, merge=False):
+        docs = self._collection._docs
+        if merge and self.id in docs:
+            docs[self.id] = _merge(docs[self.id], data)
+        else:
+            docs[self.id] = _merge({}, data)
+
+    def _check_update(self):
+        if self.id not in self._collection._docs:
+            raise NotFound(f"No document to update: {self.path}")
+
+    def _apply_update(self, data):
+        self._check_update()
+        docs = self._collection._docs
+        docs[self.id].update({key: _resolve(docs[self.id].get(key), value) for key, value in data.items()})
+
+    def _check_delete(self, option):
+        if option is not None and option.exists and self.id not in self._collection._docs:
+            raise NotFound(f"No document to delete: {self.path}")
+
+
+class Query:
+    def __init__(self, collection, orders=(), filters=(), after=None, limit=None):
+        self._collection = collection
+        self._orders = tuple(orders)
+        self._filters = tuple(filters)
+        self._after = after
+        self._limit = limit
+
+    def _copy(self, **changes):
+        values = dict(orders=self._orders, filters=self._filters, after=self._after, limit=self._limit)
+        values.update(changes)
+        return Query(self._collection, **values)
+
+    def order_by(self, field, direction='ASCENDING'):
+        return self._copy(orders=self._orders + ((field, direction),))
+
+    def where(self, field, op, value):
+        return self._copy(filters=self._filters + ((field, op, value),))
+
+    def start_after(self, values):
+        if isinstance(values, dict):
+            values = [values.get(field) for field, _ in self._orders]
+        return self._copy(after=list(values))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def select(self, fields):
+        return self
+
+    @staticmethod
+    def _value(doc_id, data, field):
+        return doc_id if field == '__name__' else data.get(field)
+
+    def _compare(self, a, b):
+        """Comparar dos tuplas de valores de ordenación según la dirección de cada campo"""
+        for (_, direction), x, y in zip(self._orders, a, b):
+            if x == y:
+                continue
+            result = -1 if x < y else 1
+            return -result if direction == 'DESCENDING' else result
+        return 0
+
+    def stream(self):
+        db = self._collection._db
+        with db.lock:
+            rows = [(doc_id, dict(data)) for doc_id, data in self._collection._docs.items()
+                    if all(field in data or field == '__name__' for field, _, _ in self._filters)
+                    and all(_OPERATORS[op](self._value(doc_id, data, field), value)
+                            for field, op, value in self._filters)]
+            for field, direction in reversed(self._orders):
+                rows = [row for row in rows if field == '__name__' or field in row[1]]
+                rows.sort(key=lambda row: self._value(row[0], row[1], field),
+                          reverse=direction == 'DESCENDING')
+            if self._after is not None:
+                rows = [row for row in rows
+                        if self._compare([self._value(row[0], row[1], f) for f, _ in self._orders],
+                                         self._after) > 0]
+            if self._limit is not None:
+                rows = rows[:self._limit]
+            db.reads += max(len(rows), 1)
+            return [DocumentSnapshot(DocumentReference(self._collection, doc_id), data)
+                    for doc_id, data in rows]
+
+    def get(self):
+        return self.stream()
+
+
+class CollectionReference(Query):
+    def __init__(self, db, collection_id):
+        super().__init__(self)
+        self._db = db
+        self.id = collection_id
+        self._docs = {}
+
+    def document(self, doc_id):
+        return DocumentReference(self, doc_id)
+
+    def __len__(self):
+        return len(self._docs)
+
+
+class WriteBatch:
+    def __init__(self, db):
+        self._db = db
+        self._checks = []
+        self._ops = []
+
+    def _add(self, op, check=None):
+        if len(self._ops) >= BATCH_LIMIT:
+            raise ValueError(f"Maximum {BATCH_LIMIT} writes allowed per request")
+        self._ops.append(op)
+        if check is not None:
+            self._checks.append(check)
+
+    def create(self, reference, data):
+        self._add(lambda: reference._apply_set(data), reference._check_create)
+
+    def set(self, reference, data, merge=False):
+        self._add(lambda: reference._apply_set(data, merge))
+
+    def update(self, reference, data):
+        self._add(lambda: reference._apply_update(data), reference._check_update)
+
+    def delete(self, reference, option=None):
+        self._add(lambda: reference._collection._docs.pop(reference.id, None),
+                  lambda: reference._check_delete(option))
+
+    def commit(self):
+        with self._db.lock:
+            # Todas las precondiciones antes de escribir nada: el lote es atómico
+            for check in self._checks:
+                check()
+            for op in self._ops:
+                op()
+            self._db.writes += len(self._ops)
+            self._db.commits += 1
+        self._ops = []
+        self._checks = []
+
+
+class FakeFirestore:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._collections = {}
+        self.reads = 0
+        self.writes = 0
+        self.commits = 0
+
+    def collection(self, collection_id):
+        with self.lock:
+            if collection_id not in self._collections:
+                self._collections[collection_id] = CollectionReference(self, collection_id)
+            return self._collections[collection_id]
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def get_all(self, references, field_paths=None):
+        return [reference.get() for reference in references]
+
+    def write_option(self, exists):
+        return ExistsOption(exists)
+
+    def stats(self):
+        with self.lock:
+            return {"reads": self.reads, "writes": self.writes, "commits": self.commits}
+
+
+def install(app_module, db=None):
+    """Sustituir el cliente de Firestore de app.py por uno en memoria"""
+    db = db or FakeFirestore()
+    app_module.firestore_db = db
+    app_module.firestore_collection = db.collection('uploads')
+    app_module.hash_index_collection = db.collection(app_module.HASH_INDEX_COLLECTION)
+    app_module.stats_collection = db.collection(app_module.STATS_COLLECTION)
+    return db
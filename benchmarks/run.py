@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+"""
+Benchmark de la app contra B2 y Firestore locales.
+
+Arranca benchmarks/fake_b2.py en otro proceso (para que su memoria no cuente
+en el RSS de la app), sustituye Firestore por el fake en memoria, sirve la app
+con el servidor WSGI multihilo de werkzeug y la ataca con N hilos cliente.
+El resultado es un JSON con, por escenario y endpoint: peticiones, errores,
+throughput, latencias p50/p95/p99 y pico de RSS del proceso de la app.
+
+Uso:
+    python benchmarks/run.py --concurrency 8 --requests 200 \\
+        --sizes 64KB,1MB,8MB --collection-size 10000 --output results.json
+
+Escenarios: list, list_deep, search, upload, direct (por defecto, todos).
+"""
+import argparse
+import contextlib
+import hashlib
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlencode, urlsplit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import fake_firestore  # noqa: E402
+
+SCENARIOS = ('list', 'list_deep', 'search', 'upload', 'direct')
+SEARCH_WORDS = ('product', 'shoe', 'red', 'blue', 'banner', 'logo', 'hero', 'shirt', 'cap', 'mug')
+PASSWORD = 'benchmark'
+BUCKET = 'bench-bucket'
+
+
+def parse_size(text):
+    """'64KB' / '1MB' / '512' -> bytes"""
+    text = text.strip().upper()
+    for suffix, factor in (('GB', 1024 ** 3), ('MB', 1024 ** 2), ('KB', 1024), ('B', 1)):
+        if text.endswith(suffix):
+            return int(float(text[:-len(suffix)]) * factor)
+    return int(text)
+
+
+def format_size(size):
+    for suffix, factor in (('MB', 1024 ** 2), ('KB', 1024)):
+        if size >= factor and size % factor == 0:
+            return f"{size // factor}{suffix}"
+    return f"{size}B"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"El fake de B2 no arrancó en el puerto {port}")
+
+
+def current_rss():
+    """RSS actual del proceso en bytes (pico histórico si no hay /proc)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class RssSampler:
+    """Muestrear el RSS en segundo plano y quedarse con el máximo"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def percentile(sorted_values, pct):
+    """Percentil por rango más cercano"""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+class Recorder:
+    """Latencias y errores por endpoint"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, endpoint, seconds, ok):
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(seconds * 1000)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, wall_seconds, peak_rss):
+        endpoints = {}
+        for endpoint, values in self.latencies.items():
+            values = sorted(values)
+            endpoints[endpoint] = {
+                "requests": len(values),
+                "errors": self.errors.get(endpoint, 0),
+                "throughput_rps": round(len(values) / wall_seconds, 2) if wall_seconds else None,
+                "latency_ms": {
+                    "p50": round(percentile(values, 50), 2),
+                    "p95": round(percentile(values, 95), 2),
+                    "p99": round(percentile(values, 99), 2),
+                    "mean": round(sum(values) / len(values), 2),
+                    "max": round(values[-1], 2),
+                },
+                "peak_rss_mb": round(peak_rss / 1024 / 1024, 1),
+            }
+        return endpoints
+
+
+class Client:
+    """Cliente HTTP con una conexión keep-alive por hilo y host"""
+
+    def __init__(self, base_url, recorder):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.cookie = None
+        self._local = threading.local()
+
+    def _connection(self, netloc):
+        conns = getattr(self._local, 'conns', None)
+        if conns is None:
+            conns = self._local.conns = {}
+        if netloc not in conns:
+            conns[netloc] = http.client.HTTPConnection(netloc, timeout=120)
+        return conns[netloc]
+
+    def request(self, method, url, body=None, headers=None, endpoint=None):
+        """Hacer una petición y registrar su latencia; devuelve (status, cabeceras, cuerpo)"""
+        if url.startswith('/'):
+            url = self.base_url + url
+        parts = urlsplit(url)
+        path = parts.path + (f"?{parts.query}" if parts.query else '')
+        headers = dict(headers or {})
+        if self.cookie and parts.netloc == urlsplit(self.base_url).netloc:
+            headers['Cookie'] = self.cookie
+        started = time.perf_counter()
+        for attempt in (1, 2):
+            conn = self._connection(parts.netloc)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                self._local.conns.pop(parts.netloc, None)
+                if attempt == 2:
+                    self.recorder.record(endpoint or f"{method} {parts.path}", time.perf_counter() - started, False)
+                    raise
+        if endpoint:
+            self.recorder.record(endpoint, time.perf_counter() - started, response.status < 400)
+        return response.status, response.headers, data
+
+    def json(self, method, url, payload=None, endpoint=None):
+        body = json.dumps(payload).encode('utf-8') if payload is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        status, _, data = self.request(method, url, body, headers, endpoint)
+        return status, json.loads(data) if data else None
+
+    def login(self):
+        body = urlencode({'password': PASSWORD})
+        status, headers, _ = self.request('POST', '/login', body,
+                                          {'Content-Type': 'application/x-www-form-urlencoded'})
+        cookie = headers.get('Set-Cookie')
+        if status != 302 or not cookie:
+            raise RuntimeError(f"No se pudo iniciar sesión en la app (status {status})")
+        self.cookie = cookie.split(';', 1)[0]
+
+
+def unique_payload(base):
+    """Contenido distinto en cada subida para que la deduplicación no la evite"""
+    return uuid.uuid4().bytes + base[16:]
+
+
+def multipart_body(field, filename, data, content_type='image/png'):
+    boundary = uuid.uuid4().hex
+    head = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n').encode('utf-8')
+    tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+    return head + data + tail, f'multipart/form-data; boundary={boundary}'
+
+
+# -- escenarios --------------------------------------------------------------
+
+def op_list(client, ctx, i):
+    client.request('GET', '/uploads?limit=50', endpoint='GET /uploads')
+
+
+def op_list_deep(client, ctx, i):
+    cursor = ctx['cursors'][i % len(ctx['cursors'])] if ctx['cursors'] else None
+    query = urlencode({'limit': 50, **({'cursor': cursor} if cursor else {})})
+    client.request('GET', f'/uploads?{query}', endpoint='GET /uploads?cursor')
+
+
+def op_search(client, ctx, i):
+    query = urlencode({'q': random.choice(SEARCH_WORDS), 'limit': 50})
+    client.request('GET', f'/api/uploads/search?{query}', endpoint='GET /api/uploads/search')
+
+
+def make_op_upload(size, base):
+    label = format_size(size)
+
+    def op(client, ctx, i):
+        body, content_type = multipart_body('file', f'bench-{i}.png', unique_payload(base))
+        client.request('POST', '/upload', body, {'Content-Type': content_type},
+                       endpoint=f'POST /upload [{label}]')
+    return op
+
+
+def make_op_direct(size, base):
+    label = format_size(size)
+
+    def op(client, ctx, i):
+        started = time.perf_counter()
+        data = unique_payload(base)
+        sha1 = hashlib.sha1(data).hexdigest()
+        status, auth = client.json('POST', '/api/upload/auth', {'filename': f'bench-{i}.png', 'sha1': sha1},
+                                   endpoint=f'POST /api/upload/auth [{label}]')
+        if status != 200:
+            raise RuntimeError(f"auth {status}: {auth}")
+        headers = dict(auth['headers'], **{'Content-Type': 'image/png'})
+        status, _, body = client.request('POST', auth['upload_url'], data, headers,
+                                         endpoint=f'POST b2 upload_file [{label}]')
+        if status != 200:
+            raise RuntimeError(f"B2 {status}: {body[:200]}")
+        status, _ = client.json('POST', '/api/upload/complete', {
+            'b2_filename': auth['b2_filename'],
+            'original_filename': f'bench-{i}.png',
+            'lease_id': auth.get('lease_id'),
+            'sha1': sha1,
+        }, endpoint=f'POST /api/upload/complete [{label}]')
+        client.recorder.record(f'direct upload total [{label}]', time.perf_counter() - started, status == 200)
+    return op
+
+
+def run_scenario(client, ctx, op, requests, concurrency, warmup):
+    """Ejecutar una operación `requests` veces con `concurrency` hilos"""
+    recorder = Recorder()
+    client.recorder = Recorder()
+    for i in range(warmup):
+        op(client, ctx, -1 - i)
+    client.recorder = recorder
+    db_before = ctx['db'].stats()
+    failures = []
+
+    def task(i):
+        try:
+            op(client, ctx, i)
+        except Exception as e:
+            failures.append(str(e))
+
+    with RssSampler() as sampler:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(task, range(requests)))
+        wall = time.perf_counter() - started
+    db_after = ctx['db'].stats()
+    return {
+        "operations": requests,
+        "failures": len(failures),
+        "failure_sample": failures[:3],
+        "wall_seconds": round(wall, 3),
+        "throughput_ops": round(requests / wall, 2) if wall else None,
+        "peak_rss_mb": round(sampler.peak / 1024 / 1024, 1),
+        "firestore": {key: db_after[key] - db_before[key] for key in db_after},
+        "endpoints": recorder.report(wall, sampler.peak),
+    }
+
+
+def seed_collection(app_module, db, count):
+    """Rellenar la colección de subidas con `count` registros sintéticos"""
+    collection = db.collection('uploads')
+    start = datetime(2024, 1, 1)
+    batch = db.batch()
+    pending = 0
+    for i in range(count):
+        name = f"{random.choice(SEARCH_WORDS)}-{random.choice(SEARCH_WORDS)}-{i}.png"
+        b2_filename = f"{app_module.B2_PREFIX}{name[:-4]}-{i:012x}.png"
+        batch.set(collection.document(b2_filename), {
+            "filename": name,
+            "url": app_module.get_public_url(b2_filename),
+            "timestamp": (start + timedelta(seconds=i * 37)).isoformat(),
+            "b2_filename": b2_filename,
+            "bytes": 100 * 1024,
+        })
+        pending += 1
+        if pending == fake_firestore.BATCH_LIMIT:
+            batch.commit()
+            batch, pending = db.batch(), 0
+    if pending:
+        batch.commit()
+
+
+def collect_cursors(client, pages):
+    cursors = []
+    cursor = None
+    for _ in range(pages):
+        query = urlencode({'limit': 50, **({'cursor': cursor} if cursor else {})})
+        _, data = client.json('GET', f'/uploads?{query}')
+        cursor = data.get('next_cursor')
+        if not cursor:
+            break
+        cursors.append(cursor)
+    return cursors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de la app con B2 y Firestore locales')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help='operaciones por escenario')
+    parser.add_argument('--warmup', type=int, default=5, help='operaciones de calentamiento (no cuentan)')
+    parser.add_argument('--sizes', default='64KB,1MB,8MB', help='tamaños de archivo para upload/direct')
+    parser.add_argument('--collection-size', type=int, default=10000, help='registros previos en Firestore')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--b2-latency-ms', type=float, default=0, help='latencia añadida por el fake de B2')
+    parser.add_argument('--output', help='archivo JSON de salida (por defecto, stdout)')
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"escenarios desconocidos: {', '.join(sorted(unknown))}")
+    sizes = [parse_size(size) for size in args.sizes.split(',') if size.strip()]
+
+    b2_port = free_port()
+    b2_process = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, 'fake_b2.py'), '--port', str(b2_port),
+         '--latency-ms', str(args.b2_latency_ms)],
+        stdout=subprocess.DEVNULL,
+    )
+    real_stdout = sys.stdout
+    try:
+        wait_for_port(b2_port)
+        b2_url = f"http://127.0.0.1:{b2_port}"
+        os.environ.update({
+            'B2_REALM': b2_url,
+            'B2_ENDPOINT': b2_url,
+            'B2_APPLICATION_KEY_ID': 'bench-key-id',
+            'B2_APPLICATION_KEY': 'bench-key',
+            'B2_BUCKET_NAME': BUCKET,
+            'APP_PASSWORD': PASSWORD,
+            'SECRET_KEY': 'benchmark-secret',
+        })
+        # La app escribe trazas con print(); el JSON tiene que quedar limpio en stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            results = run(args, scenarios, sizes)
+    finally:
+        b2_process.terminate()
+        b2_process.wait()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output, file=real_stdout)
+
+
+def run(args, scenarios, sizes):
+    from werkzeug.serving import make_server
+
+    import app as app_module
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    # Los cuerpos de prueba no son imágenes y la cola de metadatos competiría por
+    # CPU con las peticiones medidas (y seguiría leyendo del fake de B2 al cerrarlo)
+    app_module.image_metadata.enabled = False
+    db = fake_firestore.install(app_module)
+    seed_collection(app_module, db, args.collection_size)
+
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = Client(f"http://127.0.0.1:{server.server_port}", Recorder())
+    client.login()
+
+    ctx = {'db': db, 'cursors': collect_cursors(client, 20) if 'list_deep' in scenarios else []}
+    ops = []
+    for name in scenarios:
+        if name == 'list':
+            ops.append(('list', op_list))
+        elif name == 'list_deep':
+            ops.append(('list_deep', op_list_deep))
+        elif name == 'search':
+            ops.append(('search', op_search))
+        else:
+            for size in sizes:
+                factory = make_op_upload if name == 'upload' else make_op_direct
+                ops.append((f"{name} [{format_size(size)}]", factory(size, os.urandom(size))))
+
+    results = {
+        "started_at": datetime.now().isoformat(),
+        "config": {
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "sizes": [format_size(size) for size in sizes],
+            "collection_size": args.collection_size,
+            "b2_latency_ms": args.b2_latency_ms,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "scenarios": {},
+    }
+    try:
+        for name, op in ops:
+            print(f"Escenario {name}...", file=sys.stderr)
+            results["scenarios"][name] = run_scenario(client, ctx, op, args.requests,
+                                                      args.concurrency, args.warmup)
+    finally:
+        server.shutdown()
+    results["app_stats"] = {
+        "b2_session": app_module.b2_session.stats(),
+        "upload_url_pool": app_module.upload_url_pool.stats(),
+        "listing_cache": app_module.listing_cache.stats(),
+        "search_index": app_module.search_index.stats(),
+        "hash_index": app_module.hash_index.stats(),
+    }
+    return results
+
+
+if __name__ == '__main__':
+    main()
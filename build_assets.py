@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Construir los assets de las plantillas en static/dist antes de desplegar.
+
+Cada archivo que pide una plantilla con asset_url('...') se escribe como
+static/dist/<ruta>.<huella>.<ext>, junto con sus variantes .gz y .br (gzip 9 y
+brotli 11, demasiado lentos para hacerlos en una petición o al importar).
+static/dist/manifest.json le dice a app.py qué hay: al importar solo lee esos
+archivos. En Vercel el CDN sirve static/ directamente; fuera, /assets/ los
+sirve desde memoria sin comprimir nada.
+
+La salida se versiona con el código (el build de @vercel/python no ejecuta
+comandos propios), así que hay que volver a ejecutarlo cuando cambia un asset.
+Si se olvida no se rompe nada: app.py descarta las entradas cuya huella ya no
+coincide con el archivo de origen y construye esos assets en memoria.
+
+Uso:
+    python build_assets.py
+    python build_assets.py --brotli-quality 9
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+
+import app
+
+# Sufijo en disco de cada variante comprimida
+ENCODING_SUFFIXES = {'gzip': '.gz', 'br': '.br'}
+
+
+def template_assets(folder):
+    """Rutas de static/ que piden las plantillas con asset_url('...')"""
+    paths = set()
+    for name in os.listdir(folder):
+        if name.endswith('.html'):
+            with open(os.path.join(folder, name), encoding='utf-8') as f:
+                paths.update(re.findall(r"asset_url\(\s*'([^']+)'\s*\)", f.read()))
+    return sorted(paths)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Construir los assets con huella en static/dist')
+    parser.add_argument('--brotli-quality', type=int, default=11,
+                        help='calidad de brotli (0-11, por defecto 11)')
+    args = parser.parse_args()
+
+    if not app.BROTLI_AVAILABLE:
+        print("brotli no está instalado: solo se generan las variantes gzip")
+
+    dist = os.path.join(app.assets.root, app.ASSET_DIST_DIR)
+    shutil.rmtree(dist, ignore_errors=True)
+    manifest = {}
+    for path in template_assets(os.path.join(app.BASE_DIR, 'templates')):
+        entry = app.assets.build(path, brotli_quality=args.brotli_quality)
+        target = os.path.join(dist, entry['name'])
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        for encoding, body in entry['variants'].items():
+            with open(target + ENCODING_SUFFIXES.get(encoding, ''), 'wb') as f:
+                f.write(body)
+        manifest[path] = {
+            'name': entry['name'],
+            'digest': entry['digest'],
+            'mimetype': entry['mimetype'],
+            'encodings': {encoding: ENCODING_SUFFIXES[encoding]
+                          for encoding in entry['variants'] if encoding != 'identity'},
+        }
+        sizes = ', '.join(f"{encoding}={len(body)}" for encoding, body in entry['variants'].items())
+        print(f"{path} -> {app.ASSET_DIST_DIR}/{entry['name']} ({sizes})")
+
+    with open(os.path.join(dist, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.write('\n')
+    print(f"{len(manifest)} assets en static/{app.ASSET_DIST_DIR}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Procesamiento de imágenes con Pillow.
+
+Funciones puras (bytes de entrada, bytes de salida) pensadas para ejecutarse
+en un ProcessPoolExecutor: este módulo no importa app.py, así que los procesos
+del pool no cargan Flask, Firebase ni B2.
+"""
+import io
+import math
+
+from PIL import Image, ImageOps
+
+
+def _fit_within(image, max_dimension):
+    """Reducir la imagen para que ningún lado supere max_dimension (0 = sin límite)"""
+    if max_dimension and max(image.size) > max_dimension:
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        return True
+    return False
+
+
+def transcode_to_webp(data, quality=85, max_dimension=0):
+    """Convertir una imagen a WebP.
+
+    Devuelve (bytes_webp, ancho, alto), o None si conviene conservar el
+    original: ya es WebP dentro del tamaño máximo, es un GIF animado, o el
+    resultado no es más pequeño.
+    """
+    image = Image.open(io.BytesIO(data))
+    if getattr(image, 'is_animated', False):
+        return None
+    if image.format == 'WEBP' and not (max_dimension and max(image.size) > max_dimension):
+        return None
+
+    # Aplicar la orientación EXIF antes de descartar los metadatos
+    image = ImageOps.exif_transpose(image)
+    resized = _fit_within(image, max_dimension)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+
+    output = io.BytesIO()
+    image.save(output, format='WEBP', quality=quality, method=4)
+    encoded = output.getvalue()
+    if not resized and len(encoded) >= len(data):
+        return None
+    return encoded, image.width, image.height
+
+
+def make_thumbnail(data, width, fmt='webp', quality=80):
+    """Miniatura de `width` px de ancho (sin ampliar) en WebP o JPEG.
+
+    En JPEG, draft decodifica directamente a escala reducida; los GIF animados
+    se quedan con el primer fotograma. Devuelve (bytes, ancho, alto).
+    """
+    image = Image.open(io.BytesIO(data))
+    # El alto se limita para que una imagen muy estrecha no genere una miniatura enorme
+    box = (width, width * 4)
+    image.draft('RGB', box)
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail(box, Image.LANCZOS)
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+    if fmt == 'jpeg':
+        if has_alpha:
+            rgba = image.convert('RGBA')
+            image = Image.new('RGB', rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.getchannel('A'))
+        else:
+            image = image.convert('RGB')
+        options = {'quality': quality, 'optimize': True, 'progressive': True}
+    else:
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+        options = {'quality': quality, 'method': 4}
+
+    output = io.BytesIO()
+    image.save(output, format=fmt.upper(), **options)
+    return output.getvalue(), image.width, image.height
+
+
+# Orientaciones EXIF que giran la imagen 90º (intercambian ancho y alto)
+_ROTATED_ORIENTATIONS = (5, 6, 7, 8)
+_BASE83 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+
+
+def image_metadata(data, placeholder=True):
+    """Dimensiones y tipo MIME de una imagen y, con placeholder=True, su color
+    dominante y blurhash.
+
+    Sin placeholder basta con la cabecera del archivo: Pillow lee el tamaño sin
+    decodificar los píxeles. Para el placeholder se decodifica a escala
+    reducida (draft en JPEG) y se trabaja sobre una miniatura de 32px.
+    """
+    image = Image.open(io.BytesIO(data))
+    width, height = image.size
+    if image.getexif().get(0x0112, 1) in _ROTATED_ORIENTATIONS:
+        width, height = height, width
+    metadata = {"width": width, "height": height, "mime": Image.MIME.get(image.format)}
+    if not placeholder:
+        return metadata
+
+    image.draft('RGB', (64, 64))
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        # Las zonas transparentes se ven sobre fondo blanco
+        rgba = image.convert('RGBA')
+        image = Image.new('RGB', rgba.size, (255, 255, 255))
+        image.paste(rgba, mask=rgba.getchannel('A'))
+    else:
+        image = image.convert('RGB')
+    image.thumbnail((32, 32))
+    metadata["color"] = dominant_color(image)
+    metadata["blurhash"] = blurhash_encode(image)
+    return metadata
+
+
+def dominant_color(image, colors=5):
+    """Color más frecuente tras reducir la paleta, como '#rrggbb'"""
+    quantized = image.quantize(colors=colors)
+    palette = quantized.getpalette()
+    _, index = max(quantized.getcolors())
+    r, g, b = palette[index * 3:index * 3 + 3]
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+
+def _base83(value, length):
+    return ''.join(_BASE83[(value // 83 ** (length - i - 1)) % 83] for i in range(length))
+
+
+def _srgb_to_linear(value):
+    v = value / 255
+    return v / 12.92 if v <= 0.04045 else ((v + 0.055) / 1.055) ** 2.4
+
+
+def _linear_to_srgb(value):
+    v = max(0.0, min(1.0, value))
+    if v <= 0.0031308:
+        return int(v * 12.92 * 255 + 0.5)
+    return int((1.055 * v ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def _sign_pow(value, exponent):
+    return math.copysign(abs(value) ** exponent, value)
+
+
+def blurhash_encode(image, components_x=4, components_y=3):
+    """Codificar una imagen RGB pequeña como blurhash (https://blurha.sh)"""
+    width, height = image.size
+    pixels = [tuple(_srgb_to_linear(c) for c in pixel) for pixel in image.getdata()]
+    cos_x = [[math.cos(math.pi * i * x / width) for x in range(width)] for i in range(components_x)]
+    cos_y = [[math.cos(math.pi * j * y / height) for y in range(height)] for j in range(components_y)]
+
+    factors = []
+    for j in range(components_y):
+        for i in range(components_x):
+            normalisation = 1 if i == 0 and j == 0 else 2
+            r = g = b = 0.0
+            for y in range(height):
+                row = y * width
+                basis_y = normalisation * cos_y[j][y]
+                for x in range(width):
+                    basis = basis_y * cos_x[i][x]
+                    pr, pg, pb = pixels[row + x]
+                    r += basis * pr
+                    g += basis * pg
+                    b += basis * pb
+            scale = 1 / (width * height)
+            factors.append((r * scale, g * scale, b * scale))
+
+    dc, ac = factors[0], factors[1:]
+    result = _base83((components_x - 1) + (components_y - 1) * 9, 1)
+    if ac:
+        actual_max = max(abs(c) for factor in ac for c in factor)
+        quantised_max = max(0, min(82, int(math.floor(actual_max * 166 - 0.5))))
+        max_value = (quantised_max + 1) / 166
+        result += _base83(quantised_max, 1)
+    else:
+        max_value = 1
+        result += _base83(0, 1)
+    result += _base83((_linear_to_srgb(dc[0]) << 16) + (_linear_to_srgb(dc[1]) << 8) + _linear_to_srgb(dc[2]), 4)
+
+    def quantise(value):
+        return max(0, min(18, int(math.floor(_sign_pow(value / max_value, 0.5) * 9 + 9.5))))
+
+    for r, g, b in ac:
+        result += _base83(quantise(r) * 19 * 19 + quantise(g) * 19 + quantise(b), 2)
+    return result
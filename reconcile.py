@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+"""
+Reconciliar el bucket de B2 con la colección 'uploads' de Firestore.
+
+- Huérfanos: archivos bajo B2_PREFIX sin registro (su /api/upload/complete
+  nunca llegó). Con --import se crean sus registros con escrituras por lotes.
+- Colgantes: registros cuyo archivo ya no está en B2. Con --delete se borran.
+- Con --rebuild-stats no se cruza nada: se recorre la colección entera y se
+  reescriben las estadísticas de la galería (para crearlas la primera vez o
+  corregir una deriva). Las subidas que lleguen durante el recorrido pueden
+  quedar contadas dos veces o ninguna: mejor con poco tráfico.
+
+Los documentos usan el b2_filename como ID, así que las dos fuentes se leen
+ordenadas por nombre y se cruzan en streaming (merge join): la memoria solo
+depende de las páginas en vuelo, no del tamaño del bucket. El listado de B2 se
+reparte en rangos de nombres consecutivos que se piden en paralelo.
+
+Uso:
+    python reconcile.py                         # solo informe
+    python reconcile.py --import --delete       # corregir las diferencias
+    python reconcile.py --report diff.jsonl --concurrency 16
+    python reconcile.py --rebuild-stats
+"""
+import argparse
+import functools
+import json
+import queue
+import re
+import resource
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import app
+
+# Caracteres que deja secure_filename, en orden: sirven para partir el espacio
+# de nombres en rangos (el reparto es aproximado; la corrección no depende de él)
+SHARD_ALPHABET = '-.0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+# Sufijo que añade generate_b2_filename: "<nombre>-<12 hex>.<ext>"
+UNIQUE_SUFFIX = re.compile(r'-[0-9a-f]{12}$')
+
+B2File = namedtuple('B2File', 'name size sha1 uploaded_ms')
+Record = namedtuple('Record', 'name sha1 timestamp')
+
+_DONE = object()
+
+
+def shard_bounds(prefix, shards):
+    """Partir los nombres bajo prefix en `shards` rangos [inicio, fin) consecutivos"""
+    size = len(SHARD_ALPHABET)
+    cuts = []
+    for i in range(1, shards):
+        position = i * size * size // shards
+        cut = prefix + SHARD_ALPHABET[position // size] + SHARD_ALPHABET[position % size]
+        if not cuts or cut > cuts[-1]:
+            cuts.append(cut)
+    starts = [prefix] + cuts
+    return list(zip(starts, cuts + [None]))
+
+
+class Prefetch:
+    """Recorrer un generador de páginas en otro hilo, con como mucho `depth` páginas por delante"""
+
+    def __init__(self, executor, pages, depth, stop):
+        self._queue = queue.Queue(depth)
+        self._stop = stop
+        executor.submit(self._run, pages)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self, pages):
+        try:
+            for page in pages:
+                if not self._put(page):
+                    return
+            self._put(_DONE)
+        except Exception as e:
+            self._put(e)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield from item
+
+
+def b2_pages(prefix, start, end, page_size):
+    """Páginas de list_file_names para los nombres de [start, end)"""
+    while True:
+        response = app.b2_session.call(
+            lambda b: b.api.session.list_file_names(b.id_, start, page_size, prefix))
+        page = []
+        for info in response['files']:
+            if end is not None and info['fileName'] >= end:
+                yield page
+                return
+            # Solo versiones subidas (no marcadores de ocultación ni carpetas)
+            if info.get('action', 'upload') == 'upload':
+                page.append(B2File(info['fileName'], info.get('contentLength'),
+                                   info.get('contentSha1'), info.get('uploadTimestamp')))
+        yield page
+        start = response.get('nextFileName')
+        if start is None:
+            return
+
+
+def list_b2_files(executor, prefix, shards, concurrency, page_size, depth, stop):
+    """Todos los archivos bajo prefix en orden de nombre.
+
+    Se leen a la vez hasta `concurrency` rangos: el que se está consumiendo y
+    los siguientes, cada uno con como mucho `depth` páginas adelantadas.
+    """
+    bounds = deque(shard_bounds(prefix, shards))
+    active = deque()
+    while bounds or active:
+        while bounds and len(active) < concurrency:
+            start, end = bounds.popleft()
+            active.append(Prefetch(executor, b2_pages(prefix, start, end, page_size), depth, stop))
+        yield from active.popleft()
+
+
+def firestore_pages(prefix, page_size):
+    """Páginas de registros cuyo ID empieza por prefix, en orden de ID"""
+    app.get_firestore_db()
+    query = app.firestore_collection.order_by('__name__').select(['sha1', 'timestamp'])
+    last = prefix
+    while True:
+        docs = list(query.start_after([last]).limit(page_size).stream())
+        page = []
+        for doc in docs:
+            if not doc.id.startswith(prefix):
+                yield page
+                return
+            data = doc.to_dict() or {}
+            page.append(Record(doc.id, data.get('sha1'), data.get('timestamp', '')))
+        yield page
+        if len(docs) < page_size:
+            return
+        last = docs[-1].id
+
+
+def stats_pages(page_size):
+    """Páginas de todos los registros con los campos de las estadísticas, en orden de ID"""
+    app.get_firestore_db()
+    query = app.firestore_collection.order_by('__name__').select(['filename', 'bytes', 'timestamp'])
+    last = None
+    while True:
+        page_query = query.start_after([last]) if last is not None else query
+        docs = list(page_query.limit(page_size).stream())
+        yield [{"b2_filename": doc.id, **(doc.to_dict() or {})} for doc in docs]
+        if len(docs) < page_size:
+            return
+        last = docs[-1].id
+
+
+def rebuild_stats(args):
+    started = time.perf_counter()
+    stop = threading.Event()
+    readers = ThreadPoolExecutor(max_workers=1)
+    totals = None
+    try:
+        for record in Prefetch(readers, stats_pages(args.page_size), args.depth, stop):
+            totals = app.stats_totals([record], totals)
+    finally:
+        stop.set()
+        readers.shutdown(wait=True)
+    totals = totals or app.stats_totals([])
+    app.reset_upload_stats(totals)
+    print(json.dumps({
+        "images": totals["images"],
+        "bytes": totals["bytes"],
+        "extensions": len(totals["by_extension"]),
+        "days": len(totals["by_day"]),
+        "seconds": round(time.perf_counter() - started, 2),
+    }, indent=2))
+    return 0
+
+
+def ordered(items, source):
+    """Comprobar que una fuente llega ordenada: si no, el cruce daría diferencias falsas"""
+    previous = None
+    for item in items:
+        if previous is not None and item.name <= previous:
+            raise RuntimeError(f"{source} no está ordenado: {item.name!r} después de {previous!r}")
+        previous = item.name
+        yield item
+
+
+def merge_join(files, records):
+    """Cruzar archivos y registros ordenados por nombre.
+
+    Produce ('match', archivo), ('orphan', archivo) o ('dangling', registro).
+    """
+    files = iter(files)
+    records = iter(records)
+    f = next(files, None)
+    r = next(records, None)
+    while f is not None or r is not None:
+        if r is None or (f is not None and f.name < r.name):
+            yield 'orphan', f
+            f = next(files, None)
+        elif f is None or r.name < f.name:
+            yield 'dangling', r
+            r = next(records, None)
+        else:
+            yield 'match', f
+            f = next(files, None)
+            r = next(records, None)
+
+
+def orphan_record(f, prefix):
+    """Registro de subida para un archivo huérfano (nombre original sin el sufijo único)"""
+    stem, dot, ext = f.name[len(prefix):].rpartition('.')
+    if not dot:
+        stem, ext = ext, ''
+    filename = UNIQUE_SUFFIX.sub('', stem) + (f".{ext}" if ext else '')
+    return {
+        "b2_filename": f.name,
+        "filename": filename or f.name,
+        "url": app.get_public_url(f.name),
+        "timestamp": datetime.fromtimestamp(f.uploaded_ms / 1000).isoformat() if f.uploaded_ms else None,
+        "bytes": f.size,
+        "sha1": f.sha1 if app.is_sha1(f.sha1 or '') else None,
+    }
+
+
+class BatchWriter:
+    """Agrupar escrituras en lotes y enviarlos en paralelo (con un máximo en vuelo)"""
+
+    def __init__(self, executor, write, batch_size, in_flight):
+        self._executor = executor
+        self._write = write
+        self._batch_size = batch_size
+        self._slots = threading.BoundedSemaphore(in_flight)
+        self._pending = []
+        self._futures = deque()
+        self._lock = threading.Lock()
+        self.written = 0
+        self.failed = 0
+
+    def add(self, item):
+        self._pending.append(item)
+        if len(self._pending) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        items, self._pending = self._pending, []
+        self._slots.acquire()
+        self._futures.append(self._executor.submit(self._run, items))
+        while self._futures and self._futures[0].done():
+            self._futures.popleft().result()
+
+    def _run(self, items):
+        try:
+            result = self._write(items)
+            written = result if isinstance(result, int) else sum(1 for r in result if r['success'])
+        except Exception as e:
+            print(f"Error escribiendo lote: {e}", file=sys.stderr)
+            written = 0
+        with self._lock:
+            self.written += written
+            self.failed += len(items) - written
+        self._slots.release()
+
+    def close(self):
+        self.flush()
+        while self._futures:
+            self._futures.popleft().result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reconciliar el bucket de B2 con los registros de Firestore')
+    parser.add_argument('--prefix', default=app.B2_PREFIX, help='prefijo de los archivos (por defecto B2_PREFIX)')
+    parser.add_argument('--import', dest='do_import', action='store_true',
+                        help='crear registros para los archivos huérfanos')
+    parser.add_argument('--delete', action='store_true', help='borrar los registros colgantes')
+    parser.add_argument('--min-age', type=float, default=3600,
+                        help='ignorar archivos y registros más recientes (segundos; subidas en curso)')
+    parser.add_argument('--concurrency', type=int, default=8, help='rangos de B2 listados a la vez')
+    parser.add_argument('--shards', type=int, default=256, help='rangos en que se parte el listado')
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--depth', type=int, default=4, help='páginas adelantadas por rango')
+    parser.add_argument('--report', help='escribir cada diferencia como una línea JSON en este archivo')
+    parser.add_argument('--rebuild-stats', action='store_true',
+                        help='recalcular las estadísticas de la galería recorriendo la colección')
+    args = parser.parse_args()
+
+    if args.rebuild_stats:
+        if args.do_import or args.delete:
+            parser.error('--rebuild-stats no se combina con --import ni --delete')
+        return rebuild_stats(args)
+
+    if app.storage.name != 'b2':
+        parser.error(f"STORAGE_BACKEND es '{app.storage.name}'; reconcile.py solo trabaja con B2")
+
+    # El proceso termina antes de que la cola de metadatos se vacíe: los
+    # registros importados quedan sin placeholder, como los de cola llena
+    app.image_metadata.enabled = False
+
+    started = time.perf_counter()
+    cutoff = datetime.now() - timedelta(seconds=args.min_age)
+    cutoff_ms = cutoff.timestamp() * 1000
+    cutoff_iso = cutoff.isoformat()
+    counts = dict.fromkeys(('files', 'records', 'matched', 'orphans', 'dangling', 'recent'), 0)
+    report = open(args.report, 'w') if args.report else None
+    stop = threading.Event()
+
+    # Lectura (un hilo por rango de B2 activo y uno para Firestore) y escritura
+    # en pools separados: un lector bloqueado nunca deja sin hilo a un lote
+    readers = ThreadPoolExecutor(max_workers=args.concurrency + 1)
+    writers = ThreadPoolExecutor(max_workers=4)
+    # Sin write-through: con muchos huérfanos las cachés crecerían sin que nadie las lea
+    importer = BatchWriter(writers, functools.partial(app.save_upload_records, remember=False),
+                           app.FIRESTORE_BATCH_LIMIT // 2, 2)
+    deleter = BatchWriter(writers, app.delete_upload_records, app.FIRESTORE_BATCH_LIMIT // 2, 2)
+    try:
+        files = ordered(list_b2_files(readers, args.prefix, args.shards, args.concurrency,
+                                      args.page_size, args.depth, stop), 'El listado de B2')
+        records = ordered(Prefetch(readers, firestore_pages(args.prefix, args.page_size), args.depth, stop),
+                          'La colección de Firestore')
+        for kind, item in merge_join(files, records):
+            if kind == 'match':
+                counts['files'] += 1
+                counts['records'] += 1
+                counts['matched'] += 1
+            elif kind == 'orphan':
+                counts['files'] += 1
+                if item.uploaded_ms and item.uploaded_ms > cutoff_ms:
+                    counts['recent'] += 1
+                    continue
+                counts['orphans'] += 1
+                record = orphan_record(item, args.prefix)
+                if report:
+                    report.write(json.dumps({"type": "orphan", **record}) + '\n')
+                if args.do_import:
+                    importer.add(record)
+            else:
+                counts['records'] += 1
+                if item.timestamp > cutoff_iso:
+                    counts['recent'] += 1
+                    continue
+                counts['dangling'] += 1
+                if report:
+                    report.write(json.dumps({"type": "dangling", "b2_filename": item.name,
+                                             "timestamp": item.timestamp}) + '\n')
+                if args.delete:
+                    deleter.add({"b2_filename": item.name, "sha1": item.sha1})
+            seen = counts['files'] + counts['records']
+            if seen % 100000 == 0:
+                print(f"... {counts['files']} archivos, {counts['records']} registros", file=sys.stderr)
+        importer.close()
+        deleter.close()
+    finally:
+        stop.set()
+        readers.shutdown(wait=True)
+        writers.shutdown(wait=True)
+        if report:
+            report.close()
+
+    summary = {
+        **counts,
+        "imported": importer.written,
+        "import_failed": importer.failed,
+        "deleted": deleter.written,
+        "delete_failed": deleter.failed,
+        "seconds": round(time.perf_counter() - started, 2),
+        # ru_maxrss está en KB en Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    print(json.dumps(summary, indent=2))
+    return 1 if importer.failed or deleter.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1731 @@
+// Estado de la aplicación
+let currentFile = null;
+let uploadInProgress = false;
+let uploadXHR = null;
+let largeUpload = null; // { xhrs: Set, cancelled: bool } durante una subida multiparte
+let batchFiles = []; // Selección de varios archivos (subida por lotes)
+let batchUpload = null; // { xhrs: Set, cancelled: bool } durante una subida por lotes
+let nextCursor = null;
+let loadingMore = false;
+let searchQuery = ''; // Búsqueda activa en el servidor ('' = listado normal)
+let searchOffset = null;
+let searchTimer = null;
+let searchController = null;
+let changesToken = null; // Posición para /api/uploads/changes (null = recargar todo)
+const shownUrls = new Set(); // URLs ya presentes en la lista
+const PAGE_SIZE = 50;
+const SEARCH_DEBOUNCE_MS = 250;
+const LARGE_UPLOAD_THRESHOLD = 50 * 1024 * 1024; // Subida multiparte a partir de 50MB
+const PART_MAX_ATTEMPTS = 3;
+const BATCH_MAX_FILES = 200; // Igual que UPLOAD_BATCH_MAX en el servidor
+const BATCH_CONCURRENCY = 4; // Subidas simultáneas a B2 en un lote
+const UPLOAD_BUSY_MAX_RETRIES = 5; // Reintentos de /upload cuando el servidor responde 429/503
+
+// Elementos DOM
+const fileInput = document.getElementById('fileInput');
+const uploadArea = document.getElementById('uploadArea');
+const fileName = document.getElementById('fileName');
+const fileSize = document.getElementById('fileSize');
+const cancelBtn = document.getElementById('cancelBtn');
+const uploadBtn = document.getElementById('uploadBtn');
+const progressContainer = document.getElementById('progressContainer');
+const progressBar = document.getElementById('progressBar');
+const progressText = document.getElementById('progressText');
+const messageDiv = document.getElementById('message');
+const refreshBtn = document.getElementById('refreshBtn');
+const searchInput = document.getElementById('searchInput');
+const imagesList = document.getElementById('imagesList');
+const loadingIndicator = document.getElementById('loadingIndicator');
+const imageItemTemplate = document.getElementById('imageItemTemplate');
+const convertOption = document.getElementById('convertOption');
+const convertToWebp = document.getElementById('convertToWebp');
+const qualitySlider = document.getElementById('qualitySlider');
+const webpQuality = document.getElementById('webpQuality');
+const qualityValue = document.getElementById('qualityValue');
+const fileSizeComparison = document.getElementById('fileSizeComparison');
+
+// Formatear tamaño de archivo
+function formatFileSize(bytes) {
+    if (bytes === 0) return '0 Bytes';
+    const k = 1024;
+    const sizes = ['Bytes', 'KB', 'MB', 'GB'];
+    const i = Math.floor(Math.log(bytes) / Math.log(k));
+    return parseFloat((bytes / Math.pow(k, i)).toFixed(2)) + ' ' + sizes[i];
+}
+
+// Formatear fecha relativa
+function timeAgo(dateString) {
+    const date = new Date(dateString);
+    const now = new Date();
+    const seconds = Math.floor((now - date) / 1000);
+    
+    let interval = Math.floor(seconds / 31536000);
+    if (interval >= 1) return `hace ${interval} año${interval > 1 ? 's' : ''}`;
+    
+    interval = Math.floor(seconds / 2592000);
+    if (interval >= 1) return `hace ${interval} mes${interval > 1 ? 'es' : ''}`;
+    
+    interval = Math.floor(seconds / 86400);
+    if (interval >= 1) return `hace ${interval} día${interval > 1 ? 's' : ''}`;
+    
+    interval = Math.floor(seconds / 3600);
+    if (interval >= 1) return `hace ${interval} hora${interval > 1 ? 's' : ''}`;
+    
+    interval = Math.floor(seconds / 60);
+    if (interval >= 1) return `hace ${interval} minuto${interval > 1 ? 's' : ''}`;
+    
+    return 'hace unos segundos';
+}
+
+// Mostrar mensaje
+function showMessage(text, type = 'success') {
+    messageDiv.textContent = text;
+    messageDiv.className = `message ${type}`;
+    messageDiv.style.display = 'block';
+    
+    if (type === 'success') {
+        setTimeout(() => {
+            messageDiv.style.display = 'none';
+        }, 5000);
+    } else if (type === 'warning') {
+        setTimeout(() => {
+            messageDiv.style.display = 'none';
+        }, 8000);
+    }
+}
+
+// Resetear interfaz de subida
+function resetUploadUI() {
+    currentFile = null;
+    batchFiles = [];
+    uploadInProgress = false;
+    uploadXHR = null;
+    
+    fileName.textContent = 'Ningún archivo seleccionado';
+    fileSize.textContent = '';
+    
+    cancelBtn.disabled = true;
+    uploadBtn.disabled = true;
+    
+    progressContainer.style.display = 'none';
+    progressBar.style.width = '0%';
+    progressText.textContent = '0%';
+    
+    convertOption.style.display = 'none';
+    convertToWebp.checked = false;
+    qualitySlider.style.display = 'none';
+    if (fileSizeComparison) {
+        fileSizeComparison.style.display = 'none';
+        fileSizeComparison.textContent = '';
+        fileSizeComparison.classList.remove('good', 'ok');
+    }
+    
+    fileInput.value = '';
+}
+
+// Actualizar interfaz con archivo seleccionado
+function updateFileUI(file, originalSize = null) {
+    if (!file) return;
+    
+    currentFile = file;
+    fileName.textContent = file.name;
+    fileSize.textContent = formatFileSize(file.size);
+    
+    // Mostrar comparación de tamaños si hay un tamaño original diferente
+    if (fileSizeComparison) {
+        if (originalSize !== null && originalSize !== file.size && originalSize > 0) {
+            const reduction = ((originalSize - file.size) / originalSize * 100).toFixed(1);
+            fileSizeComparison.textContent = `(Original: ${formatFileSize(originalSize)} → ${reduction}% más pequeño)`;
+            fileSizeComparison.style.display = 'inline';
+            // Remover clases previas
+            fileSizeComparison.classList.remove('good', 'ok');
+            // Agregar clase apropiada basada en el ahorro
+            if (reduction >= 10) {
+                fileSizeComparison.classList.add('good');
+            } else {
+                fileSizeComparison.classList.add('ok');
+            }
+        } else {
+            fileSizeComparison.style.display = 'none';
+            fileSizeComparison.textContent = '';
+            fileSizeComparison.classList.remove('good', 'ok');
+        }
+    }
+    
+    cancelBtn.disabled = false;
+    uploadBtn.disabled = false;
+    
+    // Mostrar opción de conversión para imágenes que no sean WebP
+    const isWebP = file.type === 'image/webp';
+    const maxConvertSize = 30 * 1024 * 1024; // 30MB máximo para conversión
+    
+    if (!isWebP && file.size <= maxConvertSize) {
+        convertOption.style.display = 'block';
+        convertToWebp.checked = false;
+        qualitySlider.style.display = 'none';
+        if (convertToWebp) convertToWebp.disabled = false;
+    } else {
+        convertOption.style.display = 'none';
+        if (convertToWebp) convertToWebp.checked = false;
+        
+        if (!isWebP && file.size > maxConvertSize) {
+            // Mostrar advertencia sobre tamaño
+            setTimeout(() => {
+                showMessage('Nota: Conversión a WebP deshabilitada para archivos mayores a 30MB', 'info');
+            }, 500);
+        }
+    }
+}
+
+const allowedTypes = ['image/webp', 'image/jpeg', 'image/png', 'image/gif'];
+
+// Manejar selección de uno o varios archivos
+function handleFilesSelect(fileList) {
+    const files = Array.from(fileList || []);
+    if (files.length <= 1) {
+        handleFileSelect(files[0]);
+        return;
+    }
+    
+    const validFiles = files.filter(file => allowedTypes.includes(file.type));
+    const skipped = files.length - validFiles.length;
+    if (validFiles.length === 0) {
+        showMessage('Tipo de archivo no permitido. Solo se aceptan imágenes (webp, jpg, png, gif).', 'error');
+        return;
+    }
+    if (validFiles.length === 1) {
+        handleFileSelect(validFiles[0]);
+        return;
+    }
+    
+    currentFile = null;
+    batchFiles = validFiles;
+    const totalSize = validFiles.reduce((sum, file) => sum + file.size, 0);
+    fileName.textContent = `${validFiles.length} archivos seleccionados`;
+    fileSize.textContent = formatFileSize(totalSize);
+    convertOption.style.display = 'none';
+    convertToWebp.checked = false;
+    if (fileSizeComparison) fileSizeComparison.style.display = 'none';
+    cancelBtn.disabled = false;
+    uploadBtn.disabled = false;
+    
+    if (skipped > 0) {
+        showMessage(`Se omitieron ${skipped} archivos con tipo no permitido`, 'warning');
+    }
+}
+
+// Manejar selección de archivo
+function handleFileSelect(file) {
+    if (!file) return;
+    
+    batchFiles = [];
+    
+    // Validar tipo de archivo
+    if (!allowedTypes.includes(file.type)) {
+        showMessage('Tipo de archivo no permitido. Solo se aceptan imágenes (webp, jpg, png, gif).', 'error');
+        return;
+    }
+    
+    // Validar tamaño (max 200MB - backend upload)
+    const maxSize = 200 * 1024 * 1024; // 200MB
+    if (file.size > maxSize) {
+        showMessage('El archivo es demasiado grande. El tamaño máximo es 200MB.', 'error');
+        return;
+    }
+    
+    updateFileUI(file);
+}
+
+// Convertir imagen a WebP usando canvas
+function convertImageToWebP(file, quality = 85) {
+    return new Promise((resolve, reject) => {
+        if (!file || !file.type.startsWith('image/')) {
+            reject(new Error('Archivo no es una imagen válida'));
+            return;
+        }
+        
+        // Si ya es WebP, devolver el mismo archivo
+        if (file.type === 'image/webp') {
+            resolve(file);
+            return;
+        }
+        
+        showMessage(`Convirtiendo ${file.name} a WebP (${quality}%)...`, 'info');
+        
+        const img = new Image();
+        const reader = new FileReader();
+        
+        reader.onload = (e) => {
+            img.src = e.target.result;
+        };
+        
+        img.onload = () => {
+            try {
+                // Crear canvas con dimensiones de la imagen
+                const canvas = document.createElement('canvas');
+                canvas.width = img.width;
+                canvas.height = img.height;
+                
+                const ctx = canvas.getContext('2d');
+                
+                // Dibujar imagen en canvas
+                ctx.drawImage(img, 0, 0);
+                
+                // Convertir a WebP blob
+                canvas.toBlob((blob) => {
+                    if (!blob) {
+                        reject(new Error('Error al convertir a WebP'));
+                        return;
+                    }
+                    
+                    // Crear nuevo archivo con extensión .webp
+                    const newFileName = file.name.replace(/\.[^/.]+$/, '') + '.webp';
+                    const webpFile = new File([blob], newFileName, {
+                        type: 'image/webp',
+                        lastModified: Date.now()
+                    });
+                    
+                    const originalSize = file.size;
+                    const convertedSize = blob.size;
+                    const reduction = originalSize > 0 ? ((originalSize - convertedSize) / originalSize * 100).toFixed(1) : 0;
+                    
+                    console.log(`Convertido: ${file.name} (${formatFileSize(originalSize)}) -> ${newFileName} (${formatFileSize(convertedSize)}) - ${reduction}% reducción`);
+                    showMessage(`✅ Conversión completada: ${formatFileSize(originalSize)} → ${formatFileSize(convertedSize)} (${reduction}% más pequeño)`, 'success');
+                    
+                    resolve(webpFile);
+                }, 'image/webp', quality / 100);
+                
+            } catch (error) {
+                reject(new Error(`Error en conversión: ${error.message}`));
+            }
+        };
+        
+        img.onerror = () => {
+            reject(new Error('Error al cargar la imagen para conversión'));
+        };
+        
+        reader.onerror = () => {
+            reject(new Error('Error al leer el archivo'));
+        };
+        
+        reader.readAsDataURL(file);
+    });
+}
+
+// Función principal de subida - decide qué método usar
+async function uploadFile() {
+    if (batchFiles.length > 1 && !uploadInProgress) {
+        return uploadBatch(batchFiles);
+    }
+    if (!currentFile || uploadInProgress) return;
+    
+    let fileToUpload = currentFile;
+    const shouldConvert = convertToWebp && convertToWebp.checked && currentFile.type !== 'image/webp';
+    const originalSize = currentFile.size;
+    
+    if (shouldConvert) {
+        try {
+            const quality = webpQuality ? parseInt(webpQuality.value) : 85;
+            showMessage('Convirtiendo imagen a WebP...', 'info');
+            uploadBtn.disabled = true;
+            cancelBtn.disabled = true;
+            
+            fileToUpload = await convertImageToWebP(currentFile, quality);
+            
+            // Actualizar UI con el archivo convertido y mostrar comparación
+            updateFileUI(fileToUpload, originalSize);
+            
+            uploadBtn.disabled = false;
+            cancelBtn.disabled = false;
+            
+        } catch (error) {
+            showMessage(`Error en conversión: ${error.message}. Subiendo archivo original.`, 'warning');
+            // Continuar con archivo original
+            fileToUpload = currentFile;
+            // Actualizar UI sin comparación
+            updateFileUI(fileToUpload);
+        }
+    }
+    
+    // Guardar archivo a subir temporalmente
+    const originalCurrentFile = currentFile;
+    currentFile = fileToUpload;
+    
+    const isVercel = window.IS_VERCEL === 'true' || window.IS_VERCEL === true;
+    const maxBackendSize = 4.2 * 1024 * 1024; // 4.2MB conservative Vercel limit
+    const fileSize = fileToUpload.size;
+    
+    // Determine upload method
+    let uploadMethod;
+    let warningMessage = '';
+    
+    if (fileSize <= maxBackendSize) {
+        // File is small enough for backend upload even on Vercel
+        uploadMethod = 'backend';
+    } else {
+        // File is too large for backend upload on Vercel
+        if (isVercel && directUploadsEnabled()) {
+            // On Vercel, try direct B2 upload for large files
+            uploadMethod = 'direct-b2';
+            warningMessage = 'Archivo grande en Vercel: usando upload directo a Backblaze B2 (puede fallar por restricciones CORS).';
+            
+            // Suggest WebP conversion if not already WebP
+            if (currentFile.type !== 'image/webp') {
+                warningMessage += ' Considera convertir a WebP para reducir el tamaño.';
+            }
+        } else {
+            // Not on Vercel, backend can handle up to 200MB locally
+            uploadMethod = 'backend';
+        }
+    }
+    
+    console.log('Upload method decision:', {
+        isVercel: window.IS_VERCEL,
+        originalFileSize: originalCurrentFile.size,
+        convertedFileSize: fileSize,
+        maxBackendSize: maxBackendSize,
+        uploadMethod: uploadMethod,
+        warning: warningMessage
+    });
+    
+    try {
+        if (warningMessage) {
+            showMessage(warningMessage, 'warning');
+        }
+        
+        if (uploadMethod === 'backend') {
+            console.log('Using backend upload');
+            await uploadViaBackend();
+        } else if (uploadMethod === 'direct-b2') {
+            console.log('Using direct B2 upload');
+            await uploadDirectToB2();
+        }
+    } finally {
+        // Restaurar archivo original en currentFile para UI
+        currentFile = originalCurrentFile;
+    }
+}
+
+// ¿El almacenamiento del servidor admite subidas directas a B2 desde el navegador?
+function directUploadsEnabled() {
+    return window.DIRECT_UPLOADS !== false && window.DIRECT_UPLOADS !== 'false';
+}
+
+// Subir archivo a través del backend (evita problemas CORS con B2)
+async function uploadViaBackend() {
+    if (!currentFile || uploadInProgress) return;
+    
+    uploadInProgress = true;
+    uploadBtn.disabled = true;
+    cancelBtn.textContent = 'Cancelar Subida';
+    progressContainer.style.display = 'block';
+    progressBar.style.width = '0%';
+    progressText.textContent = '0%';
+    
+    try {
+        showMessage('Preparando subida...', 'info');
+        
+        // Usar FormData para enviar el archivo
+        const formData = new FormData();
+        formData.append('file', currentFile);
+        
+        showMessage('Subiendo a través del servidor...', 'info');
+        
+        // Upload through backend using XMLHttpRequest to track progress
+        return new Promise((resolve, reject) => {
+            let busyRetries = 0;
+            const sendRequest = () => {
+                uploadXHR = new XMLHttpRequest();
+            
+                uploadXHR.upload.addEventListener('progress', (e) => {
+                    if (e.lengthComputable) {
+                        const percentComplete = Math.round((e.loaded / e.total) * 100);
+                        progressBar.style.width = percentComplete + '%';
+                        progressText.textContent = percentComplete + '%';
+                    
+                        // Update message at certain milestones
+                        if (percentComplete === 50) {
+                            showMessage('Subida a la mitad...', 'info');
+                        } else if (percentComplete === 90) {
+                            showMessage('Subida casi completa...', 'info');
+                        }
+                    }
+                });
+            
+                uploadXHR.addEventListener('load', async () => {
+                    // Servidor saturado: esperar lo que indique Retry-After y reenviar
+                    if (isBusyStatus(uploadXHR.status) && busyRetries < UPLOAD_BUSY_MAX_RETRIES) {
+                        busyRetries++;
+                        const delay = retryAfterMs(uploadXHR);
+                        showMessage(`Servidor ocupado, reintentando en ${Math.ceil(delay / 1000)}s...`, 'info');
+                        progressBar.style.width = '0%';
+                        progressText.textContent = '0%';
+                        setTimeout(() => {
+                            if (uploadInProgress) {
+                                sendRequest();
+                            } else {
+                                reject(new Error('Upload cancelled'));
+                            }
+                        }, delay);
+                        return;
+                    }
+                    try {
+                        if (uploadXHR.status === 200) {
+                            const response = JSON.parse(uploadXHR.responseText);
+                            if (response.success) {
+                                showMessage(`¡Imagen subida exitosamente! URL: ${response.url}`, 'success');
+                                resetUploadUI();
+                                syncImages(); // Añadir las imágenes nuevas
+                                resolve(response);
+                            } else {
+                                throw new Error(response.error || 'Error al subir el archivo');
+                            }
+                        } else {
+                            let errorMsg = `Error ${uploadXHR.status} al subir el archivo`;
+                            try {
+                                const errorResponse = JSON.parse(uploadXHR.responseText);
+                                errorMsg = errorResponse.error || errorMsg;
+                            } catch (e) {
+                                // Not JSON
+                            }
+                            throw new Error(errorMsg);
+                        }
+                    } catch (error) {
+                        showMessage(error.message, 'error');
+                        reject(error);
+                    } finally {
+                        uploadInProgress = false;
+                        cancelBtn.textContent = 'Cancelar';
+                        cancelBtn.disabled = true;
+                        progressContainer.style.display = 'none';
+                        uploadXHR = null;
+                    }
+                });
+            
+                uploadXHR.addEventListener('error', (e) => {
+                    console.error('XHR error event:', e);
+                    console.error('XHR status:', uploadXHR.status);
+                    console.error('XHR statusText:', uploadXHR.statusText);
+                    console.error('XHR responseText:', uploadXHR.responseText);
+                    showMessage('Error de conexión con el servidor', 'error');
+                    uploadInProgress = false;
+                    cancelBtn.textContent = 'Cancelar';
+                    cancelBtn.disabled = true;
+                    progressContainer.style.display = 'none';
+                    uploadXHR = null;
+                    reject(new Error('Network error uploading to server'));
+                });
+            
+                uploadXHR.addEventListener('abort', () => {
+                    showMessage('Subida cancelada', 'error');
+                    uploadInProgress = false;
+                    cancelBtn.textContent = 'Cancelar';
+                    cancelBtn.disabled = true;
+                    progressContainer.style.display = 'none';
+                    uploadXHR = null;
+                    reject(new Error('Upload cancelled'));
+                });
+            
+                // Open POST request to our backend upload endpoint
+                uploadXHR.open('POST', '/upload');
+            
+                // No need to set Content-Type header for FormData, browser sets it automatically
+                // with proper boundary for multipart/form-data
+            
+                // Log request details
+                console.log('Sending to backend:', {
+                    url: '/upload',
+                    filename: currentFile.name,
+                    size: currentFile.size,
+                    type: currentFile.type
+                });
+            
+                // Send the FormData (which includes the file)
+                uploadXHR.send(formData);
+            };
+            sendRequest();
+        });
+        
+    } catch (error) {
+        showMessage(error.message, 'error');
+        uploadInProgress = false;
+        cancelBtn.textContent = 'Cancelar';
+        cancelBtn.disabled = true;
+        progressContainer.style.display = 'none';
+        uploadXHR = null;
+    }
+}
+
+// Subir directamente a Backblaze B2 (usado en Vercel)
+async function uploadDirectToB2() {
+    if (!currentFile || uploadInProgress) return;
+    
+    // Archivos grandes: subida multiparte en paralelo (requiere SHA1 en el navegador)
+    if (currentFile.size > LARGE_UPLOAD_THRESHOLD && window.crypto && window.crypto.subtle) {
+        return uploadLargeFileToB2();
+    }
+    
+    uploadInProgress = true;
+    uploadBtn.disabled = true;
+    cancelBtn.textContent = 'Cancelar Subida';
+    progressContainer.style.display = 'block';
+    progressBar.style.width = '0%';
+    progressText.textContent = '0%';
+    
+    try {
+        // 0. Huella SHA1 del contenido: evita subir duplicados y permite que B2 verifique la subida
+        let contentSha1 = null;
+        if (window.crypto && window.crypto.subtle) {
+            showMessage('Calculando huella del archivo...', 'info');
+            contentSha1 = await sha1Hex(currentFile);
+        }
+        
+        showMessage('Obteniendo credenciales de Backblaze B2...', 'info');
+        
+        // 1. Get upload credentials from backend
+        const authResponse = await fetch('/api/upload/auth', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            credentials: 'same-origin',
+            body: JSON.stringify({
+                filename: currentFile.name,
+                sha1: contentSha1
+            })
+        });
+        
+        if (!authResponse.ok) {
+            const errorData = await authResponse.json();
+            throw new Error(errorData.error || `Error ${authResponse.status} obteniendo credenciales`);
+        }
+        
+        const authData = await authResponse.json();
+        if (!authData.success) {
+            throw new Error(authData.error || 'Error en credenciales de Backblaze B2');
+        }
+        
+        // El mismo contenido ya está en B2: no hace falta subirlo
+        if (authData.duplicate) {
+            showMessage(`Esta imagen ya estaba subida. URL: ${authData.url}`, 'success');
+            uploadInProgress = false;
+            cancelBtn.textContent = 'Cancelar';
+            resetUploadUI();
+            return authData;
+        }
+        
+        showMessage('Subiendo directamente a Backblaze B2...', 'info');
+        
+        // 2. Upload directly to B2 using the provided URL
+        // Headers for B2 upload (use headers from backend, except Content-Type which browser sets)
+        const b2Headers = authData.headers || {};
+        // Ensure we have the b2_filename in headers (backend should include it)
+        if (!b2Headers['X-Bz-File-Name'] && authData.b2_filename) {
+            b2Headers['X-Bz-File-Name'] = authData.b2_filename;
+        }
+        
+        // Use XMLHttpRequest to track progress
+        return new Promise((resolve, reject) => {
+            uploadXHR = new XMLHttpRequest();
+            
+            uploadXHR.upload.addEventListener('progress', (e) => {
+                if (e.lengthComputable) {
+                    const percentComplete = Math.round((e.loaded / e.total) * 100);
+                    progressBar.style.width = percentComplete + '%';
+                    progressText.textContent = percentComplete + '%';
+                    
+                    // Update message at certain milestones
+                    if (percentComplete === 50) {
+                        showMessage('Subida a la mitad...', 'info');
+                    } else if (percentComplete === 90) {
+                        showMessage('Subida casi completa...', 'info');
+                    }
+                }
+            });
+            
+            uploadXHR.addEventListener('load', async () => {
+                try {
+                    if (uploadXHR.status === 200) {
+                        // B2 returns XML or JSON response
+                        showMessage('Subida a B2 completada, registrando en Firebase...', 'info');
+                        
+                        // 3. Register upload in Firebase via backend
+                        const completeResponse = await fetch('/api/upload/complete', {
+                            method: 'POST',
+                            headers: {
+                                'Content-Type': 'application/json',
+                            },
+                            credentials: 'same-origin',
+                            body: JSON.stringify({
+                                b2_filename: authData.b2_filename,
+                                original_filename: currentFile.name,
+                                lease_id: authData.lease_id,
+                                sha1: contentSha1
+                            })
+                        });
+                        
+                        if (!completeResponse.ok) {
+                            const errorData = await completeResponse.json();
+                            throw new Error(errorData.error || `Error ${completeResponse.status} registrando subida`);
+                        }
+                        
+                        const completeData = await completeResponse.json();
+                        
+                        showMessage(`¡Imagen subida exitosamente! URL: ${completeData.url}`, 'success');
+                        resetUploadUI();
+                        syncImages(); // Añadir las imágenes nuevas
+                        resolve(completeData);
+                    } else {
+                        let errorMsg = `Error ${uploadXHR.status} subiendo a Backblaze B2`;
+                        try {
+                            // Try to parse error response (B2 returns XML)
+                            const parser = new DOMParser();
+                            const xmlDoc = parser.parseFromString(uploadXHR.responseText, "text/xml");
+                            const code = xmlDoc.getElementsByTagName('code')[0];
+                            const message = xmlDoc.getElementsByTagName('message')[0];
+                            if (code && message) {
+                                errorMsg = `B2 Error ${code.textContent}: ${message.textContent}`;
+                            }
+                        } catch (e) {
+                            // Not XML, try JSON
+                            try {
+                                const errorResponse = JSON.parse(uploadXHR.responseText);
+                                errorMsg = errorResponse.error || errorResponse.message || errorMsg;
+                            } catch (e2) {
+                                // Plain text
+                                if (uploadXHR.responseText) {
+                                    errorMsg += `: ${uploadXHR.responseText.substring(0, 100)}`;
+                                }
+                            }
+                        }
+                        throw new Error(errorMsg);
+                    }
+                } catch (error) {
+                    showMessage(error.message, 'error');
+                    reject(error);
+                } finally {
+                    uploadInProgress = false;
+                    cancelBtn.textContent = 'Cancelar';
+                    cancelBtn.disabled = true;
+                    progressContainer.style.display = 'none';
+                    uploadXHR = null;
+                }
+            });
+            
+            uploadXHR.addEventListener('error', (e) => {
+                console.error('XHR error event:', e);
+                console.error('XHR status:', uploadXHR.status);
+                console.error('XHR statusText:', uploadXHR.statusText);
+                console.error('XHR responseText:', uploadXHR.responseText);
+                showMessage('Error de conexión con Backblaze B2', 'error');
+                uploadInProgress = false;
+                cancelBtn.textContent = 'Cancelar';
+                cancelBtn.disabled = true;
+                progressContainer.style.display = 'none';
+                uploadXHR = null;
+                reject(new Error('Network error uploading to Backblaze B2'));
+            });
+            
+            uploadXHR.addEventListener('abort', () => {
+                showMessage('Subida cancelada', 'error');
+                uploadInProgress = false;
+                cancelBtn.textContent = 'Cancelar';
+                cancelBtn.disabled = true;
+                progressContainer.style.display = 'none';
+                uploadXHR = null;
+                reject(new Error('Upload cancelled'));
+            });
+            
+            // Open POST request to B2 upload URL
+            uploadXHR.open('POST', authData.upload_url);
+            
+            // Set B2 headers
+            Object.keys(b2Headers).forEach(key => {
+                uploadXHR.setRequestHeader(key, b2Headers[key]);
+            });
+            
+            // Log request details
+            console.log('Sending to B2:', {
+                url: authData.upload_url,
+                filename: authData.b2_filename,
+                size: currentFile.size,
+                type: currentFile.type
+            });
+            
+            // Send the file directly
+            uploadXHR.send(currentFile);
+        });
+        
+    } catch (error) {
+        showMessage(error.message, 'error');
+        uploadInProgress = false;
+        cancelBtn.textContent = 'Cancelar';
+        cancelBtn.disabled = true;
+        progressContainer.style.display = 'none';
+        uploadXHR = null;
+    }
+}
+
+// POST JSON al backend y devolver la respuesta (lanza error si falla)
+async function postJSON(url, body) {
+    const response = await fetch(url, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        credentials: 'same-origin',
+        body: JSON.stringify(body)
+    });
+    let data = {};
+    try {
+        data = await response.json();
+    } catch (e) {
+        // Respuesta sin JSON
+    }
+    if (!response.ok || data.success === false) {
+        throw new Error(data.error || `Error ${response.status} en ${url}`);
+    }
+    return data;
+}
+
+// SHA1 en hexadecimal de un Blob
+async function sha1Hex(blob) {
+    const buffer = await blob.arrayBuffer();
+    const digest = await crypto.subtle.digest('SHA-1', buffer);
+    return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+}
+
+// Subir una parte a su URL de B2; onProgress recibe los bytes enviados
+function uploadPartXHR(xhrs, partUrl, partNumber, blob, sha1, onProgress) {
+    return new Promise((resolve, reject) => {
+        const xhr = new XMLHttpRequest();
+        xhrs.add(xhr);
+        
+        xhr.upload.addEventListener('progress', (e) => {
+            if (e.lengthComputable) onProgress(e.loaded);
+        });
+        xhr.addEventListener('load', () => {
+            xhrs.delete(xhr);
+            if (xhr.status === 200) {
+                resolve();
+            } else {
+                reject(new Error(`Error ${xhr.status} subiendo la parte ${partNumber}`));
+            }
+        });
+        xhr.addEventListener('error', () => {
+            xhrs.delete(xhr);
+            reject(new Error(`Error de red subiendo la parte ${partNumber}`));
+        });
+        xhr.addEventListener('abort', () => {
+            xhrs.delete(xhr);
+            reject(new Error('Upload cancelled'));
+        });
+        
+        xhr.open('POST', partUrl.upload_url);
+        xhr.setRequestHeader('Authorization', partUrl.authorization_token);
+        xhr.setRequestHeader('X-Bz-Part-Number', String(partNumber));
+        xhr.setRequestHeader('X-Bz-Content-Sha1', sha1);
+        xhr.send(blob);
+    });
+}
+
+// Subida multiparte directa a B2: partes en paralelo, reanudable tras un fallo
+async function uploadLargeFileToB2() {
+    const file = currentFile;
+    const resumeKey = `b2-large-upload:${file.name}:${file.size}:${file.lastModified}`;
+    
+    uploadInProgress = true;
+    const upload = { xhrs: new Set(), cancelled: false, stopped: false, fileId: null, resumeKey };
+    largeUpload = upload;
+    uploadBtn.disabled = true;
+    cancelBtn.textContent = 'Cancelar Subida';
+    progressContainer.style.display = 'block';
+    progressBar.style.width = '0%';
+    progressText.textContent = '0%';
+    
+    try {
+        // 1. Reanudar una subida anterior del mismo archivo o empezar una nueva
+        let state = null;
+        const doneParts = new Map(); // número de parte -> sha1
+        try {
+            state = JSON.parse(localStorage.getItem(resumeKey) || 'null');
+        } catch (e) {
+            state = null;
+        }
+        if (state) {
+            try {
+                const response = await fetch(`/api/upload/large/${encodeURIComponent(state.file_id)}/parts`, {
+                    credentials: 'same-origin'
+                });
+                if (!response.ok) throw new Error(`Error ${response.status}`);
+                const data = await response.json();
+                data.parts.forEach(part => {
+                    const expected = Math.min(state.part_size, file.size - (part.part_number - 1) * state.part_size);
+                    if (part.size === expected) doneParts.set(part.part_number, part.sha1);
+                });
+                showMessage(`Reanudando subida: ${doneParts.size} partes ya estaban en Backblaze B2`, 'info');
+            } catch (e) {
+                console.warn('No se pudo reanudar la subida anterior:', e);
+                state = null;
+                doneParts.clear();
+            }
+        }
+        if (!state) {
+            showMessage('Iniciando subida multiparte a Backblaze B2...', 'info');
+            const started = await postJSON('/api/upload/large/start', {
+                filename: file.name,
+                content_type: file.type
+            });
+            state = {
+                file_id: started.file_id,
+                b2_filename: started.b2_filename,
+                part_size: started.part_size,
+                max_parallel: started.max_parallel
+            };
+            localStorage.setItem(resumeKey, JSON.stringify(state));
+        }
+        upload.fileId = state.file_id;
+        
+        // 2. Subir las partes que faltan con varias conexiones en paralelo
+        const totalParts = Math.ceil(file.size / state.part_size);
+        const pending = [];
+        for (let n = 1; n <= totalParts; n++) {
+            if (!doneParts.has(n)) pending.push(n);
+        }
+        
+        const partBytes = (n) => Math.min(state.part_size, file.size - (n - 1) * state.part_size);
+        let completedBytes = 0;
+        doneParts.forEach((sha1, n) => { completedBytes += partBytes(n); });
+        const inFlight = new Map();
+        const updateProgress = () => {
+            let loaded = completedBytes;
+            inFlight.forEach(bytes => { loaded += bytes; });
+            const percentComplete = Math.min(100, Math.round((loaded / file.size) * 100));
+            progressBar.style.width = percentComplete + '%';
+            progressText.textContent = percentComplete + '%';
+        };
+        updateProgress();
+        
+        const parallel = Math.max(1, Math.min(state.max_parallel || 4, pending.length));
+        if (pending.length > 0) {
+            showMessage(`Subiendo ${pending.length} partes a Backblaze B2 (${parallel} en paralelo)...`, 'info');
+        }
+        const partUrls = pending.length > 0
+            ? (await postJSON('/api/upload/large/part-urls', { file_id: state.file_id, count: parallel })).urls
+            : [];
+        
+        const worker = async (partUrl) => {
+            while (pending.length > 0) {
+                if (upload.cancelled || upload.stopped) throw new Error('Upload cancelled');
+                const n = pending.shift();
+                const blob = file.slice((n - 1) * state.part_size, (n - 1) * state.part_size + partBytes(n));
+                const sha1 = await sha1Hex(blob);
+                
+                for (let attempt = 1; ; attempt++) {
+                    try {
+                        await uploadPartXHR(upload.xhrs, partUrl, n, blob, sha1, (loaded) => {
+                            inFlight.set(n, loaded);
+                            updateProgress();
+                        });
+                        break;
+                    } catch (error) {
+                        inFlight.delete(n);
+                        if (upload.cancelled || upload.stopped || attempt >= PART_MAX_ATTEMPTS) throw error;
+                        // B2 pide una URL nueva tras un fallo
+                        console.warn(`Reintentando parte ${n}:`, error);
+                        partUrl = (await postJSON('/api/upload/large/part-urls', { file_id: state.file_id, count: 1 })).urls[0];
+                    }
+                }
+                inFlight.delete(n);
+                doneParts.set(n, sha1);
+                completedBytes += partBytes(n);
+                updateProgress();
+            }
+        };
+        await Promise.all(partUrls.map(partUrl => worker(partUrl)));
+        
+        // 3. Ensamblar el archivo y registrarlo en Firebase
+        showMessage('Partes subidas, finalizando archivo en Backblaze B2...', 'info');
+        const partSha1Array = [];
+        for (let n = 1; n <= totalParts; n++) {
+            partSha1Array.push(doneParts.get(n));
+        }
+        const completeData = await postJSON('/api/upload/large/finish', {
+            file_id: state.file_id,
+            original_filename: file.name,
+            part_sha1_array: partSha1Array
+        });
+        localStorage.removeItem(resumeKey);
+        
+        showMessage(`¡Imagen subida exitosamente! URL: ${completeData.url}`, 'success');
+        resetUploadUI();
+        syncImages(); // Añadir las imágenes nuevas
+        return completeData;
+    } catch (error) {
+        // Detener el resto de partes en curso (quedan en B2 para reanudar)
+        upload.stopped = true;
+        upload.xhrs.forEach(xhr => xhr.abort());
+        if (upload.cancelled) {
+            showMessage('Subida cancelada', 'error');
+        } else {
+            showMessage(`${error.message}. Vuelve a subir el mismo archivo para reanudar.`, 'error');
+        }
+    } finally {
+        if (largeUpload === upload) largeUpload = null;
+        uploadInProgress = false;
+        cancelBtn.textContent = 'Cancelar';
+        cancelBtn.disabled = true;
+        progressContainer.style.display = 'none';
+    }
+}
+
+// Subir un archivo completo a B2 con las credenciales de un lote
+function uploadFileXHR(xhrs, item, file, onProgress) {
+    return new Promise((resolve, reject) => {
+        const xhr = new XMLHttpRequest();
+        xhrs.add(xhr);
+        
+        xhr.upload.addEventListener('progress', (e) => {
+            if (e.lengthComputable) onProgress(e.loaded);
+        });
+        xhr.addEventListener('load', () => {
+            xhrs.delete(xhr);
+            if (xhr.status === 200) {
+                resolve();
+            } else {
+                reject(new Error(`Error ${xhr.status} subiendo ${file.name}`));
+            }
+        });
+        xhr.addEventListener('error', () => {
+            xhrs.delete(xhr);
+            reject(new Error(`Error de red subiendo ${file.name}`));
+        });
+        xhr.addEventListener('abort', () => {
+            xhrs.delete(xhr);
+            reject(new Error('Upload cancelled'));
+        });
+        
+        xhr.open('POST', item.upload_url);
+        const headers = item.headers || {};
+        Object.keys(headers).forEach(key => {
+            xhr.setRequestHeader(key, headers[key]);
+        });
+        xhr.send(file);
+    });
+}
+
+// Milisegundos que pide esperar el servidor (Retry-After en segundos o como fecha HTTP)
+function retryAfterMs(xhr, fallbackSeconds = 5) {
+    const header = xhr.getResponseHeader('Retry-After');
+    if (header) {
+        const seconds = Number(header);
+        if (!Number.isNaN(seconds)) return seconds * 1000;
+        const date = Date.parse(header);
+        if (!Number.isNaN(date)) return Math.max(0, date - Date.now());
+    }
+    return fallbackSeconds * 1000;
+}
+
+// 429 (demasiadas subidas a la vez) y 503 (servidor saturado) se pueden reintentar
+function isBusyStatus(status) {
+    return status === 429 || status === 503;
+}
+
+function wait(ms) {
+    return new Promise(resolve => setTimeout(resolve, ms));
+}
+
+// Subir un archivo de un lote a través del backend (almacenamiento local)
+// Si el servidor está saturado, el error lleva retryAfter (ms) para reintentar
+function uploadFileToBackendXHR(xhrs, file, onProgress) {
+    return new Promise((resolve, reject) => {
+        const xhr = new XMLHttpRequest();
+        xhrs.add(xhr);
+        const formData = new FormData();
+        formData.append('file', file);
+        
+        xhr.upload.addEventListener('progress', (e) => {
+            if (e.lengthComputable) onProgress(e.loaded);
+        });
+        xhr.addEventListener('load', () => {
+            xhrs.delete(xhr);
+            if (xhr.status === 200) {
+                resolve();
+            } else {
+                const error = new Error(`Error ${xhr.status} subiendo ${file.name}`);
+                if (isBusyStatus(xhr.status)) error.retryAfter = retryAfterMs(xhr);
+                reject(error);
+            }
+        });
+        xhr.addEventListener('error', () => {
+            xhrs.delete(xhr);
+            reject(new Error(`Error de red subiendo ${file.name}`));
+        });
+        xhr.addEventListener('abort', () => {
+            xhrs.delete(xhr);
+            reject(new Error('Upload cancelled'));
+        });
+        
+        xhr.open('POST', '/upload');
+        xhr.withCredentials = true;
+        xhr.send(formData);
+    });
+}
+
+// Subir varios archivos directamente a B2: credenciales y registro por lotes,
+// con un máximo de BATCH_CONCURRENCY subidas simultáneas. Con almacenamiento
+// local cada archivo pasa por /upload (misma ventana de concurrencia).
+async function uploadBatch(files) {
+    const upload = { xhrs: new Set(), cancelled: false };
+    batchUpload = upload;
+    uploadInProgress = true;
+    uploadBtn.disabled = true;
+    cancelBtn.textContent = 'Cancelar Subida';
+    progressContainer.style.display = 'block';
+    progressBar.style.width = '0%';
+    progressText.textContent = '0%';
+    
+    const totalBytes = files.reduce((sum, file) => sum + file.size, 0) || 1;
+    let completedBytes = 0;
+    const inFlight = new Map();
+    const updateProgress = () => {
+        let loaded = completedBytes;
+        inFlight.forEach(bytes => { loaded += bytes; });
+        const percentComplete = Math.min(100, Math.round((loaded / totalBytes) * 100));
+        progressBar.style.width = percentComplete + '%';
+        progressText.textContent = percentComplete + '%';
+    };
+    
+    let uploaded = 0;
+    const failures = [];
+    
+    try {
+        for (let start = 0; start < files.length; start += BATCH_MAX_FILES) {
+            const chunk = files.slice(start, start + BATCH_MAX_FILES);
+            const queue = [];
+            
+            if (!directUploadsEnabled()) {
+                // Sin credenciales de B2: la clave solo identifica el progreso
+                chunk.forEach((file, i) => {
+                    queue.push({ item: { b2_filename: `${start + i}` }, file, sha1: null });
+                });
+            } else {
+                // 1. Credenciales para todo el bloque en una sola petición
+                showMessage(`Obteniendo credenciales para ${chunk.length} archivos...`, 'info');
+                // Huellas SHA1 (una a una para no cargar todo el bloque en memoria)
+                const hashes = [];
+                if (window.crypto && window.crypto.subtle) {
+                    showMessage(`Calculando huellas de ${chunk.length} archivos...`, 'info');
+                    for (const file of chunk) {
+                        if (upload.cancelled) throw new Error('Upload cancelled');
+                        hashes.push(await sha1Hex(file));
+                    }
+                }
+            
+                // (success=false solo indica que algún archivo fue rechazado)
+                const authResponse = await fetch('/api/upload/auth/batch', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                    },
+                    credentials: 'same-origin',
+                    body: JSON.stringify({
+                        files: chunk.map((file, i) => ({ filename: file.name, sha1: hashes[i] || null }))
+                    })
+                });
+                const auth = await authResponse.json();
+                if (!authResponse.ok) {
+                    throw new Error(auth.error || `Error ${authResponse.status} obteniendo credenciales`);
+                }
+            
+                auth.items.forEach(item => {
+                    const file = chunk[item.index];
+                    if (item.success && item.duplicate) {
+                        // Ya estaba en B2 con el mismo contenido
+                        uploaded++;
+                        completedBytes += file.size;
+                    } else if (item.success) {
+                        queue.push({ item, file, sha1: hashes[item.index] || null });
+                    } else {
+                        failures.push(`${file.name}: ${item.error}`);
+                        completedBytes += file.size;
+                    }
+                });
+            }
+            
+            // 2. Subir a B2 con una ventana de concurrencia acotada
+            const completed = [];
+            let next = 0;
+            const worker = async () => {
+                while (next < queue.length) {
+                    if (upload.cancelled) throw new Error('Upload cancelled');
+                    const { item, file, sha1 } = queue[next++];
+                    showMessage(`Subiendo ${uploaded + completed.length + 1} de ${files.length}...`, 'info');
+                    try {
+                        const onProgress = (loaded) => {
+                            inFlight.set(item.b2_filename, loaded);
+                            updateProgress();
+                        };
+                        if (!directUploadsEnabled()) {
+                            // El servidor guarda y registra el archivo en la misma petición
+                            for (let busyRetries = 0; ; busyRetries++) {
+                                try {
+                                    await uploadFileToBackendXHR(upload.xhrs, file, onProgress);
+                                    break;
+                                } catch (error) {
+                                    if (!error.retryAfter || busyRetries >= UPLOAD_BUSY_MAX_RETRIES) throw error;
+                                    onProgress(0);
+                                    await wait(error.retryAfter);
+                                    if (upload.cancelled) throw new Error('Upload cancelled');
+                                }
+                            }
+                            uploaded++;
+                            continue;
+                        }
+                        await uploadFileXHR(upload.xhrs, item, file, onProgress);
+                        completed.push({
+                            b2_filename: item.b2_filename,
+                            original_filename: file.name,
+                            lease_id: item.lease_id,
+                            sha1: sha1
+                        });
+                    } catch (error) {
+                        if (upload.cancelled) throw error;
+                        failures.push(`${file.name}: ${error.message}`);
+                    } finally {
+                        inFlight.delete(item.b2_filename);
+                        completedBytes += file.size;
+                        updateProgress();
+                    }
+                }
+            };
+            const workers = [];
+            for (let i = 0; i < Math.min(BATCH_CONCURRENCY, queue.length); i++) {
+                workers.push(worker());
+            }
+            await Promise.all(workers);
+            
+            // 3. Registrar todo el bloque en Firebase con una sola petición
+            if (completed.length > 0) {
+                showMessage(`Registrando ${completed.length} imágenes en Firebase...`, 'info');
+                const response = await fetch('/api/upload/complete/batch', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                    },
+                    credentials: 'same-origin',
+                    body: JSON.stringify({ uploads: completed })
+                });
+                const data = await response.json();
+                if (!response.ok) {
+                    throw new Error(data.error || `Error ${response.status} registrando subidas`);
+                }
+                data.results.forEach(result => {
+                    if (result.success) {
+                        uploaded++;
+                    } else {
+                        failures.push(`${completed[result.index].original_filename}: ${result.error}`);
+                    }
+                });
+            }
+        }
+        
+        if (failures.length === 0) {
+            showMessage(`¡${uploaded} imágenes subidas exitosamente!`, 'success');
+        } else {
+            console.warn('Archivos con error:', failures);
+            showMessage(`${uploaded} imágenes subidas, ${failures.length} con error: ${failures.slice(0, 3).join('; ')}`, 'warning');
+        }
+        resetUploadUI();
+        syncImages(); // Añadir las imágenes nuevas
+    } catch (error) {
+        upload.xhrs.forEach(xhr => xhr.abort());
+        if (upload.cancelled) {
+            showMessage('Subida cancelada', 'error');
+        } else {
+            showMessage(error.message, 'error');
+        }
+        if (uploaded > 0) syncImages();
+    } finally {
+        if (batchUpload === upload) batchUpload = null;
+        uploadInProgress = false;
+        cancelBtn.textContent = 'Cancelar';
+        cancelBtn.disabled = true;
+        progressContainer.style.display = 'none';
+    }
+}
+
+// Cancelar una subida multiparte y descartar sus partes en B2
+function cancelLargeUpload() {
+    const upload = largeUpload;
+    upload.cancelled = true;
+    upload.xhrs.forEach(xhr => xhr.abort());
+    localStorage.removeItem(upload.resumeKey);
+    if (upload.fileId) {
+        postJSON('/api/upload/large/cancel', { file_id: upload.fileId }).catch(error => {
+            console.warn('No se pudo cancelar el archivo grande en B2:', error);
+        });
+    }
+}
+
+// Cancelar subida
+function cancelUpload() {
+    if (uploadInProgress && batchUpload) {
+        batchUpload.cancelled = true;
+        batchUpload.xhrs.forEach(xhr => xhr.abort());
+    } else if (uploadInProgress && largeUpload) {
+        cancelLargeUpload();
+    } else if (uploadInProgress && uploadXHR) {
+        uploadXHR.abort();
+        showMessage('Subida cancelada', 'error');
+        uploadInProgress = false;
+    }
+    
+    resetUploadUI();
+}
+
+// Pedir una página de imágenes al servidor
+async function fetchImagesPage(cursor = null) {
+    const params = new URLSearchParams({ limit: PAGE_SIZE });
+    if (cursor) params.set('cursor', cursor);
+    
+    const response = await fetch(`/uploads?${params}`, {
+        credentials: 'same-origin'
+    });
+    if (!response.ok) throw new Error(`Error ${response.status}`);
+    return response.json();
+}
+
+// Pedir una página de resultados de búsqueda (cancela la búsqueda anterior)
+async function fetchSearchPage(query, offset = 0) {
+    if (searchController) searchController.abort();
+    searchController = new AbortController();
+    const params = new URLSearchParams({ q: query, limit: PAGE_SIZE, offset });
+    
+    const response = await fetch(`/api/uploads/search?${params}`, {
+        credentials: 'same-origin',
+        signal: searchController.signal
+    });
+    if (!response.ok) throw new Error(`Error ${response.status}`);
+    return response.json();
+}
+
+// Mostrar la primera página de resultados de una búsqueda
+async function searchImages(query) {
+    try {
+        const data = await fetchSearchPage(query);
+        if (query !== searchQuery) return;
+        searchOffset = data.next_offset ?? null;
+        if ((data.images || []).length === 0) {
+            imagesList.innerHTML = `
+                <div class="message">
+                    No hay imágenes que coincidan con la búsqueda.
+                </div>
+            `;
+            return;
+        }
+        displayImages(data.images);
+    } catch (error) {
+        if (error.name === 'AbortError') return;
+        console.error('Error buscando imágenes:', error);
+        imagesList.innerHTML = `
+            <div class="message error">
+                Error al buscar imágenes: ${error.message}
+            </div>
+        `;
+    }
+}
+
+// ¿Quedan páginas por cargar (del listado o de la búsqueda activa)?
+function hasMoreImages() {
+    return searchQuery ? searchOffset !== null : Boolean(nextCursor);
+}
+
+// Cargar imágenes desde el servidor (primera página)
+async function loadImages() {
+    if (searchQuery) {
+        return searchImages(searchQuery);
+    }
+    
+    try {
+        loadingIndicator.style.display = 'block';
+        imagesList.innerHTML = '';
+        imagesList.appendChild(loadingIndicator);
+        
+        const data = await fetchImagesPage();
+        nextCursor = data.next_cursor || null;
+        const images = data.images || [];
+        // El servidor acepta el timestamp más reciente como punto de partida
+        changesToken = images.length > 0 ? images[0].timestamp : null;
+        displayImages(images);
+    } catch (error) {
+        console.error('Error cargando imágenes:', error);
+        imagesList.innerHTML = `
+            <div class="message error">
+                Error al cargar las imágenes: ${error.message}
+            </div>
+        `;
+    } finally {
+        loadingIndicator.style.display = 'none';
+    }
+}
+
+// Añadir a la lista solo los registros escritos desde la última carga
+async function syncImages() {
+    if (searchQuery || !changesToken) {
+        return loadImages();
+    }
+    
+    try {
+        const params = new URLSearchParams({ since: changesToken });
+        const response = await fetch(`/api/uploads/changes?${params}`, {
+            credentials: 'same-origin'
+        });
+        if (!response.ok) throw new Error(`Error ${response.status}`);
+        const data = await response.json();
+        if (data.reset) {
+            return loadImages();
+        }
+        changesToken = data.since;
+        
+        // Llegan en orden ascendente: insertar cada una al principio
+        const fresh = (data.images || []).filter(image => !shownUrls.has(image.url));
+        if (fresh.length === 0) return;
+        fresh.forEach(image => {
+            imagesList.insertBefore(createImageItem(image), imagesList.firstChild);
+        });
+    } catch (error) {
+        console.error('Error sincronizando imágenes:', error);
+        loadImages();
+    }
+}
+
+// Cargar la siguiente página (scroll infinito)
+async function loadMoreImages() {
+    if (!hasMoreImages() || loadingMore) return;
+    
+    loadingMore = true;
+    try {
+        if (searchQuery) {
+            const query = searchQuery;
+            const data = await fetchSearchPage(query, searchOffset);
+            if (query !== searchQuery) return;
+            searchOffset = data.next_offset ?? null;
+            displayImages(data.images || [], true);
+        } else {
+            const data = await fetchImagesPage(nextCursor);
+            nextCursor = data.next_cursor || null;
+            displayImages(data.images || [], true);
+        }
+    } catch (error) {
+        if (error.name === 'AbortError') return;
+        console.error('Error cargando más imágenes:', error);
+    } finally {
+        loadingMore = false;
+    }
+}
+
+// Centinela al final de la lista para cargar más imágenes al hacer scroll
+const scrollSentinel = document.createElement('div');
+scrollSentinel.className = 'scroll-sentinel';
+const scrollObserver = 'IntersectionObserver' in window
+    ? new IntersectionObserver((entries) => {
+        if (entries.some(entry => entry.isIntersecting)) {
+            loadMoreImages();
+        }
+    }, { root: imagesList, rootMargin: '400px' })
+    : null;
+
+// Decodificar un blurhash (https://blurha.sh) a una imagen pequeña como data URL
+const BASE83_CHARS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~';
+
+function decodeBase83(str) {
+    let value = 0;
+    for (const char of str) value = value * 83 + BASE83_CHARS.indexOf(char);
+    return value;
+}
+
+function srgbToLinear(value) {
+    const v = value / 255;
+    return v <= 0.04045 ? v / 12.92 : Math.pow((v + 0.055) / 1.055, 2.4);
+}
+
+function linearToSrgb(value) {
+    const v = Math.max(0, Math.min(1, value));
+    return v <= 0.0031308 ? Math.round(v * 12.92 * 255) : Math.round((1.055 * Math.pow(v, 1 / 2.4) - 0.055) * 255);
+}
+
+function blurhashToDataURL(hash, width = 32, height = 32) {
+    const sizeFlag = decodeBase83(hash[0]);
+    const numY = Math.floor(sizeFlag / 9) + 1;
+    const numX = (sizeFlag % 9) + 1;
+    if (hash.length !== 4 + 2 * numX * numY) return null;
+    const maxValue = (decodeBase83(hash[1]) + 1) / 166;
+    const signPow = (v, exp) => Math.sign(v) * Math.pow(Math.abs(v), exp);
+    const unquantise = (v) => signPow((v - 9) / 9, 2) * maxValue;
+    
+    const colors = [];
+    for (let i = 0; i < numX * numY; i++) {
+        if (i === 0) {
+            const value = decodeBase83(hash.substring(2, 6));
+            colors.push([srgbToLinear(value >> 16), srgbToLinear((value >> 8) & 255), srgbToLinear(value & 255)]);
+        } else {
+            const value = decodeBase83(hash.substring(4 + i * 2, 6 + i * 2));
+            colors.push([unquantise(Math.floor(value / 361)), unquantise(Math.floor(value / 19) % 19), unquantise(value % 19)]);
+        }
+    }
+    
+    const canvas = document.createElement('canvas');
+    canvas.width = width;
+    canvas.height = height;
+    const ctx = canvas.getContext('2d');
+    const pixels = ctx.createImageData(width, height);
+    for (let y = 0; y < height; y++) {
+        for (let x = 0; x < width; x++) {
+            let r = 0, g = 0, b = 0;
+            for (let j = 0; j < numY; j++) {
+                for (let i = 0; i < numX; i++) {
+                    const basis = Math.cos(Math.PI * x * i / width) * Math.cos(Math.PI * y * j / height);
+                    const color = colors[i + j * numX];
+                    r += color[0] * basis;
+                    g += color[1] * basis;
+                    b += color[2] * basis;
+                }
+            }
+            const offset = 4 * (x + y * width);
+            pixels.data[offset] = linearToSrgb(r);
+            pixels.data[offset + 1] = linearToSrgb(g);
+            pixels.data[offset + 2] = linearToSrgb(b);
+            pixels.data[offset + 3] = 255;
+        }
+    }
+    ctx.putImageData(pixels, 0, 0);
+    return canvas.toDataURL();
+}
+
+// Crear el elemento de la lista para una imagen
+function createImageItem(image) {
+    shownUrls.add(image.url);
+    const clone = imageItemTemplate.content.cloneNode(true);
+    const preview = clone.querySelector('.image-preview');
+    const img = clone.querySelector('.preview-img');
+    const filename = clone.querySelector('.image-filename');
+    const urlInput = clone.querySelector('.url-input');
+    const timeText = clone.querySelector('.time-text');
+    const viewLink = clone.querySelector('.btn-view');
+    const copyBtn = clone.querySelector('.btn-copy');
+    
+    // Configurar elementos
+    if (image.thumb && window.THUMB_WIDTHS && window.THUMB_WIDTHS.length) {
+        // Miniaturas redimensionadas en el servidor; el navegador elige el ancho
+        // según el tamaño de la vista previa y la densidad de la pantalla
+        img.srcset = window.THUMB_WIDTHS.map(w => `${image.thumb}?w=${w} ${w}w`).join(', ');
+        img.sizes = '120px';
+        img.src = `${image.thumb}?w=${window.THUMB_WIDTHS[0]}`;
+    } else {
+        img.src = image.url;
+    }
+    img.alt = image.filename;
+    img.loading = 'lazy';
+    img.decoding = 'async';
+    
+    // Metadatos (si ya se calcularon): placeholder mientras carga y detalles
+    if (image.width && image.height) {
+        img.width = image.width;
+        img.height = image.height;
+        const details = clone.querySelector('.image-details');
+        const size = image.bytes ? ` · ${formatFileSize(image.bytes)}` : '';
+        details.querySelector('.details-text').textContent = `${image.width}×${image.height}${size}`;
+        details.hidden = false;
+    }
+    if (image.color || image.blurhash) {
+        preview.classList.add('has-placeholder');
+        if (image.color) preview.style.backgroundColor = image.color;
+        const placeholder = image.blurhash ? blurhashToDataURL(image.blurhash) : null;
+        if (placeholder) preview.style.backgroundImage = `url(${placeholder})`;
+        img.addEventListener('load', () => {
+            preview.style.backgroundImage = '';
+        }, { once: true });
+    }
+    filename.textContent = image.filename;
+    urlInput.value = image.url;
+    timeText.textContent = timeAgo(image.timestamp);
+    viewLink.href = image.url;
+    
+    // Copiar URL al portapapeles
+    copyBtn.addEventListener('click', () => {
+        urlInput.select();
+        document.execCommand('copy');
+        
+        // Feedback visual
+        const originalHTML = copyBtn.innerHTML;
+        copyBtn.innerHTML = '<i class="fas fa-check"></i>';
+        copyBtn.style.background = '#2ecc71';
+        
+        setTimeout(() => {
+            copyBtn.innerHTML = originalHTML;
+            copyBtn.style.background = '';
+        }, 2000);
+    });
+    
+    return clone;
+}
+
+// Mostrar imágenes en la lista (append=true agrega la página al final)
+function displayImages(images, append = false) {
+    if (images.length === 0 && !append) {
+        imagesList.innerHTML = `
+            <div class="message">
+                No hay imágenes subidas todavía. ¡Sube la primera!
+            </div>
+        `;
+        return;
+    }
+    
+    if (!append) {
+        imagesList.innerHTML = '';
+        shownUrls.clear();
+    }
+    
+    // El servidor ya las devuelve ordenadas (más reciente primero)
+    images.forEach(image => {
+        imagesList.appendChild(createImageItem(image));
+    });
+    
+    // Mantener el centinela al final mientras queden páginas
+    if (hasMoreImages() && scrollObserver) {
+        imagesList.appendChild(scrollSentinel);
+        scrollObserver.observe(scrollSentinel);
+    } else if (scrollObserver) {
+        scrollObserver.unobserve(scrollSentinel);
+        scrollSentinel.remove();
+    }
+}
+
+// Buscar imágenes en el servidor (con debounce mientras se escribe)
+function filterImages(searchTerm) {
+    const term = searchTerm.trim();
+    
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(() => {
+        if (term === searchQuery) return;
+        searchQuery = term;
+        if (term === '') {
+            if (searchController) searchController.abort();
+            loadImages();
+        } else {
+            searchImages(term);
+        }
+    }, SEARCH_DEBOUNCE_MS);
+}
+
+// Event Listeners
+document.addEventListener('DOMContentLoaded', () => {
+    // Cargar imágenes al inicio
+    loadImages();
+    
+    // Click en área de subida para abrir selector de archivos
+    uploadArea.addEventListener('click', (e) => {
+        // Elementos que NO deben abrir el selector
+        const excludedElements = [
+            fileInput, uploadBtn, cancelBtn,
+            webpQuality, qualityValue, convertToWebp,
+            fileSizeComparison
+        ];
+        
+        // Verificar si el target es uno de los excluidos
+        if (excludedElements.includes(e.target)) return;
+        
+        // Verificar si el target está dentro de un contenedor excluido
+        const excludedContainers = [
+            '.convert-option',
+            '.quality-slider',
+            '.file-info',
+            '.buttons',
+            '.progress-container',
+            '#message'
+        ];
+        
+        for (const selector of excludedContainers) {
+            if (e.target.closest(selector)) return;
+        }
+        
+        // Solo se abre el selector si se hizo clic en el área vacía
+        fileInput.click();
+    });
+    
+    // Cambio en selector de archivos
+    fileInput.addEventListener('change', (e) => {
+        handleFilesSelect(e.target.files);
+    });
+    
+    // Drag and drop
+    uploadArea.addEventListener('dragover', (e) => {
+        e.preventDefault();
+        uploadArea.classList.add('drag-over');
+    });
+    
+    uploadArea.addEventListener('dragleave', () => {
+        uploadArea.classList.remove('drag-over');
+    });
+    
+    uploadArea.addEventListener('drop', (e) => {
+        e.preventDefault();
+        uploadArea.classList.remove('drag-over');
+        
+        handleFilesSelect(e.dataTransfer.files);
+    });
+    
+    // Botón de subir
+    uploadBtn.addEventListener('click', uploadFile);
+    
+    // Botón de cancelar
+    cancelBtn.addEventListener('click', cancelUpload);
+    
+    // Botón de actualizar lista
+    refreshBtn.addEventListener('click', loadImages);
+    
+    // Buscador
+    searchInput.addEventListener('input', (e) => {
+        filterImages(e.target.value);
+    });
+    
+    // Conversión a WebP
+    if (convertToWebp) {
+        convertToWebp.addEventListener('change', (e) => {
+            e.stopPropagation();
+            if (e.target.checked) {
+                qualitySlider.style.display = 'block';
+            } else {
+                qualitySlider.style.display = 'none';
+            }
+        });
+    }
+    
+    if (webpQuality && qualityValue) {
+        webpQuality.addEventListener('input', (e) => {
+            e.stopPropagation();
+            qualityValue.textContent = e.target.value;
+        });
+    }
+    
+    // Permitir subir con Enter cuando el input de archivo está seleccionado
+    document.addEventListener('keydown', (e) => {
+        if (e.key === 'Enter' && (currentFile || batchFiles.length > 1) && !uploadInProgress) {
+            uploadFile();
+        }
+        if (e.key === 'Escape' && (currentFile || batchFiles.length > 1 || uploadInProgress)) {
+            cancelUpload();
+        }
+    });
+});
+
+// Precarga de imágenes para vista previa (opcional)
+function previewImage(file) {
+    const reader = new FileReader();
+    reader.onload = (e) => {
+        // Podríamos mostrar una vista previa en miniatura
+        console.log('Vista previa cargada');
+    };
+    reader.readAsDataURL(file);
+}
\ No newline at end of file